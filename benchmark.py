@@ -0,0 +1,275 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Micro benchmarks of the HAGW hot paths.
+Usage: python benchmark.py [benchmark ...]
+"""
+
+import sys, os, logging, math, random, tempfile, timeit
+
+import settings
+
+
+def makePixieStatus(tags, refs=None):
+    """
+    Generate a Pixie status with reference points and connected tags at
+    random positions in the home.
+    :param: tags: number of tags
+    :param: refs: reference point ids, defaults to the configured ones
+    """
+    if refs is None:
+        refs = settings.PIXIE_SERVER_REFERENCE_POINTS
+    width = settings.PIXIE_SERVER_HOME_DIMENSIONS['x']
+    height = settings.PIXIE_SERVER_HOME_DIMENSIONS['y']
+    positions = {refs[0]: (0.0, 0.0), refs[1]: (float(width), 0.0)}
+    for ref in refs[2:]:
+        positions[ref] = (random.uniform(0, width), float(height))
+    for i in range(0, tags):
+        positions['%012X' % i] = (random.uniform(0, width), random.uniform(0, height))
+    points = {}
+    for key, (x, y) in positions.iteritems():
+        points[key] = {
+            'status': 'Connected',
+            'tagName': 'tag ' + key,
+            'tagColor': 'blue',
+            'range': dict((ref, math.hypot(x - rx, y - ry)) for ref, (rx, ry) in positions.iteritems() if ref in refs),
+        }
+    return {'username': 'benchmark', 'pixiePoints': points}
+
+
+def report(name, count, seconds):
+    print '%-56s %8d calls %10.1f us/call' % (name, count, seconds * 1e6 / count)
+
+
+def calculateCoordinates(dr1, dr2, d):
+    """
+    Calculate the x and y coordinates of a point based on its distance
+    to two reference points, one point at a time as the Pixie server did
+    before the batch engine.
+    :param dr1: distance of the point to reference point 1
+    :param dr2: distance of the point to reference point 2
+    :param d: distance between the two reference points
+    """
+    x = ((dr1 * dr1) - (dr2 * dr2) + (d * d)) / (2 * d)
+    y = math.sqrt((dr1 * dr1) - (x * x))
+    return (int(round(x)), int(round(y)))
+
+
+def benchTrilateration():
+    """
+    Compare the scalar per tag calculation with the batch engine.
+    """
+    import trilateration
+    refs = settings.PIXIE_SERVER_REFERENCE_POINTS
+    for tags in (100, 500, 1000):
+        points = makePixieStatus(tags)['pixiePoints']
+        def scalar():
+            d = points[refs[0]]['range'][refs[1]]
+            for key, value in points.iteritems():
+                if key not in refs:
+                    calculateCoordinates(value['range'][refs[0]], value['range'][refs[1]], d)
+        def batch():
+            geometry = trilateration.ReferenceGeometry(refs, points)
+            geometry.locate([[value['range'][r] for r in refs] for key, value in points.iteritems() if key not in refs])
+        runs = 20
+        report('trilateration scalar %d tags' % tags, runs, timeit.timeit(scalar, number=runs))
+        report('trilateration batch %d tags' % tags, runs, timeit.timeit(batch, number=runs))
+    print 'trilateration batch backend: %s' % ('numpy' if trilateration.numpy is not None else 'python')
+
+
+def benchLogging():
+    """
+    Measure the logging overhead per request on the request thread for a
+    Pixie reply and a vehicle status report, synchronous and asynchronous,
+    with and without payload truncation and sampling.
+    """
+    import hagwlogging
+    pstatus = makePixieStatus(50)
+    report_data = [{'channel': 'speed', 'value': '%d' % i} for i in range(0, 20)]
+    formatter = logging.Formatter('%(levelname)s %(asctime)s %(module)s %(process)d %(thread)d %(message)s')
+    fd, filename = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    variants = [
+        ('sync full payload', logging.FileHandler, False, None),
+        ('sync truncated payload', logging.FileHandler, True, None),
+        ('async truncated payload', hagwlogging.AsyncFileHandler, True, None),
+        ('async truncated sampled payload', hagwlogging.AsyncFileHandler, True, hagwlogging.PayloadSampler(10, 20)),
+    ]
+    try:
+        for name, handler_class, wrap, sampler in variants:
+            handler = handler_class(filename)
+            handler.setFormatter(formatter)
+            if sampler is not None:
+                handler.addFilter(sampler)
+            logger = logging.getLogger('hagw.benchmark.logging')
+            logger.handlers = [handler]
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            arg = hagwlogging.payload if wrap else (lambda value: value)
+            def request():
+                logger.info('Vehicle Callback Server: statusReport: vin: %s, timestamp: %s, data: %s.', 'VIN', 'now', arg(report_data))
+                logger.info('PIXIE Callback Server: sending message: %s to %s', arg(pstatus), 'sendto')
+            runs = 2000
+            report('logging %s' % name, runs, timeit.timeit(request, number=runs))
+            handler.close()
+    finally:
+        os.remove(filename)
+
+
+def benchJSON():
+    """
+    Compare encode and decode cost of the standard library defaults with
+    every installed JSON codec backend for the payloads the HAGW handles.
+    """
+    import json, jsoncodec, thingcontrolserver
+    command = thingcontrolserver.initData()
+    command['device_id'] = 'wip_gw2.zb_hue01'
+    command['device_type'] = 'zb_hue_bulb'
+    command['msgTyp'] = 'zb_hue_msg'
+    command['control'] = [{"value":255, "controlR":255, "controlG":255, "controlB":255}]
+    vehicle = {'jsonrpc': '2.0', 'id': 1, 'method': 'message',
+               'params': {'service_name': settings.VH_SERVER_SERVICE_ID + '/statusreport',
+                          'timeout': 1420070400,
+                          'parameters': [{'vin': 'SAJAA01T99GR00001'},
+                                         {'timestamp': '2015-01-01T00:00:00Z'},
+                                         {'data': [{'channel': 'seats', 'value': {'frontleft': 'occupied', 'frontright': 'empty'}},
+                                                   {'channel': 'trunk', 'value': 'closed'},
+                                                   {'channel': 'speed', 'value': '42.5'},
+                                                   {'channel': 'odometer', 'value': '12345.6'}]}]}}
+    payloads = [
+        ('pixie status', makePixieStatus(50)),
+        ('vehicle report', vehicle),
+        ('thingcontrol command', command),
+    ]
+    backends = [('stdlib default', json.dumps, json.loads)]
+    for name in ['ujson', 'simplejson', 'json']:
+        try:
+            jsoncodec.useBackend(name)
+            backends.append(('codec ' + name, jsoncodec.dumps, jsoncodec.loads))
+        except ImportError:
+            pass
+    runs = 2000
+    for payload_name, payload in payloads:
+        for backend_name, dumps, loads in backends:
+            text = dumps(payload)
+            report('json encode %s %s' % (payload_name, backend_name), runs,
+                   timeit.timeit(lambda: dumps(payload), number=runs))
+            report('json decode %s %s (%d bytes)' % (payload_name, backend_name, len(text)), runs,
+                   timeit.timeit(lambda: loads(text), number=runs))
+
+
+def benchDispatch():
+    """
+    Compare the RVI message routing of RVIJSONRPCServer with the previous
+    parameter flattening and jsonrpclib dispatch, and measure the full
+    dispatch including metrics and tracing separately.
+    """
+    from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer
+    from rvijsonrpc import RVIJSONRPCServer
+    def statusReport(vin, timestamp, data):
+        return {u'status': 0}
+    server = RVIJSONRPCServer(addr=('127.0.0.1', 0), logRequests=False, bind_and_activate=False)
+    server.register_function(statusReport, settings.VH_SERVER_SERVICE_ID + '/statusreport')
+    params = {'service_name': settings.VH_SERVER_SERVICE_ID + '/statusreport',
+              'timeout': 1420070400,
+              'parameters': [{'vin': 'SAJAA01T99GR00001'},
+                             {'timestamp': '2015-01-01T00:00:00Z'},
+                             {'data': [{'channel': 'speed', 'value': '42.5'}]}]}
+    def legacy():
+        dict_param = {}
+        msg_params = params['parameters']
+        for i in range(0, len(msg_params)):
+            for j in range(0, len(msg_params[i].keys())):
+                dict_param[msg_params[i].keys()[j]] = msg_params[i].values()[j]
+        return SimpleJSONRPCServer._dispatch(server, params['service_name'], dict_param)
+    def compiled():
+        dict_param = {}
+        for param in params['parameters']:
+            dict_param.update(param)
+        return server._call_route(server.service_routes[params['service_name']], dict_param)
+    def dispatch():
+        return server._dispatch('message', params)
+    runs = 100000
+    report('dispatch legacy', runs, timeit.timeit(legacy, number=runs))
+    report('dispatch compiled route', runs, timeit.timeit(compiled, number=runs))
+    report('dispatch compiled route with metrics', runs, timeit.timeit(dispatch, number=runs))
+    server.server_close()
+
+
+def benchRules():
+    """
+    Measure the rule evaluation per status report for growing numbers of
+    rules on channels the report does not contain, and on its channels.
+    """
+    from rules import RuleEngine
+    from telemetry import flattenReport
+    logger = logging.getLogger('hagw.benchmark.rules')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    data = [{'channel': 'seats', 'value': {'frontleft': 'occupied', 'frontright': 'empty'}},
+            {'channel': 'trunk', 'value': 'closed'},
+            {'channel': 'speed', 'value': '42.5'},
+            {'channel': 'odometer', 'value': '12345.6'}]
+    actions = {'none': lambda vin, rule, value: None}
+    for count in (10, 100, 1000):
+        specs = []
+        for i in range(0, count):
+            if i % 2:
+                specs.append({'channel': 'channel%d' % (i % 100), 'op': '>', 'value': i, 'action': 'none'})
+            else:
+                specs.append({'channel': 'trunk', 'value': 'state%d' % i, 'action': 'none'})
+        specs.append({'channel': 'speed', 'op': '>', 'value': 100, 'action': 'none'})
+        engine = RuleEngine(specs, actions, logger)
+        runs = 20000
+        report('rules %d rules per report' % count, runs,
+               timeit.timeit(lambda: engine.evaluate('VIN', flattenReport(data)), number=runs))
+
+
+def benchTagFilter():
+    """
+    Compare locating and encoding all tags of a Pixie status with a
+    request for two of them.
+    """
+    import pixieserver, jsoncodec
+    from cache import LRUCache
+    pixieserver.logger = logging.getLogger('hagw.benchmark')
+    pixieserver.logger.addHandler(logging.NullHandler())
+    pixieserver.logger.propagate = False
+    pixieserver.tag_filters = LRUCache(settings.PIXIE_SERVER_TAG_FILTER_CACHE_SIZE)
+    pstatus = makePixieStatus(1000)
+    for name, tags in (('all', ['*']), ('two', ['000000000001', 'tag 00000000002A'])):
+        def request():
+            match = pixieserver.getTagFilter(tags)
+            return jsoncodec.dumps(pixieserver.calculatePixieLocations(pstatus, match))
+        runs = 50
+        report('tag filter %s of 1000 tags (%d bytes)' % (name, len(request())), runs,
+               timeit.timeit(request, number=runs))
+
+
+benchmarks = {
+    'dispatch': benchDispatch,
+    'json': benchJSON,
+    'logging': benchLogging,
+    'rules': benchRules,
+    'tagfilter': benchTagFilter,
+    'trilateration': benchTrilateration,
+}
+
+"""
+Main Function
+"""
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        if name not in benchmarks:
+            print "Unknown benchmark: %s, available: %s" % (name, ', '.join(sorted(benchmarks.keys())))
+            sys.exit(2)
+        benchmarks[name]()
@@ -0,0 +1,151 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Caches used by the HAGW servers.
+"""
+
+import threading, time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Thread-safe cache of values that expire ttl seconds after they were
+    fetched. Concurrent misses for the same key are coalesced: the first
+    caller fetches the value, all others wait for and share its result.
+    A fetch returning None is not cached.
+    """
+
+    class Flight(object):
+        """
+        Fetch in progress.
+        """
+        def __init__(self):
+            self.done = threading.Event()
+            self.value = None
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.coalesced = 0
+
+    def get(self, key, fetch):
+        """
+        Return the value for key, calling fetch() if it is not cached or
+        has expired.
+        :param: key: cache key
+        :param: fetch: function returning the value for key
+        """
+        leader = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.hits += 1
+                    return entry[0]
+                self.stale += 1
+            else:
+                self.misses += 1
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+            else:
+                flight = self.flights[key] = TTLCache.Flight()
+                leader = True
+        if not leader:
+            flight.done.wait()
+            return flight.value
+        try:
+            flight.value = fetch()
+        finally:
+            with self.lock:
+                if flight.value is not None:
+                    self.entries[key] = (flight.value, time.time() + self.ttl)
+                del self.flights[key]
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, key=None):
+        """
+        Drop the entry for key or all entries.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Return the cache statistics.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'coalesced': self.coalesced,
+                'entries': len(self.entries),
+            }
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache of at most size values. When it is full the least
+    recently used value is evicted.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        """
+        Return the value for key, calling compute() if it is not cached.
+        :param: key: cache key, hashable
+        :param: compute: function returning the value for key
+        """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        """
+        Return the cache statistics.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+            }
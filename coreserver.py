@@ -16,48 +16,56 @@ itself rather than devices it connects to.
 import os, threading, base64
 import time, httplib, json, math
 from urlparse import urlparse
-from rvijsonrpc import RVIJSONRPCServer
+from rvijsonrpc import RVICallbackServer
 
-import settings
+import settings, metrics, tracing, profiler
 
 logger = None
 service_edge = None
-transaction_id = 0
 
 # Core Callback Server
-class CoreCallbackServer(threading.Thread):
+class CoreCallbackServer(RVICallbackServer):
     """
     RPC server thread responding to core callbacks from the RVI framework
     """
+
+    live_settings = ('CORE_SERVER_RVI_DOMAIN',)
     
-    def __init__(self, _logger, _service_edge):
+    def __init__(self, _logger, _service_edge, _mux=None):
         global logger
         global service_edge
         logger = _logger
         service_edge = _service_edge
-        threading.Thread.__init__(self)
+        RVICallbackServer.__init__(self, settings.CORE_SERVER_CALLBACK_URL, settings.CORE_SERVER_SERVICE_ID, _mux)
         self.init_callback_server()
-        self.register_services()
 
     def init_callback_server(self):
         # initialize RPC server and register callback functions
-        url = urlparse(settings.CORE_SERVER_CALLBACK_URL)
-        self.localServer =  RVIJSONRPCServer(addr=((url.hostname, url.port)), logRequests=False)
+        self.localServer = self.create_local_server()
         self.localServer.register_function(ping, settings.CORE_SERVER_SERVICE_ID + "/ping")
+        self.localServer.register_function(getMetrics, settings.CORE_SERVER_SERVICE_ID + "/metrics")
+        self.localServer.register_function(getTraces, settings.CORE_SERVER_SERVICE_ID + "/gettraces")
+        self.localServer.register_function(startProfile, settings.CORE_SERVER_SERVICE_ID + "/startprofile")
+        self.localServer.register_function(stopProfile, settings.CORE_SERVER_SERVICE_ID + "/stopprofile")
         
     def register_services(self):
         # register services with RVI framework
-        result = service_edge.register_service(service = settings.CORE_SERVER_SERVICE_ID + '/ping',
-                                               network_address = settings.CORE_SERVER_CALLBACK_URL)
-        logger.info('Core Server: Service Registration: ping service name: %s', result)
-        return result
+        services = [settings.CORE_SERVER_SERVICE_ID + '/' + name for name in
+                    ['ping', 'metrics', 'gettraces', 'startprofile', 'stopprofile']]
+        results = self.register_rvi_services(service_edge, services)
+        for result in results:
+            logger.info('Core Server: Service Registration: service name: %s', result['service'])
+        return results
 
-    def run(self):
-        self.localServer.serve_forever()
-        
-    def shutdown(self):
-        self.localServer.shutdown()
-        self.localServer.server_close()
+
+# Support functions
+def sendRVIMessage(sendto, message):
+    """
+    Send message to recipient via RVI.
+    :param: sendto: recipient RVI service
+    :param: message: message as RVI parameter block
+    """
+    return service_edge.send(sendto, message, logger, 'Core Server')
 
 
 # Callback functions
@@ -68,3 +76,66 @@ def ping(message):
     """
     logger.info('Core Server: ping: %s', message)
     return {u'status': 0}
+
+def getMetrics(sendto):
+    """
+    Send the request counts, error counts and latency histograms of the
+    services and outbound dependencies of the HAGW.
+    :param: sendto: RVI service to send the metrics to
+    """
+    logger.info('Core Server: getMetrics: sendto: %s', sendto)
+    sendRVIMessage(sendto, metrics.registry.snapshot())
+    return {u'status': 0}
+
+def getTraces(sendto, limit=None):
+    """
+    Send the most recent slow traces, newest first.
+    :param: sendto: RVI service to send the traces to
+    :param: limit: maximum number of traces
+    """
+    logger.info('Core Server: getTraces: sendto: %s', sendto)
+    sendRVIMessage(sendto, {u'traces': tracing.traces(limit)})
+    return {u'status': 0}
+
+def startProfile(mode=u'sampling', interval=None, duration=None):
+    """
+    Start profiling the HAGW.
+    :param: mode: 'sampling' samples the stacks of all threads, 'cprofile'
+                  runs every RPC call under cProfile
+    :param: interval: sampling interval in seconds
+    :param: duration: seconds after which profiling stops by itself
+    """
+    logger.info('Core Server: startProfile: mode: %s, interval: %s, duration: %s', mode, interval, duration)
+    try:
+        if not profiler.start(mode, interval, duration):
+            logger.error('Core Server: startProfile: profiling already running')
+            return {u'status': 1}
+    except ValueError as e:
+        logger.error('Core Server: startProfile: %s', e)
+        return {u'status': 1}
+    return {u'status': 0}
+
+def stopProfile(sendto=None, limit=20, dump=False):
+    """
+    Stop profiling and report the functions the HAGW spent the most time
+    in. If profiling has already stopped by itself the last session is
+    reported.
+    :param: sendto: RVI service to send the report to
+    :param: limit: number of functions reported
+    :param: dump: write the session to settings.PROFILE_DIR
+    """
+    logger.info('Core Server: stopProfile: sendto: %s, dump: %s', sendto, dump)
+    profile = profiler.stop()
+    if profile is None:
+        logger.error('Core Server: stopProfile: no profiling session')
+        return {u'status': 1}
+    report = profile.stats(limit)
+    if dump:
+        try:
+            report['file'] = profiler.dump(profile)
+            logger.info('Core Server: stopProfile: written to %s', report['file'])
+        except (IOError, OSError) as e:
+            logger.error('Core Server: stopProfile: cannot write profile: %s', e)
+    if sendto is not None:
+        sendRVIMessage(sendto, report)
+    return {u'status': 0, u'file': report.get('file')}
@@ -130,6 +130,29 @@ class Daemon(object):
                 sys.stderr.write(message % err)
                 sys.exit(1)
  
+    def reload(self):
+        """
+        Ask the daemon to reload its configuration
+        """
+        try:
+            pf = file(self.pidfile,'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except IOError:
+            pid = None
+
+        if not pid:
+            message = "Daemon: Pidfile %s does not exist. Daemon not running?\n"
+            sys.stderr.write(message % self.pidfile)
+            sys.exit(1)
+
+        try:
+            os.kill(pid, SIGHUP)
+        except OSError, err:
+            message = "Daemon: Error reloading: %s\n"
+            sys.stderr.write(message % err)
+            sys.exit(1)
+
     def restart(self):
         """
         Restart the daemon
@@ -0,0 +1,412 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+End to end benchmark of the HAGW services. Starts the HAGW with local
+stand-ins for the RVI Service Edge, the Pixie Adjacent Server, the
+Thingcontrol gateway and the TV and IVI, drives the services at a fixed
+request rate and reports throughput and latency percentiles.
+Usage: python e2ebench.py [options] [scenario ...], see --help
+"""
+
+import sys, os, logging, threading, random, tempfile, time, argparse
+import BaseHTTPServer, SocketServer
+from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer
+
+import settings, jsoncodec
+from httppool import HTTPConnectionPool
+from benchmark import makePixieStatus
+
+
+class StandIn(object):
+    """
+    Latency and failure injection of a stand-in: every request waits for
+    latency seconds, +/- jitter, and fails with probability failure_rate.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'failures': 0}
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def delay(self, fail=True):
+        """
+        Wait for the latency and return True if the request fails.
+        :param: fail: False if the request must not fail
+        """
+        self.count('requests')
+        latency = self.latency + random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+        if fail and random.random() < self.failure_rate:
+            self.count('failures')
+            return True
+        return False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class ThreadingJSONRPCServer(SocketServer.ThreadingMixIn, SimpleJSONRPCServer):
+    daemon_threads = True
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RVIStandIn(StandIn):
+    """
+    RVI Service Edge accepting service registrations and messages.
+    """
+
+    def __init__(self, port, **kwargs):
+        StandIn.__init__(self, **kwargs)
+        self.server = ThreadingJSONRPCServer(('127.0.0.1', port), logRequests=False)
+        self.server.register_function(self.register_service, 'register_service')
+        self.server.register_function(self.message, 'message')
+
+    def register_service(self, service, network_address):
+        # registrations do not fail, startup is not benchmarked
+        self.delay(fail=False)
+        return {'service': settings.CORE_SERVER_RVI_DOMAIN + service, 'status': 0}
+
+    def message(self, service_name, timeout, parameters):
+        if self.delay():
+            raise Exception('injected failure')
+        self.count('messages')
+        return {'status': 0}
+
+
+class HTTPStandIn(StandIn):
+    """
+    HTTP server answering GET and POST requests with handle(method, path,
+    body), which returns the response body.
+    """
+
+    def __init__(self, port, **kwargs):
+        StandIn.__init__(self, **kwargs)
+        standin = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # the response is written in pieces, do not let them wait for
+            # delayed acknowledgements
+            disable_nagle_algorithm = True
+
+            def respond(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                if standin.delay():
+                    status, data = 500, '{}'
+                else:
+                    status, data = 200, standin.handle(method, self.path, body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+
+
+class PixieStandIn(HTTPStandIn):
+    """
+    Pixie Adjacent Server reporting tags that move a little on every request.
+    """
+
+    def __init__(self, port, tags, **kwargs):
+        HTTPStandIn.__init__(self, port, **kwargs)
+        self.status = makePixieStatus(tags)
+
+    def handle(self, method, path, body):
+        refs = settings.PIXIE_SERVER_REFERENCE_POINTS
+        with self.lock:
+            for key, point in self.status['pixiePoints'].iteritems():
+                if key not in refs:
+                    for ref in refs:
+                        point['range'][ref] = max(point['range'][ref] + random.uniform(-5, 5), 1.0)
+            return jsoncodec.dumps(self.status)
+
+
+class ThingcontrolStandIn(HTTPStandIn):
+    """
+    Thingcontrol gateway accepting commands and reporting a thermostat.
+    """
+
+    def handle(self, method, path, body):
+        if method == 'POST':
+            self.count('commands')
+            return '{}'
+        return jsoncodec.dumps({'device_id': 'wip_gw2.zw_thermostat01', 'device_type': 'zw_thermostat',
+                                'msgTyp': 'zw_thermostat_msg', 'control': [{'target_temp': 21}]})
+
+
+class SocketStandIn(StandIn):
+    """
+    TCP endpoint like the TV or the IVI counting the messages it receives.
+    Closes the connection of a message with probability failure_rate.
+    """
+
+    def __init__(self, port, **kwargs):
+        StandIn.__init__(self, **kwargs)
+        standin = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    standin.count('messages')
+                    if standin.delay():
+                        return
+
+        class Server(SocketServer.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(('127.0.0.1', port), Handler)
+
+
+class Scenario(object):
+    """
+    RVI message to a HAGW service, with parameters made by params(i) for
+    the i-th request.
+    """
+
+    def __init__(self, name, service, params):
+        self.name = name
+        self.service = service
+        self.params = params
+
+
+def rvi(**kwargs):
+    # RVI parameter block, one dictionary per parameter
+    return [{key: value} for key, value in kwargs.iteritems()]
+
+
+scenarios = [
+    Scenario('core-ping', '/core/ping', lambda i: rvi(message='ping %d' % i)),
+    Scenario('pixie-locations', '/pixie/getitemlocations', lambda i: rvi(tags=['*'], sendto='jlr.com/bench/pixie')),
+    Scenario('pixie-locations-filtered', '/pixie/getitemlocations',
+             lambda i: rvi(tags=['000000000001', '000000000002'], sendto='jlr.com/bench/pixie')),
+    Scenario('pixie-raw', '/pixie/getrawitemlocations', lambda i: rvi(tags=['*'], sendto='jlr.com/bench/pixie')),
+    Scenario('thingcontrol-status', '/thingcontrol/getdevicestatus', lambda i: rvi(devices=['thermostat'], sendto='jlr.com/bench/tc')),
+    Scenario('thingcontrol-dimmer', '/thingcontrol/setdimmer',
+             lambda i: rvi(deviceid='wip_gw2.zb_dimmer%02d' % (i % 16), control=[{'value': i % 100}])),
+    Scenario('thingcontrol-batch', '/thingcontrol/batch',
+             lambda i: rvi(commands=[{'command': 'dimmer', 'deviceid': 'wip_gw2.zb_dimmer%02d' % d,
+                                      'control': [{'value': i % 100}]} for d in range(0, 4)])),
+    Scenario('message-show', '/message/showusermessage',
+             lambda i: rvi(messageid=i, displays=['tv'], messagetext='message %d' % i)),
+    Scenario('message-cancel', '/message/cancelusermessage', lambda i: rvi(messageid=i, displays=['tv'])),
+    Scenario('vehicle-report', '/vehicle/statusreport',
+             lambda i: rvi(vin='SAJAA01T99GR%05d' % (i % 10), timestamp='2015-01-01T00:00:00Z',
+                           data=[{'channel': 'speed', 'value': '%d' % (i % 120)},
+                                 {'channel': 'odometer', 'value': '%d' % (10000 + i)},
+                                 {'channel': 'trunk', 'value': 'open' if i % 20 == 0 else 'closed'},
+                                 {'channel': 'seats', 'value': {'frontleft': 'occupied', 'frontright': 'empty'}}])),
+    Scenario('vehicle-telemetry', '/vehicle/gettelemetry',
+             lambda i: rvi(vin='SAJAA01T99GR%05d' % (i % 10), channels=['speed'], window=60, sendto='jlr.com/bench/vehicle')),
+]
+
+
+def callbackURL(service):
+    if settings.MUX_SERVER_ENABLE == True:
+        return settings.MUX_SERVER_CALLBACK_URL
+    prefix = '/' + service.split('/')[1]
+    for url, service_id in [(settings.CORE_SERVER_CALLBACK_URL, settings.CORE_SERVER_SERVICE_ID),
+                            (settings.PIXIE_SERVER_CALLBACK_URL, settings.PIXIE_SERVER_SERVICE_ID),
+                            (settings.TC_SERVER_CALLBACK_URL, settings.TC_SERVER_SERVICE_ID),
+                            (settings.UM_SERVER_CALLBACK_URL, settings.UM_SERVER_SERVICE_ID),
+                            (settings.VH_SERVER_CALLBACK_URL, settings.VH_SERVER_SERVICE_ID)]:
+        if service_id == prefix:
+            return url
+    raise ValueError('no server for service %s' % service)
+
+
+def drive(scenario, rate, duration, threads):
+    """
+    Send requests of a scenario at a fixed rate and return the latencies
+    of the successful ones, the number of errors and the elapsed time.
+    Latencies are taken from the time a request was due, so a server
+    falling behind shows up as latency instead of a lower request rate.
+    """
+    pool = HTTPConnectionPool(callbackURL(scenario.service), size=threads)
+    headers = {'Content-Type': 'application/json-rpc'}
+    count = int(rate * duration)
+    start = time.time() + 0.1
+    next_request = [0]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next_request[0]
+                if i >= count:
+                    return
+                next_request[0] += 1
+            due = start + i / float(rate)
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            request = jsoncodec.dumps({'jsonrpc': '2.0', 'id': i, 'method': 'message',
+                                       'params': {'service_name': scenario.service,
+                                                  'timeout': int(time.time()) + 60,
+                                                  'parameters': scenario.params(i)}})
+            try:
+                status, reason, data = pool.request('POST', '/', request, headers)
+                response = jsoncodec.loads(data)
+                # services report failures with a status other than 0
+                ok = status == 200 and 'error' not in response and response['result'].get('status', 0) == 0
+            except Exception:
+                ok = False
+            latency = time.time() - due
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors[0] += 1
+
+    workers = [threading.Thread(target=worker) for n in range(0, threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    pool.close()
+    return latencies, errors[0], elapsed
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def report(name, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    print '%-26s %7d %6d %9.1f %9.2f %9.2f %9.2f %9.2f' % (
+        name, len(latencies), errors, len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+        percentile(latencies, 0.99) * 1000, (latencies[-1] if latencies else 0.0) * 1000)
+
+
+def configure(args):
+    """
+    Point the HAGW settings at the stand-ins and the local callback ports.
+    """
+    base = args.port_base
+    settings.RVI_SERVICE_EDGE_URL = 'http://127.0.0.1:%d' % (base + 1)
+    settings.PIXIE_SERVER_ADJACENT_URL = 'http://127.0.0.1:%d' % (base + 2)
+    settings.TC_SERVER_GATEWAY_URL = 'http://127.0.0.1:%d' % (base + 3)
+    settings.TV_SERVICE_EDGE_URL = 'tcp://127.0.0.1:%d' % (base + 4)
+    settings.IVI_SERVICE_EDGE_URL = 'tcp://127.0.0.1:%d' % (base + 5)
+    settings.CORE_SERVER_CALLBACK_URL = 'http://127.0.0.1:%d' % (base + 10)
+    settings.PIXIE_SERVER_CALLBACK_URL = 'http://127.0.0.1:%d' % (base + 11)
+    settings.TC_SERVER_CALLBACK_URL = 'http://127.0.0.1:%d' % (base + 12)
+    settings.UM_SERVER_CALLBACK_URL = 'http://127.0.0.1:%d' % (base + 13)
+    settings.VH_SERVER_CALLBACK_URL = 'http://127.0.0.1:%d' % (base + 14)
+    settings.MUX_SERVER_CALLBACK_URL = 'http://127.0.0.1:%d' % (base + 15)
+    settings.MUX_SERVER_ENABLE = args.mux
+    settings.PIXIE_SERVER_POLL_ENABLE = args.poll
+    settings.PIXIE_SERVER_ENABLE = True
+    settings.TC_SERVER_ENABLE = True
+    settings.UM_SERVER_ENABLE = True
+    settings.VH_SERVER_ENABLE = True
+
+
+"""
+Main Function
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End to end benchmark of the HAGW services.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, default all: ' +
+                        ', '.join(s.name for s in scenarios))
+    parser.add_argument('--rate', type=float, default=50, help='requests per second per scenario')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per scenario')
+    parser.add_argument('--threads', type=int, default=8, help='client threads')
+    parser.add_argument('--latency', type=float, default=5, help='stand-in latency in ms')
+    parser.add_argument('--jitter', type=float, default=2, help='stand-in latency jitter in ms')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='stand-in failure probability')
+    parser.add_argument('--tags', type=int, default=100, help='number of Pixie tags')
+    parser.add_argument('--mux', action='store_true', help='use the multiplex server')
+    parser.add_argument('--poll', action='store_true', help='poll the Pixie status in the background')
+    parser.add_argument('--port-base', type=int, default=21000, help='first local port used')
+    parser.add_argument('--log', help='write the HAGW log to this file')
+    args = parser.parse_args()
+
+    selected = [s for s in scenarios if not args.scenarios or s.name in args.scenarios]
+    unknown = set(args.scenarios) - set(s.name for s in scenarios)
+    if unknown:
+        print 'Unknown scenarios: %s' % ', '.join(sorted(unknown))
+        sys.exit(2)
+
+    configure(args)
+    import hagwserver, tracing
+    logger = logging.getLogger('hagw.e2ebench')
+    logger.propagate = False
+    if args.log:
+        handler = logging.FileHandler(args.log)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(asctime)s %(module)s %(thread)d %(trace_id)s %(message)s'))
+        handler.addFilter(tracing.TraceFilter())
+        logger.setLevel(logging.INFO)
+    else:
+        handler = logging.NullHandler()
+    logger.addHandler(handler)
+    hagwserver.logger = logger
+    tracing.logger = logger
+
+    faults = dict(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0, failure_rate=args.failure_rate)
+    standins = [
+        ('rvi', RVIStandIn(args.port_base + 1, **faults)),
+        ('pixie', PixieStandIn(args.port_base + 2, args.tags, **faults)),
+        ('thingcontrol', ThingcontrolStandIn(args.port_base + 3, **faults)),
+        ('tv', SocketStandIn(args.port_base + 4, failure_rate=args.failure_rate)),
+        ('ivi', SocketStandIn(args.port_base + 5, failure_rate=args.failure_rate)),
+    ]
+    for name, standin in standins:
+        thread = threading.Thread(target=standin.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    server = hagwserver.HAGWServer(os.path.join(tempfile.gettempdir(), 'e2ebench.pid'))
+    begin = time.time()
+    if not server.startup():
+        print 'HAGW startup failed'
+        sys.exit(1)
+    print 'HAGW started in %.3f s, %s, %d scenarios at %.0f requests/s for %.0f s' % (
+        time.time() - begin, 'multiplex server' if args.mux else 'one server per service',
+        len(selected), args.rate, args.duration)
+    print '%-26s %7s %6s %9s %9s %9s %9s %9s' % ('scenario', 'ok', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    try:
+        for scenario in selected:
+            report(scenario.name, *drive(scenario, args.rate, args.duration, args.threads))
+    finally:
+        server.cleanup()
+    for name, standin in standins:
+        print '%-12s %s' % (name, ', '.join('%s: %d' % item for item in sorted(standin.stats().items())))
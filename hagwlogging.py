@@ -0,0 +1,204 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Logging support: asynchronous file handler, payload truncation and payload
+sampling. Handlers and filters are configured in settings.LOGGING_CONFIG.
+"""
+
+import os, threading, time, Queue
+import logging
+
+import settings, tracing
+
+
+class AsyncFileHandler(logging.FileHandler):
+    """
+    File handler writing records from a background thread. Records are
+    formatted on the logging thread, so they show their arguments as they
+    were when logged, and written by the writer thread. If the queue is
+    full records are dropped and counted.
+    The writer is started on first use in every process, so the handler
+    survives the forks of the daemon.
+    """
+
+    def __init__(self, filename, mode='a', encoding=None, delay=False, queue_size=10000):
+        logging.FileHandler.__init__(self, filename, mode, encoding, delay)
+        self.queue_size = queue_size
+        self.queue = None
+        self.writer = None
+        self.pid = None
+        self.dropped = 0
+        self.start_lock = threading.Lock()
+
+    def createLock(self):
+        logging.FileHandler.createLock(self)
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = Queue.Queue(self.queue_size)
+                self.writer = threading.Thread(target=self.write, name='AsyncFileHandler')
+                self.writer.daemon = True
+                self.writer.start()
+                self.pid = os.getpid()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait((record, msg))
+        except Queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        queue = self.queue
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            record, msg = item
+            try:
+                if self.stream is None:
+                    self.stream = self._open()
+                try:
+                    self.stream.write('%s\n' % msg)
+                except UnicodeError:
+                    self.stream.write(('%s\n' % msg).encode('UTF-8'))
+                self.flush()
+            except Exception:
+                self.handleError(record)
+
+    def stats(self):
+        return {'dropped': self.dropped, 'queued': self.queue.qsize() if self.queue is not None else 0}
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.writer.join(5)
+            self.pid = None
+        logging.FileHandler.close(self)
+
+
+def afterFork():
+    """
+    Create the locks of the logging module and of all handlers anew in a
+    forked process. A lock held by another thread of the parent at the time
+    of the fork, e.g. the writer of an AsyncFileHandler flushing its stream,
+    would never be released in the child.
+    """
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
+
+
+class Payload(object):
+    """
+    Log argument rendering a payload truncated to at most limit
+    characters. The payload is only rendered if the record is formatted.
+    """
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.value)
+        if self.limit > 0 and len(text) > self.limit:
+            return '%s... (%d more)' % (text[:self.limit], len(text) - self.limit)
+        return text
+
+
+def payload(value):
+    """
+    Wrap a payload for logging, e.g. logger.info('data: %s', payload(data)).
+    :param: value: payload
+    """
+    return Payload(value, settings.LOG_PAYLOAD_MAX)
+
+
+class PayloadSampler(logging.Filter):
+    """
+    Rate limit the payloads logged per service with a token bucket of
+    burst records refilled at rate records per second. The service is the
+    name of the trace of the logging thread, or the module logging outside
+    of traces. Records over the limit are still logged but their payloads
+    are replaced by a marker. A record is sampled once, even if the filter
+    is attached to several handlers. The buckets are updated without a
+    lock, concurrent records may occasionally share a token.
+    """
+
+    SAMPLED = '<payload not logged>'
+
+    def __init__(self, rate=10, burst=20):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # [tokens, last refill] by service
+        self.buckets = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        args = record.args
+        if type(args) is not tuple or 'payload_sampled' in record.__dict__:
+            return True
+        for arg in args:
+            if type(arg) is Payload:
+                break
+        else:
+            return True
+        record.payload_sampled = True
+        trace = tracing.current()
+        key = trace.name if trace is not None else record.module
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        bucket[0] = tokens
+        self.suppressed += 1
+        record.args = tuple(PayloadSampler.SAMPLED if type(a) is Payload else a for a in args)
+        return True
+
+    def stats(self):
+        return {'suppressed': self.suppressed, 'services': len(self.buckets)}
+
+
+def stats():
+    """
+    Return the counters of the asynchronous handlers and payload samplers
+    of the process by handler name.
+    """
+    stats = {}
+    for ref in list(logging._handlerList):
+        handler = ref()
+        if handler is None:
+            continue
+        entry = {}
+        if isinstance(handler, AsyncFileHandler):
+            entry.update(handler.stats())
+        for sampler in handler.filters:
+            if isinstance(sampler, PayloadSampler):
+                entry.update(sampler.stats())
+        if entry:
+            stats[handler.get_name() or handler.__class__.__name__] = entry
+    return stats
@@ -12,7 +12,7 @@ Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
 Home Automation Gateway with RVI integration.
 """
 
-import sys, os, logging, jsonrpclib
+import sys, os, logging, logging.config, threading
 import time
 from signal import *
 from urlparse import urlparse
@@ -21,6 +21,12 @@ from urlparse import urlparse
 import __init__, settings
 from daemon import Daemon
 
+import rviclient
+import hagwlogging
+import metrics
+import tracing
+import supervisor
+import muxserver
 import coreserver
 import pixieserver
 import thingcontrolserver
@@ -29,12 +35,48 @@ import vehicleserver
 
 logger = logging.getLogger('hagw.default')
 
+# settings of the callback servers by prefix, the first one is the server's own
+SERVER_SETTINGS = {
+    'core': ('CORE_SERVER_',),
+    'pixie': ('PIXIE_SERVER_',),
+    'thingcontrol': ('TC_SERVER_', 'IVI_'),
+    'usermessage': ('UM_SERVER_',),
+    'vehicle': ('VH_SERVER_', 'TV_'),
+}
+# settings read on every use, by prefix
+LIVE_SETTINGS = ('MAIN_LOOP_INTERVAL', 'SERVER_STARTUP_TIMEOUT', 'SUPERVISOR_', 'RVI_SEND_TIMEOUT',
+                 'LOG_PAYLOAD_MAX', 'TRACE_ENABLE', 'TRACE_SLOW_THRESHOLD', 'PROFILE_',
+                 'PROCESS_WORKERS')
+
+
+def settingsSnapshot():
+    """
+    Return the settings as a dictionary.
+    """
+    return dict((name, getattr(settings, name)) for name in dir(settings) if name.isupper())
+
 class HAGWServer(Daemon):
     """
     Main server daemon
     """
     rvi_service_edge = None
+    mux_server = None
+    metrics_server = None
+    supervisor = None
+    reload_requested = False
     servers = {}
+    startup_lock = threading.Lock()
+
+    # in a worker process: keys of the servers it runs (None for all),
+    # its number and the pid of the daemon
+    only = None
+    worker = None
+    parent = None
+    # in the daemon running the workers: (name, slot, start time) by pid
+    workers = {}
+    worker_backoffs = {}
+    stopping = set()
+    shutting_down = False
     
     core_cb_server = None
     pixie_cb_server = None
@@ -57,6 +99,13 @@ class HAGWServer(Daemon):
         for key, value in self.servers.iteritems():
             if value is not None:
                 value.shutdown()
+        self.servers = {}
+        self.mux_server = None
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        self.metrics_server = None
+        if self.rvi_service_edge is not None:
+            self.rvi_service_edge.close()
         self.rvi_service_edge = None
 
     def startup(self):
@@ -64,6 +113,7 @@ class HAGWServer(Daemon):
         Initialization and startup
         """
         logger.info('HAGW Server: Starting...')
+        startup_begin = time.time()
 
         logger.debug('HAGW Server: General Configuration: ' + 
             'RVI_SERVICE_EDGE_URL: '  + settings.RVI_SERVICE_EDGE_URL
@@ -71,122 +121,554 @@ class HAGWServer(Daemon):
 
         # setup RVI Service Edge
         logger.info('HAGW Server: Setting up outbound connection to RVI Service Edge at %s', settings.RVI_SERVICE_EDGE_URL)
-        self.rvi_service_edge = jsonrpclib.Server(settings.RVI_SERVICE_EDGE_URL)
-        
-        # Core Server Startup
-        logger.info('HAGW Server: Starting Core Server on %s with service id %s.', settings.CORE_SERVER_CALLBACK_URL, settings.CORE_SERVER_SERVICE_ID)
-        while True:
-            try:
-                server = coreserver.CoreCallbackServer(logger, self.rvi_service_edge)
-                server.start()
-                self.servers['core'] = server
-                logger.info('HAGW Server: Core Server started.')
-                break
-            except Exception as e:
-                logger.error('HAGW Server: Core Server startup failure: %s', e)
-                self.cleanup()
-                time.sleep(settings.MAIN_LOOP_INTERVAL)
-                
-        # Pixie Server Startup
-        if settings.PIXIE_SERVER_ENABLE == True:
-            # start the Pixie Server
+        self.rvi_service_edge = rviclient.RVIServiceEdge(settings.RVI_SERVICE_EDGE_URL,
+                                                         pool_size=settings.RVI_SERVICE_EDGE_POOL_SIZE,
+                                                         connect_timeout=settings.RVI_SERVICE_EDGE_CONNECT_TIMEOUT,
+                                                         read_timeout=settings.RVI_SERVICE_EDGE_READ_TIMEOUT)
+        self.rvi_service_edge.send_queue = self.create_send_queue()
+
+        # Metrics Endpoint Startup
+        self.start_metrics_server()
+
+        # Multiplex Server Startup
+        if settings.MUX_SERVER_ENABLE == True:
             try:
-                logger.info('HAGW Server: Starting Pixie Adjacent Callback Server on %s with service id %s.', settings.PIXIE_SERVER_CALLBACK_URL, settings.PIXIE_SERVER_SERVICE_ID)
-                server = pixieserver.PixieCallbackServer(logger, self.rvi_service_edge)
+                logger.info('HAGW Server: Starting Multiplex Server on %s.', settings.MUX_SERVER_CALLBACK_URL)
+                server = muxserver.MultiplexCallbackServer(logger, self.rvi_service_edge)
                 server.start()
-                self.servers['pixie'] = server
-                logger.info('HAGW Server: Pixie Adjacent Callback Server started.')
+                self.servers['mux'] = server
+                self.mux_server = server
+                logger.info('HAGW Server: Multiplex Server started.')
             except Exception as e:
-                logger.error('HAGW Server: Cannot start Pixie Adjacent Callback Server: %s', e)
+                logger.error('HAGW Server: Cannot start Multiplex Server: %s', e)
                 self.cleanup()
                 return False
-            # wait for Pixie Adjacent Callback server to come up    
-            time.sleep(0.5)
-        else:
-            logger.info('HAGW Server: Pixie Adjacent Server not enabled')
         
-        # Thingcontrol Server Startup
-        if settings.TC_SERVER_ENABLE == True:
-            # start the Thingcontrol Server
+        # Callback Servers Startup
+        # The enabled callback servers are started concurrently. Each one
+        # binds its listener, starts serving and registers its services
+        # with RVI, then signals that it is ready.
+        started = {}
+        aborted = threading.Event()
+        starters = []
+        for key, name, enabled, url, service_id, factory in self.components():
+            if not self.runs(key):
+                continue
+            if not enabled:
+                logger.info('HAGW Server: %s not enabled', name)
+                continue
+            logger.info('HAGW Server: Starting %s on %s with service id %s.', name, url, service_id)
+            starter = threading.Thread(target=self.start_server,
+                                       args=(key, name, factory, started, aborted))
+            starter.start()
+            starters.append((key, name, starter))
+
+        deadline = time.time() + settings.SERVER_STARTUP_TIMEOUT
+        for key, name, starter in starters:
+            starter.join(max(deadline - time.time(), 0))
+        failed = [name for key, name, starter in starters
+                  if key not in started or not started[key].ready.is_set()]
+        with self.startup_lock:
+            aborted.set()
+            self.servers.update(started)
+        if failed:
+            logger.error('HAGW Server: Startup failed for: %s', ', '.join(failed))
+            self.cleanup()
+            return False
+
+        logger.info('HAGW Server: Started in %.3f s.', time.time() - startup_begin)
+        return True
+
+    def create_send_queue(self):
+        """
+        Return a new RVI send queue, or None if it is not enabled.
+        """
+        if settings.RVI_SEND_QUEUE_ENABLE != True:
+            return None
+        return rviclient.RVISendQueue(self.rvi_service_edge, logger,
+                                      size=settings.RVI_SEND_QUEUE_SIZE,
+                                      policy=settings.RVI_SEND_QUEUE_POLICY,
+                                      workers=settings.RVI_SEND_QUEUE_WORKERS,
+                                      backoff=settings.RVI_SEND_RETRY_BACKOFF,
+                                      max_backoff=settings.RVI_SEND_RETRY_MAX_BACKOFF)
+
+    def start_metrics_server(self):
+        """
+        Serve the metrics via HTTP if enabled.
+        """
+        if settings.METRICS_HTTP_ENABLE != True:
+            return
+        url = settings.METRICS_HTTP_URL
+        if self.worker is not None:
+            # every worker has metrics of its own
+            parsed = urlparse(url)
+            url = 'http://%s:%d' % (parsed.hostname, parsed.port + self.worker)
+        try:
+            logger.info('HAGW Server: Serving metrics on %s.', url)
+            self.metrics_server = metrics.MetricsHTTPServer(url)
+            self.metrics_server.start()
+        except Exception as e:
+            # metrics are not essential, keep going without them
+            logger.error('HAGW Server: Cannot serve metrics: %s', e)
+
+    def components(self):
+        """
+        Return the callback servers as tuples (key, name, enabled, callback
+        URL, service id, class).
+        """
+        return [
+            ('core', 'Core Server', True,
+             settings.CORE_SERVER_CALLBACK_URL, settings.CORE_SERVER_SERVICE_ID,
+             coreserver.CoreCallbackServer),
+            ('pixie', 'Pixie Adjacent Callback Server', settings.PIXIE_SERVER_ENABLE == True,
+             settings.PIXIE_SERVER_CALLBACK_URL, settings.PIXIE_SERVER_SERVICE_ID,
+             pixieserver.PixieCallbackServer),
+            ('thingcontrol', 'Thingcontrol Callback Server', settings.TC_SERVER_ENABLE == True,
+             settings.TC_SERVER_CALLBACK_URL, settings.TC_SERVER_SERVICE_ID,
+             thingcontrolserver.ThingcontrolCallbackServer),
+            ('usermessage', 'Usermessage Callback Server', settings.UM_SERVER_ENABLE == True,
+             settings.UM_SERVER_CALLBACK_URL, settings.UM_SERVER_SERVICE_ID,
+             umsgserver.UsermessageCallbackServer),
+            ('vehicle', 'Vehicle Callback Server', settings.VH_SERVER_ENABLE == True,
+             settings.VH_SERVER_CALLBACK_URL, settings.VH_SERVER_SERVICE_ID,
+             vehicleserver.VehicleCallbackServer),
+        ]
+
+    def runs(self, key):
+        """
+        Return True if this process runs the callback server.
+        """
+        return self.only is None or key in self.only
+
+    def start_server(self, key, name, factory, started, aborted):
+        """
+        Create a callback server, start it and register its services.
+        Runs in its own thread during startup.
+        :param: key: key of the server in the servers table
+        :param: name: name of the server for logging
+        :param: factory: callback server class
+        :param: started: table to add the server to once it is ready
+        :param: aborted: set if startup gave up waiting for the server
+        """
+        server = None
+        try:
+            begin = time.time()
+            server = factory(logger, self.rvi_service_edge, self.mux_server)
+            bound = time.time()
+            registration = server.activate()
+        except Exception as e:
+            logger.error('HAGW Server: Cannot start %s: %s', name, e)
+            if server is not None:
+                server.shutdown()
+            return
+        with self.startup_lock:
+            if aborted.is_set():
+                # startup gave up on this server, nobody else will shut it down
+                server.shutdown()
+                return
+            started[key] = server
+        logger.info('HAGW Server: %s started: listen %.3f s, register %.3f s, total %.3f s.',
+                    name, bound - begin, registration, time.time() - begin)
+
+    def restart_server(self, key, register=False):
+        """
+        Shut a callback server down and start it again on the same address.
+        Its services stay registered with RVI and are not registered again.
+        Restarting the multiplexer moves the servers it hosts to the new one.
+        :param: key: key of the server in the servers table
+        :param: register: register the services again, e.g. if the address
+                          or the service id of the server has changed
+        """
+        old = self.servers[key]
+        if not supervisor.stopServer(old, settings.SUPERVISOR_SHUTDOWN_TIMEOUT):
+            logger.warning('HAGW Server: %s did not shut down in time, listener closed', key)
+        if key == 'mux':
+            server = muxserver.MultiplexCallbackServer(logger, self.rvi_service_edge)
+            server.start()
+            for hosted in self.servers.values():
+                if hosted.mux is old:
+                    hosted.mux = server
+                    server.attach(hosted)
+            self.mux_server = server
+        else:
+            factory = dict((c[0], c[5]) for c in self.components())[key]
+            server = factory(logger, self.rvi_service_edge, self.mux_server)
             try:
-                logger.info('HAGW Server: Starting Thingcontrol Callback Server on %s with service id %s.', settings.TC_SERVER_CALLBACK_URL, settings.TC_SERVER_SERVICE_ID)
-                server = thingcontrolserver.ThingcontrolCallbackServer(logger, self.rvi_service_edge)
-                server.start()
-                self.servers['thingcontrol'] = server
-                logger.info('HAGW Server: Thingcontrol Callback Server started.')
-            except Exception as e:
-                logger.error('HAGW Server: Cannot start Thingcontrol Callback Server: %s', e)
-                self.cleanup()
-                return False
-            # wait for Thingcontrol Callback server to come up    
-            time.sleep(0.5)
+                server.activate(register=register)
+            except Exception:
+                server.shutdown()
+                raise
+        self.servers[key] = server
+
+    def request_reload(self, *args):
+        """
+        Signal handler, the main loop reloads the settings.
+        """
+        self.reload_requested = True
+
+    def read_settings(self):
+        """
+        Read the settings again. Returns the names of the changed settings,
+        or None if the settings could not be read and the current ones are
+        kept.
+        """
+        logger.info('HAGW Server: Reloading settings...')
+        old = settingsSnapshot()
+        try:
+            reload(settings)
+        except Exception as e:
+            for name, value in old.iteritems():
+                setattr(settings, name, value)
+            logger.error('HAGW Server: Cannot reload settings, keeping the current ones: %s', e)
+            return None
+        new = settingsSnapshot()
+        changed = set(name for name, value in new.iteritems() if name not in old or old[name] != value)
+        if changed:
+            logger.info('HAGW Server: Changed settings: %s', ', '.join(sorted(changed)))
         else:
-            logger.info('HAGW Server: Thingcontrol Server not enabled')
+            logger.info('HAGW Server: Settings unchanged.')
+        return changed
+
+    def reload_settings(self):
+        """
+        Read the settings again and apply the changes, touching only what
+        they affect: the RVI client is pointed at the new service edge in
+        place, callback servers apply their changes in place where they can
+        and are restarted on their own otherwise, and services are only
+        registered again if RVI or their address changed.
+        Returns False if the settings could not be read.
+        """
+        changed = self.read_settings()
+        if changed is None:
+            return False
+        if not changed:
+            return True
+        if not self.servers:
+            # not running, the next startup uses the new settings
+            return True
+        if any(name.startswith('MUX_SERVER_') for name in changed):
+            # the network address of all services changes
+            logger.info('HAGW Server: Multiplex Server changed, restarting all servers.')
+            self.cleanup()
+            return self.startup()
+        pending = set(name for name in changed if not name.startswith(LIVE_SETTINGS))
+
+        # outbound connections
+        edge = set(name for name in pending if name.startswith('RVI_SERVICE_EDGE_'))
+        if edge:
+            logger.info('HAGW Server: RVI Service Edge now %s', settings.RVI_SERVICE_EDGE_URL)
+            self.rvi_service_edge.retarget(settings.RVI_SERVICE_EDGE_URL,
+                                           pool_size=settings.RVI_SERVICE_EDGE_POOL_SIZE,
+                                           connect_timeout=settings.RVI_SERVICE_EDGE_CONNECT_TIMEOUT,
+                                           read_timeout=settings.RVI_SERVICE_EDGE_READ_TIMEOUT)
+        queue = set(name for name in pending if name.startswith(('RVI_SEND_QUEUE_', 'RVI_SEND_RETRY_')))
+        if queue:
+            dropped = self.rvi_service_edge.replace_send_queue(self.create_send_queue())
+            if dropped:
+                logger.warning('HAGW Server: RVI send queue replaced, %d messages dropped', dropped)
+        pending -= edge | queue
 
-        # Usermessage Server Startup
-        if settings.UM_SERVER_ENABLE == True:
-            # start the Usermessage Server
+        # process wide
+        if 'LOGGING_CONFIG' in pending:
+            logging.config.dictConfig(settings.LOGGING_CONFIG)
+            pending -= set(name for name in pending if name.startswith('LOG'))
+        if 'TRACE_HISTORY' in pending:
+            tracing.setHistory(settings.TRACE_HISTORY)
+            pending.discard('TRACE_HISTORY')
+        metrics_http = set(name for name in pending if name.startswith('METRICS_HTTP_'))
+        if metrics_http:
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+                self.metrics_server = None
+            self.start_metrics_server()
+            pending -= metrics_http
+        rpc = set(name for name in pending if name.startswith('RPC_SERVER_'))
+        pending -= rpc
+        if rpc and 'mux' in self.servers:
+            self.restart_server('mux')
+
+        # callback servers
+        for key, name, enabled, url, service_id, factory in self.components():
+            prefix = SERVER_SETTINGS[key][0]
+            owned = set(setting for setting in pending if setting.startswith(SERVER_SETTINGS[key]))
+            pending -= owned
+            if not self.runs(key):
+                # another worker process runs it
+                continue
+            server = self.servers.get(key)
             try:
-                logger.info('HAGW Server: Starting Usermessage Callback Server on %s with service id %s.', settings.UM_SERVER_CALLBACK_URL, settings.UM_SERVER_SERVICE_ID)
-                server = umsgserver.UsermessageCallbackServer(logger, self.rvi_service_edge)
-                server.start()
-                self.servers['usermessage'] = server
-                logger.info('HAGW Server: Usermessage Callback Server started.')
+                if server is None:
+                    if enabled:
+                        logger.info('HAGW Server: Starting %s.', name)
+                        started = {}
+                        self.start_server(key, name, factory, started, threading.Event())
+                        self.servers.update(started)
+                elif not enabled:
+                    # RVI offers no way to unregister the services
+                    logger.info('HAGW Server: Stopping %s.', name)
+                    supervisor.stopServer(server, settings.SUPERVISOR_SHUTDOWN_TIMEOUT)
+                    del self.servers[key]
+                elif owned & set([prefix + 'CALLBACK_URL', prefix + 'SERVICE_ID']):
+                    logger.info('HAGW Server: Restarting %s on %s with service id %s.', name, url, service_id)
+                    self.restart_server(key, register=True)
+                elif owned or (rpc and server.mux is None):
+                    unapplied = server.reconfigure(owned)
+                    if unapplied or (rpc and server.mux is None):
+                        logger.info('HAGW Server: Restarting %s for: %s', name, ', '.join(sorted(unapplied | rpc)))
+                        self.restart_server(key)
             except Exception as e:
-                logger.error('HAGW Server: Cannot start Usermessage Callback Server: %s', e)
-                self.cleanup()
-                return False
-            # wait for Usermessge Callback server to come up    
-            time.sleep(0.5)
-        else:
-            logger.info('HAGW Server: Usermessage Server not enabled')
+                # the supervisor retries a server that is left stopped
+                logger.error('HAGW Server: Cannot apply the settings to %s: %s', name, e)
 
-        # Vehicle Server Startup
-        if settings.VH_SERVER_ENABLE == True:
-            # start the Vehicle Server
+        if 'RVI_SERVICE_EDGE_URL' in edge:
             try:
-                logger.info('HAGW Server: Starting Vehicle Callback Server on %s with service id %s.', settings.VH_SERVER_CALLBACK_URL, settings.VH_SERVER_SERVICE_ID)
-                server = vehicleserver.VehicleCallbackServer(logger, self.rvi_service_edge)
-                server.start()
-                self.servers['vehicle'] = server
-                logger.info('HAGW Server: Vehicle Callback Server started.')
+                self.register_services()
             except Exception as e:
-                logger.error('HAGW Server: Cannot start Vehicle Callback Server: %s', e)
-                self.cleanup()
-                return False
-            # wait for Vehicle Callback server to come up    
-            time.sleep(0.5)
-        else:
-            logger.info('HAGW Server: Vehicle Server not enabled')
-
+                logger.error('HAGW Server: Cannot register services with the new RVI Service Edge: %s', e)
+        if pending:
+            logger.warning('HAGW Server: Restart the HAGW to apply: %s', ', '.join(sorted(pending)))
+        logger.info('HAGW Server: Settings reloaded.')
         return True
 
+    def register_services(self):
+        """
+        Register the services of all callback servers with RVI again,
+        concurrently.
+        """
+        errors = []
+        def register(server):
+            try:
+                server.register_services()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=register, args=(server,)) for server in self.servers.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def run(self):
         """
         Main execution loop
         """
+        if settings.PROCESS_MODE == 'processes':
+            self.run_workers()
+        else:
+            self.serve()
+
+    def serve(self):
+        """
+        Run the callback servers in this process and supervise them.
+        """
         # catch signals for proper shutdown
         for sig in (SIGABRT, SIGTERM, SIGINT):
             signal(sig, self.shutdown)
+        signal(SIGHUP, self.request_reload)
         # start servers
-        self.startup()
+        self.supervisor = supervisor.Supervisor(self, logger)
+        backoff = supervisor.Backoff(settings.SUPERVISOR_BACKOFF, settings.SUPERVISOR_MAX_BACKOFF)
+        started = self.startup()
+        if not started:
+            logger.warning('HAGW Server: startup failed, next attempt in %.1f s.', backoff.failed(time.time()))
         # main loop
         logger.debug('HAGW Server: Entering Main Loop')
         while True:
             try:
                 time.sleep(settings.MAIN_LOOP_INTERVAL)
-                if self.ping() == False:
-                    # cannot ping myself via RVI -> restart
-                    logger.warning('HAGW Server: ping failed -> restarting')
+                if self.parent is not None and os.getppid() != self.parent:
+                    # the daemon is gone, nobody would restart this worker
+                    logger.error('HAGW Server: Daemon exited, stopping worker %d.', self.worker)
                     self.cleanup()
-                    if not self.startup():
-                        logger.warning('HAGW Server: startup failed.')
-                        continue
+                    break
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload_settings()
+                    # a failed restart of all servers is retried like a failed startup
+                    started = started and bool(self.servers)
+                if started:
+                    # check the servers, restart only the failed ones
+                    self.supervisor.check()
+                elif backoff.due(time.time()):
+                    started = self.startup()
+                    if not started:
+                        logger.warning('HAGW Server: startup failed, next attempt in %.1f s.',
+                                       backoff.failed(time.time()))
                 #logger.debug('HAGW Server: Thingcontrol Status: %s', thingcontrolserver.setIVIHVAC())
             except KeyboardInterrupt:
                 print ('\n')
                 break
                 
+    def worker_units(self):
+        """
+        Return the worker processes to run in 'processes' mode as tuples
+        (name, slot, keys of the servers, None for all): one per enabled
+        callback server, or one for all of them on the Multiplex Server,
+        times PROCESS_WORKERS.
+        """
+        if settings.MUX_SERVER_ENABLE == True:
+            units = [('mux', None)]
+        else:
+            units = [(key, set([key])) for key, name, enabled, url, service_id, factory
+                     in self.components() if enabled]
+        return [(name, slot, keys) for name, keys in units
+                for slot in range(max(settings.PROCESS_WORKERS.get(name, 1), 1))]
+
+    def run_workers(self):
+        """
+        Fork the worker processes and restart them when they exit. SIGHUP
+        and SIGTERM are passed on to the workers.
+        """
+        for sig in (SIGABRT, SIGTERM, SIGINT):
+            signal(sig, self.shutdown_workers)
+        signal(SIGHUP, self.request_reload)
+        logger.info('HAGW Server: Running the callback servers in worker processes.')
+        while True:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload_workers()
+            self.reap_workers()
+            self.spawn_workers()
+            time.sleep(settings.MAIN_LOOP_INTERVAL)
+
+    def spawn_workers(self):
+        """
+        Start the workers that are not running and not backing off.
+        """
+        running = set((name, slot) for name, slot, begin in self.workers.values())
+        now = time.time()
+        for number, (name, slot, keys) in enumerate(self.worker_units(), 1):
+            backoff = self.worker_backoff(name, slot)
+            if (name, slot) in running or not backoff.due(now):
+                continue
+            try:
+                pid = os.fork()
+            except OSError as e:
+                logger.error('HAGW Server: Cannot start worker %s/%d: %s, next attempt in %.1f s.',
+                             name, slot, e, backoff.failed(now))
+                continue
+            if pid == 0:
+                self.run_worker(name, keys, number)
+            self.workers[pid] = (name, slot, now)
+            logger.info('HAGW Server: Started worker %s/%d, pid %d.', name, slot, pid)
+
+    def run_worker(self, name, keys, number):
+        """
+        Run the callback servers of a worker in the forked process. Never
+        returns, the process exits without running the exit handlers of the
+        daemon, e.g. the one removing the pidfile.
+        """
+        hagwlogging.afterFork()
+        code = 1
+        try:
+            self.only = keys
+            self.worker = number
+            self.parent = os.getppid()
+            self.workers = {}
+            self.serve()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except Exception:
+            logger.exception('HAGW Server: Worker %s failed', name)
+        finally:
+            os._exit(code)
+
+    def worker_backoff(self, name, slot):
+        backoff = self.worker_backoffs.get((name, slot))
+        if backoff is None:
+            backoff = self.worker_backoffs[(name, slot)] = supervisor.Backoff(settings.SUPERVISOR_BACKOFF,
+                                                                              settings.SUPERVISOR_MAX_BACKOFF)
+        return backoff
+
+    def reap_workers(self):
+        """
+        Collect the exited workers and schedule their restart.
+        """
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            if pid not in self.workers:
+                continue
+            name, slot, begin = self.workers.pop(pid)
+            if pid in self.stopping:
+                self.stopping.discard(pid)
+                logger.info('HAGW Server: Worker %s/%d stopped.', name, slot)
+                continue
+            now = time.time()
+            backoff = self.worker_backoff(name, slot)
+            if now - begin > settings.SUPERVISOR_MAX_BACKOFF:
+                # it ran for a while, this is no crash loop
+                backoff.reset()
+            if os.WIFSIGNALED(status):
+                cause = 'signal %d' % os.WTERMSIG(status)
+            else:
+                cause = 'status %d' % os.WEXITSTATUS(status)
+            logger.error('HAGW Server: Worker %s/%d, pid %d, exited with %s, restarting in %.1f s.',
+                         name, slot, pid, cause, backoff.failed(now))
+
+    def reload_workers(self):
+        """
+        Read the settings again, stop the workers no longer needed and ask
+        the others to reload theirs. New workers are started by the main loop.
+        """
+        changed = self.read_settings()
+        if not changed:
+            # the workers would fail to read them as well
+            return
+        if 'LOGGING_CONFIG' in changed:
+            logging.config.dictConfig(settings.LOGGING_CONFIG)
+        if 'PROCESS_MODE' in changed:
+            logger.warning('HAGW Server: Restart the HAGW to apply: PROCESS_MODE')
+        wanted = set((name, slot) for name, slot, keys in self.worker_units())
+        for pid, (name, slot, begin) in self.workers.items():
+            try:
+                if (name, slot) in wanted:
+                    os.kill(pid, SIGHUP)
+                else:
+                    logger.info('HAGW Server: Stopping worker %s/%d.', name, slot)
+                    self.stopping.add(pid)
+                    os.kill(pid, SIGTERM)
+            except OSError:
+                # exited already, reaped by the main loop
+                pass
+
+    def shutdown_workers(self, *args):
+        """
+        Stop the workers and exit. Workers still running after
+        SUPERVISOR_SHUTDOWN_TIMEOUT seconds are killed.
+        """
+        if self.shutting_down:
+            # the stop command repeats SIGTERM until the daemon is gone
+            return
+        self.shutting_down = True
+        logger.info('HAGW Server: Caught signal: %d. Stopping workers...', args[0])
+        for pid in self.workers:
+            try:
+                os.kill(pid, SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + settings.SUPERVISOR_SHUTDOWN_TIMEOUT
+        while self.workers:
+            for pid in list(self.workers):
+                try:
+                    if time.time() >= deadline:
+                        logger.warning('HAGW Server: Killing worker %s/%d.', *self.workers[pid][:2])
+                        os.kill(pid, SIGKILL)
+                        os.waitpid(pid, 0)
+                        del self.workers[pid]
+                    elif os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        del self.workers[pid]
+                except OSError:
+                    del self.workers[pid]
+            time.sleep(0.1)
+        sys.exit(0)
+
     def ping(self):
         """
         Ping myself via RVI
@@ -206,7 +688,7 @@ def usage():
     """
     Print usage message
     """
-    print "HAGW Server: Usage: %s foreground|start|stop|restart" % sys.argv[0]        
+    print "HAGW Server: Usage: %s foreground|start|stop|restart|reload" % sys.argv[0]        
     
 """
 Main Function
@@ -228,6 +710,8 @@ if __name__ == "__main__":
             hagw_server.stop()
         elif sys.argv[1] in ('restart', 're'):
             hagw_server.restart()
+        elif sys.argv[1] in ('reload', 'rl'):
+            hagw_server.reload()
         else:
             print "HAGW Server: Unknown command."
             usage()
@@ -0,0 +1,185 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Pool of persistent HTTP/1.1 connections to a server.
+"""
+
+import threading, socket, errno
+import time, httplib
+from urlparse import urlparse
+
+import metrics, tracing
+
+
+# errors of a connection the server has closed
+CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def closedByServer(e):
+    """
+    Return True if a request failed because the server had closed the
+    connection before answering: sending failed or the connection was
+    closed before the first byte of the response. Timeouts are not, the
+    server may be processing the request.
+    """
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        # Python 2.7 before 2.7.10 raises it with an empty line
+        return not e.line or e.line.startswith('No status line received')
+    if isinstance(e, socket.error):
+        return e.errno in CLOSED_ERRNOS
+    return False
+
+
+class HTTPConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP connections to one server.
+    Connections idle for longer than idle_timeout are closed instead of
+    being reused, at most size idle connections are kept. If the pool is
+    named its requests are recorded in the metrics under the name.
+    Requests carry the trace id of the calling thread, see tracing.py.
+    """
+
+    def __init__(self, url, size=4, idle_timeout=30, connect_timeout=2, read_timeout=10, name=None):
+        self.name = name
+        url = urlparse(url)
+        self.host = url.hostname
+        self.port = url.port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.retries = 0
+        self.errors = 0
+
+    def connect(self):
+        """
+        Open a new connection with the connect timeout and switch the
+        socket to the read timeout once connected.
+        """
+        con = httplib.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        con.connect()
+        con.sock.settimeout(self.read_timeout)
+        return con
+
+    def acquire(self):
+        """
+        Return an idle connection or a new one and whether it was reused.
+        """
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            while self.idle:
+                con, last_used = self.idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.hits += 1
+                    return con, True
+                self.evictions += 1
+                con.close()
+            self.misses += 1
+        return self.connect(), False
+
+    def release(self, con):
+        """
+        Return a connection to the pool.
+        """
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((con, time.time()))
+                return
+        con.close()
+
+    def request(self, method, path, body=None, headers={}):
+        """
+        Send a request and read the response.
+        Returns the tuple (status, reason, data).
+        :param: method: HTTP method
+        :param: path: request path
+        :param: body: request body
+        :param: headers: request headers
+        """
+        headers = tracing.headers(headers)
+        begin = time.time()
+        try:
+            con, reused = self.acquire()
+        except Exception:
+            self.failed(begin)
+            raise
+        try:
+            try:
+                con.request(method, path, body, headers)
+                res = con.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                # the server may have closed a reused connection while it
+                # was idle, try once more on a new one, but only if it
+                # cannot have seen the request: requests are not idempotent
+                con.close()
+                if not reused or not closedByServer(e):
+                    raise
+                with self.lock:
+                    self.retries += 1
+                con = self.connect()
+                con.request(method, path, body, headers)
+                res = con.getresponse()
+            data = res.read()
+        except Exception:
+            con.close()
+            self.failed(begin)
+            raise
+        if res.will_close:
+            con.close()
+        else:
+            self.release(con)
+        if self.name is not None:
+            seconds = time.time() - begin
+            metrics.observe(metrics.OUTBOUND, self.name, seconds, res.status >= 500)
+            tracing.record(self.name, seconds, res.status >= 500)
+        return res.status, res.reason, data
+
+    def failed(self, begin):
+        with self.lock:
+            self.errors += 1
+        if self.name is not None:
+            seconds = time.time() - begin
+            metrics.observe(metrics.OUTBOUND, self.name, seconds, True)
+            tracing.record(self.name, seconds, True)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for con, last_used in idle:
+            con.close()
+
+    def stats(self):
+        """
+        Return the pool statistics.
+        """
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / self.requests if self.requests else 0.0,
+                'evictions': self.evictions,
+                'retries': self.retries,
+                'errors': self.errors,
+                'idle': len(self.idle),
+            }
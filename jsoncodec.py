@@ -0,0 +1,55 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+JSON codec used for all JSON encoding and decoding of the HAGW. Uses the
+first backend of settings.JSON_CODEC_BACKENDS that is installed, falling
+back to the standard library. Output is compact, without whitespace.
+"""
+
+import json
+
+import settings
+
+BACKEND = None
+dumps = None
+loads = None
+
+
+def useBackend(name):
+    """
+    Switch to a JSON backend. Raises ImportError if it is not installed.
+    :param: name: 'ujson', 'simplejson' or 'json'
+    """
+    global BACKEND, dumps, loads
+    if name == 'ujson':
+        import ujson
+        dumps = lambda obj: ujson.dumps(obj, escape_forward_slashes=False)
+        loads = ujson.loads
+    elif name == 'simplejson':
+        import simplejson
+        encoder = simplejson.JSONEncoder(separators=(',', ':'))
+        dumps = encoder.encode
+        loads = simplejson.loads
+    elif name == 'json':
+        encoder = json.JSONEncoder(separators=(',', ':'))
+        dumps = encoder.encode
+        loads = json.loads
+    else:
+        raise ImportError('unknown JSON backend: %s' % name)
+    BACKEND = name
+
+
+for name in settings.JSON_CODEC_BACKENDS + ['json']:
+    try:
+        useBackend(name)
+        break
+    except ImportError:
+        pass
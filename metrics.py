@@ -0,0 +1,237 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Request counts, error counts and latency histograms of the inbound
+services and the outbound dependencies of the HAGW, and a local HTTP
+endpoint to scrape them.
+"""
+
+import threading, time, bisect
+import BaseHTTPServer, SocketServer
+from urlparse import urlparse
+
+import settings, jsoncodec, hagwlogging
+
+INBOUND = 'inbound'
+OUTBOUND = 'outbound'
+
+
+class Histogram(object):
+    """
+    Request and error count and latency histogram of one service or
+    dependency. Not thread-safe, every thread records into its own, see
+    Registry.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.requests = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, failed):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.requests += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if failed:
+            self.errors += 1
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bounds.
+        """
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.requests += other.requests
+        self.errors += other.errors
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'total': self.total,
+            'mean': self.total / self.requests if self.requests else 0.0,
+            'max': self.max,
+            'buckets': zip(self.bounds + [None], self.buckets),
+        }
+
+
+class Registry(object):
+    """
+    Histograms by kind, inbound or outbound, and name. Every thread
+    records into histograms of its own without locking, a snapshot merges
+    them. The histograms of finished threads are folded into one set.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        # guards shards and retired
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # (thread, histograms by kind and name) of the recording threads
+        self.shards = []
+        self.retired = {INBOUND: {}, OUTBOUND: {}}
+        self.started = time.time()
+
+    def shard(self):
+        """
+        Return the histograms of the calling thread.
+        """
+        histograms = {INBOUND: {}, OUTBOUND: {}}
+        with self.lock:
+            self.retire()
+            self.shards.append((threading.current_thread(), histograms))
+        self.local.histograms = histograms
+        return histograms
+
+    def retire(self):
+        """
+        Fold the histograms of finished threads into the retired ones.
+        Called with the lock held.
+        """
+        live = []
+        for thread, histograms in self.shards:
+            if thread.is_alive():
+                live.append((thread, histograms))
+            else:
+                self.add(self.retired, histograms)
+        self.shards = live
+
+    def add(self, total, histograms):
+        for kind, named in histograms.items():
+            for name, histogram in named.items():
+                merged = total[kind].get(name)
+                if merged is None:
+                    merged = total[kind][name] = Histogram(self.bounds)
+                merged.merge(histogram)
+
+    def observe(self, kind, name, seconds, failed=False):
+        """
+        Record a request.
+        :param: kind: INBOUND or OUTBOUND
+        :param: name: service or dependency name
+        :param: seconds: latency
+        :param: failed: True if the request failed
+        """
+        try:
+            histograms = self.local.histograms
+        except AttributeError:
+            histograms = self.shard()
+        histogram = histograms[kind].get(name)
+        if histogram is None:
+            histogram = histograms[kind][name] = Histogram(self.bounds)
+        histogram.observe(seconds, failed)
+
+    def snapshot(self):
+        """
+        Return all histograms as a dictionary.
+        """
+        total = {INBOUND: {}, OUTBOUND: {}}
+        with self.lock:
+            self.retire()
+            self.add(total, self.retired)
+            for thread, histograms in self.shards:
+                self.add(total, histograms)
+        snapshot = dict((kind, dict((name, histogram.snapshot()) for name, histogram in histograms.iteritems()))
+                        for kind, histograms in total.iteritems())
+        snapshot['uptime'] = time.time() - self.started
+        snapshot['logging'] = hagwlogging.stats()
+        return snapshot
+
+    def render(self):
+        """
+        Return all histograms in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for kind, label in ((INBOUND, 'service'), (OUTBOUND, 'dependency')):
+            prefix = 'hagw_' + kind
+            lines.append('# TYPE %s_requests_total counter' % prefix)
+            lines.append('# TYPE %s_errors_total counter' % prefix)
+            lines.append('# TYPE %s_latency_seconds histogram' % prefix)
+            for name, h in sorted(snapshot[kind].iteritems()):
+                tag = '%s="%s"' % (label, name.replace('\\', '\\\\').replace('"', '\\"'))
+                lines.append('%s_requests_total{%s} %d' % (prefix, tag, h['requests']))
+                lines.append('%s_errors_total{%s} %d' % (prefix, tag, h['errors']))
+                cumulative = 0
+                for bound, count in h['buckets']:
+                    cumulative += count
+                    le = '+Inf' if bound is None else repr(bound)
+                    lines.append('%s_latency_seconds_bucket{%s,le="%s"} %d' % (prefix, tag, le, cumulative))
+                lines.append('%s_latency_seconds_sum{%s} %r' % (prefix, tag, h['total']))
+                lines.append('%s_latency_seconds_count{%s} %d' % (prefix, tag, h['requests']))
+        for counter, name in (('dropped', 'hagw_log_records_dropped_total'),
+                              ('suppressed', 'hagw_log_payloads_suppressed_total')):
+            lines.append('# TYPE %s counter' % name)
+            for handler, entry in sorted(snapshot['logging'].iteritems()):
+                if counter in entry:
+                    lines.append('%s{handler="%s"} %d' % (name, handler, entry[counter]))
+        lines.append('hagw_uptime_seconds %r' % snapshot['uptime'])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(settings.METRICS_LATENCY_BUCKETS)
+
+
+def observe(kind, name, seconds, failed=False):
+    """
+    Record a request in the registry of the HAGW, see Registry.observe().
+    """
+    registry.observe(kind, name, seconds, failed)
+
+
+class MetricsHTTPServer(threading.Thread):
+    """
+    HTTP server thread answering GET /metrics with the metrics in the
+    Prometheus text format and GET /metrics.json with them as JSON.
+    """
+
+    def __init__(self, url):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        url = urlparse(url)
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.render(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = jsoncodec.dumps(registry.snapshot()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((url.hostname, url.port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
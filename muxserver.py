@@ -0,0 +1,64 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Multiplex Server. Hosts the services of all enabled callback servers on a
+single listener.
+"""
+
+from rvijsonrpc import RVICallbackServer, MultiplexJSONRPCServer
+
+import settings
+
+logger = None
+service_edge = None
+
+# Multiplex Callback Server
+class MultiplexCallbackServer(RVICallbackServer):
+    """
+    RPC server thread responding to callbacks from the RVI framework for
+    all callback servers attached to it
+    """
+
+    def __init__(self, _logger, _service_edge):
+        global logger
+        global service_edge
+        logger = _logger
+        service_edge = _service_edge
+        RVICallbackServer.__init__(self, settings.MUX_SERVER_CALLBACK_URL, None)
+        self.init_callback_server()
+
+    def init_callback_server(self):
+        # initialize RPC server, callback functions are routed to the
+        # attached callback servers
+        self.localServer = self.create_local_server(MultiplexJSONRPCServer)
+
+    def attach(self, server):
+        """
+        Host the services of a callback server.
+        :param: server: callback server
+        """
+        logger.info('Multiplex Server: attaching %s', server.service_id)
+        self.localServer.add_route(server.service_id, server.localServer)
+
+    def detach(self, server):
+        """
+        Stop hosting the services of a callback server.
+        :param: server: callback server
+        """
+        logger.info('Multiplex Server: detaching %s', server.service_id)
+        self.localServer.remove_route(server.service_id)
+
+    def attached(self, server):
+        """
+        Return True if the services of a callback server are hosted.
+        :param: server: callback server
+        """
+        return self.localServer.routes.get(server.service_id) is server.localServer
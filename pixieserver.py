@@ -13,52 +13,212 @@ Pixie Adjacent Server (PAS) services.
 """
 
 import os, threading, base64, socket
-import time, httplib, json, math
+import time, httplib, math, re
 from urlparse import urlparse
-from rvijsonrpc import RVIJSONRPCServer
+from rvijsonrpc import RVICallbackServer
+from trilateration import ReferenceGeometry
+from cache import LRUCache
+from hagwlogging import payload
 
-import settings
+import settings, jsoncodec, metrics, tracing
 
 logger = None
 service_edge = None
+poller = None
+snapshot = None
+tag_filters = None
+poller_lock = threading.Lock()
+subscriptions = {}
+subscriptions_lock = threading.Lock()
 
 # Pixie Callback Server
-class PixieCallbackServer(threading.Thread):
+class PixieCallbackServer(RVICallbackServer):
     """
     RPC server thread responding to Pixie callbacks from the RVI framework
     """
     
-    def __init__(self, _logger, _service_edge):
+    def __init__(self, _logger, _service_edge, _mux=None):
         global logger
         global service_edge
+        global tag_filters
         logger = _logger
         service_edge = _service_edge
-        threading.Thread.__init__(self)
+        tag_filters = LRUCache(settings.PIXIE_SERVER_TAG_FILTER_CACHE_SIZE)
+        RVICallbackServer.__init__(self, settings.PIXIE_SERVER_CALLBACK_URL, settings.PIXIE_SERVER_SERVICE_ID, _mux)
         self.init_callback_server()
-        self.register_services()
 
     def init_callback_server(self):
         # initialize RPC server and register callback functions
-        url = urlparse(settings.PIXIE_SERVER_CALLBACK_URL)
-        self.localServer =  RVIJSONRPCServer(addr=((url.hostname, url.port)), logRequests=False)
+        self.localServer = self.create_local_server()
         self.localServer.register_function(getRawItemLocations, settings.PIXIE_SERVER_SERVICE_ID + "/getrawitemlocations")
         self.localServer.register_function(getItemLocations, settings.PIXIE_SERVER_SERVICE_ID + "/getitemlocations")
+        self.localServer.register_function(subscribe, settings.PIXIE_SERVER_SERVICE_ID + "/subscribe")
+        self.localServer.register_function(unsubscribe, settings.PIXIE_SERVER_SERVICE_ID + "/unsubscribe")
         
     def register_services(self):
         # register services with RVI framework
-        result = service_edge.register_service(service = settings.PIXIE_SERVER_SERVICE_ID + '/getrawitemlocations',
-                                               network_address = settings.PIXIE_SERVER_CALLBACK_URL)
-        logger.info('PIXIE Service Registration: Get Raw Item Locations service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.PIXIE_SERVER_SERVICE_ID + '/getitemlocations',
-                                               network_address = settings.PIXIE_SERVER_CALLBACK_URL)
-        logger.info('PIXIE Service Registration: Get Item Locations service name: %s', result['service'])
+        services = [settings.PIXIE_SERVER_SERVICE_ID + '/' + name for name in
+                    ['getrawitemlocations', 'getitemlocations', 'subscribe', 'unsubscribe']]
+        for result in self.register_rvi_services(service_edge, services):
+            logger.info('PIXIE Service Registration: service name: %s', result['service'])
+
+    live_settings = ('PIXIE_SERVER_ADJACENT_URL', 'PIXIE_SERVER_REFERENCE_POINTS', 'PIXIE_SERVER_HOME_DIMENSIONS',
+                     'PIXIE_SERVER_SUBSCRIPTION_THRESHOLD', 'PIXIE_SERVER_SUBSCRIPTION_MIN_INTERVAL',
+                     'PIXIE_SERVER_SUBSCRIPTION_LEASE', 'PIXIE_SERVER_MAX_SUBSCRIPTIONS')
+
+    def start(self):
+        RVICallbackServer.start(self)
+        if settings.PIXIE_SERVER_POLL_ENABLE == True:
+            startPoller()
+
+    def reconfigure(self, changed):
+        # resize the tag filter cache and restart the poller in place
+        global tag_filters, poller
+        changed = set(changed)
+        handled = changed & set(['PIXIE_SERVER_TAG_FILTER_CACHE_SIZE', 'PIXIE_SERVER_POLL_ENABLE',
+                                 'PIXIE_SERVER_POLL_INTERVAL'])
+        if 'PIXIE_SERVER_TAG_FILTER_CACHE_SIZE' in handled:
+            tag_filters = LRUCache(settings.PIXIE_SERVER_TAG_FILTER_CACHE_SIZE)
+        if handled & set(['PIXIE_SERVER_POLL_ENABLE', 'PIXIE_SERVER_POLL_INTERVAL']):
+            with poller_lock:
+                if poller is not None:
+                    poller.stop()
+                    poller = None
+            with subscriptions_lock:
+                subscribed = len(subscriptions) > 0
+            if settings.PIXIE_SERVER_POLL_ENABLE == True or subscribed:
+                startPoller()
+        return RVICallbackServer.reconfigure(self, changed - handled)
 
-    def run(self):
-        self.localServer.serve_forever()
-        
     def shutdown(self):
-        self.localServer.shutdown()
-        self.localServer.server_close()
+        global poller
+        RVICallbackServer.shutdown(self)
+        with poller_lock:
+            if poller is not None:
+                poller.stop()
+                poller = None
+        with subscriptions_lock:
+            subscriptions.clear()
+
+
+# Pixie Status Poller
+class PixieStatusPoller(threading.Thread):
+    """
+    Thread refreshing the snapshot of the Pixie status and the tag locations
+    calculated from it at a fixed interval
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.polls = 0
+        self.errors = 0
+
+    def run(self):
+        global snapshot
+        logger.info('PIXIE Status Poller: polling every %s s', self.interval)
+        current = None
+        while not self.stopped.is_set():
+            self.polls += 1
+            try:
+                pstatus = fetchPixieStatus()
+                locations = calculatePixieLocations(pstatus) if pstatus is not None else None
+            except Exception as e:
+                logger.error('PIXIE Status Poller: poll failed: %s', e)
+                locations = None
+            if locations is None:
+                self.errors += 1
+                # answer from the Pixie Adjacent Server rather than from a stale snapshot
+                if snapshot is current:
+                    snapshot = None
+                current = None
+            else:
+                current = snapshot = PixieSnapshot(pstatus, locations)
+                try:
+                    publishLocations(locations)
+                except Exception as e:
+                    self.errors += 1
+                    logger.error('PIXIE Status Poller: cannot publish the locations: %s', e)
+            self.stopped.wait(self.interval)
+        # stopped while polling, do not leave a snapshot nobody refreshes
+        if snapshot is current:
+            snapshot = None
+
+    def stop(self):
+        global snapshot
+        self.stopped.set()
+        snapshot = None
+
+
+class PixieSnapshot(object):
+    """
+    Pixie status and tag locations at a point in time
+    """
+
+    def __init__(self, status, locations):
+        self.timestamp = time.time()
+        self.status = status
+        self.locations = locations
+
+    def age(self):
+        return time.time() - self.timestamp
+
+
+class PixieSubscription(object):
+    """
+    Subscriber to the tag locations. The first push contains all selected
+    tags, every further push only the tags whose status changed or that
+    moved by threshold or more since they were last pushed, and the tags
+    that disappeared. Pushes are at least interval seconds apart, changes
+    in between are pushed with the next one.
+    """
+
+    def __init__(self, sendto, tags, threshold, interval, lease):
+        self.sendto = sendto
+        self.match = getTagFilter(tags)
+        self.threshold = threshold
+        self.interval = interval
+        self.expires = time.time() + lease
+        self.last_push = 0
+        self.pushes = 0
+        self.sent = None
+
+    @staticmethod
+    def state(point):
+        coordinates = point.get('coordinates') or {}
+        return (point.get('status'), coordinates.get('x'), coordinates.get('y'))
+
+    def changed(self, old, new):
+        if old[0] != new[0] or (old[1] is None) != (new[1] is None):
+            return True
+        return new[1] is not None and math.hypot(new[1] - old[1], new[2] - old[2]) >= self.threshold
+
+    def delta(self, locations):
+        """
+        Return the message to push for new locations or None if nothing
+        changed.
+        :param: locations: tag locations, see calculatePixieLocations()
+        """
+        selected = filterPixiePoints(locations, self.match)
+        points = selected['pixiePoints']
+        if self.sent is None:
+            self.sent = dict((key, PixieSubscription.state(point)) for key, point in points.iteritems())
+            return selected
+        changes = {}
+        for key, point in points.iteritems():
+            new = PixieSubscription.state(point)
+            old = self.sent.get(key)
+            if old is None or self.changed(old, new):
+                changes[key] = point
+                self.sent[key] = new
+        removed = [key for key in self.sent if key not in points]
+        for key in removed:
+            del self.sent[key]
+        if not changes and not removed:
+            return None
+        return {u'username': locations['username'], u'pixiePoints': changes, u'removed': removed}
 
 
 # Callback functions
@@ -69,8 +229,16 @@ def getRawItemLocations(tags, sendto):
     :param: sendto: RVI service to send response to
     """
     logger.info('PIXIE Callback Server: getRawItemLocations: tags: %s, sento: %s.', tags, sendto)
+    if not validTags(tags):
+        return {u'status': 1, u'error': u'tags must be strings'}
+    match = getTagFilter(tags)
+    current = snapshot
+    if current is not None:
+        logger.info('PIXIE Callback Server: getRawItemLocations: snapshot age: %.3f s', current.age())
+        sendRVIMessage(sendto, filterPixiePoints(current.status, match))
+        return {u'status': 0, u'age': current.age()}
     pstatus = getPixieStatus()
-    sendRVIMessage(sendto, pstatus)
+    sendRVIMessage(sendto, filterPixiePoints(pstatus, match))
     return {u'status': 0}
 
 def getItemLocations(tags, sendto):
@@ -80,112 +248,288 @@ def getItemLocations(tags, sendto):
     :param: sendto: RVI service to send response to
     """
     logger.info('PIXIE Callback Server: getItemLocations: tags: %s, sento: %s.', tags, sendto)
-    ploc = getPixieLocations()
+    if not validTags(tags):
+        return {u'status': 1, u'error': u'tags must be strings'}
+    match = getTagFilter(tags)
+    current = snapshot
+    if current is not None:
+        logger.info('PIXIE Callback Server: getItemLocations: snapshot age: %.3f s', current.age())
+        sendRVIMessage(sendto, filterPixiePoints(current.locations, match))
+        return {u'status': 0, u'age': current.age()}
+    ploc = getPixieLocations(match)
     sendRVIMessage(sendto, ploc)
     return {u'status': 0}
 
+def subscribe(tags, sendto, threshold=None, interval=None, lease=None):
+    """
+    Subscribe to the locations of the items. The current locations are
+    sent to sendto first, then only the changes. Subscribing again with the
+    same sendto replaces the subscription and renews the lease.
+    :param: tags: list of tags (regular expressions ok)
+    :param: sendto: RVI service to send the locations to
+    :param: threshold: minimum move of a tag to push it, default PIXIE_SERVER_SUBSCRIPTION_THRESHOLD
+    :param: interval: minimum seconds between pushes, at least PIXIE_SERVER_SUBSCRIPTION_MIN_INTERVAL
+    :param: lease: seconds until the subscription expires, at most PIXIE_SERVER_SUBSCRIPTION_LEASE
+    """
+    logger.info('PIXIE Callback Server: subscribe: tags: %s, sendto: %s, threshold: %s, interval: %s, lease: %s.',
+                tags, sendto, threshold, interval, lease)
+    if not validTags(tags):
+        return {u'status': 1, u'error': u'tags must be strings'}
+    for name, value in (('threshold', threshold), ('interval', interval), ('lease', lease)):
+        if not validNumber(value):
+            return {u'status': 1, u'error': u'%s must be a non-negative number' % name}
+    if threshold is None:
+        threshold = settings.PIXIE_SERVER_SUBSCRIPTION_THRESHOLD
+    interval = max(interval or 0, settings.PIXIE_SERVER_SUBSCRIPTION_MIN_INTERVAL)
+    lease = min(lease or settings.PIXIE_SERVER_SUBSCRIPTION_LEASE, settings.PIXIE_SERVER_SUBSCRIPTION_LEASE)
+    subscription = PixieSubscription(sendto, tags, threshold, interval, lease)
+    with subscriptions_lock:
+        if sendto not in subscriptions and len(subscriptions) >= settings.PIXIE_SERVER_MAX_SUBSCRIPTIONS:
+            logger.warning('PIXIE Callback Server: subscribe: too many subscriptions, refusing %s', sendto)
+            return {u'status': 1}
+        subscriptions[sendto] = subscription
+    startPoller()
+    return {u'status': 0, u'interval': interval, u'lease': lease}
+
+def unsubscribe(sendto):
+    """
+    Cancel a subscription to the locations of the items.
+    :param: sendto: RVI service the locations are sent to
+    """
+    logger.info('PIXIE Callback Server: unsubscribe: sendto: %s.', sendto)
+    with subscriptions_lock:
+        if subscriptions.pop(sendto, None) is None:
+            return {u'status': 1}
+    stopIdlePoller()
+    return {u'status': 0}
+
     
 # private functions
+def startPoller():
+    """
+    Start the Pixie status poller unless it is running.
+    """
+    global poller
+    with poller_lock:
+        if poller is None:
+            poller = PixieStatusPoller(settings.PIXIE_SERVER_POLL_INTERVAL)
+            poller.start()
+
+
+def stopIdlePoller():
+    """
+    Stop the poller if it only ran for the subscriptions and there are none
+    left, requests are answered from the Pixie Adjacent Server again.
+    """
+    global poller
+    if settings.PIXIE_SERVER_POLL_ENABLE == True:
+        return
+    with poller_lock:
+        with subscriptions_lock:
+            if subscriptions or poller is None:
+                return
+        logger.info('PIXIE Callback Server: no subscriptions left, stopping the poller')
+        poller.stop()
+        poller = None
+
+
+def publishLocations(locations):
+    """
+    Push the changes of the tag locations to the subscribers that are due
+    and drop the expired subscriptions.
+    :param: locations: tag locations, see calculatePixieLocations()
+    """
+    now = time.time()
+    with subscriptions_lock:
+        for sendto in [sendto for sendto, s in subscriptions.iteritems() if s.expires <= now]:
+            logger.info('PIXIE Callback Server: subscription of %s expired', sendto)
+            del subscriptions[sendto]
+        idle = not subscriptions
+        due = [s for s in subscriptions.itervalues() if now - s.last_push >= s.interval]
+    if idle:
+        stopIdlePoller()
+    for subscription in due:
+        message = subscription.delta(locations)
+        if message is not None:
+            subscription.last_push = now
+            subscription.pushes += 1
+            sendRVIMessage(subscription.sendto, message)
+
+
+def validTags(tags):
+    """
+    Return True if tags is a tag or a list of tags, see getTagFilter().
+    """
+    if tags is None or isinstance(tags, basestring):
+        return True
+    return isinstance(tags, (list, tuple)) and all(isinstance(tag, basestring) for tag in tags)
+
+
+def validNumber(value):
+    """
+    Return True if value is None or a finite non-negative number.
+    """
+    if value is None:
+        return True
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        return False
+    return 0 <= value < float('inf')
+
+
+def getTagFilter(tags):
+    """
+    Return a function match(key, point) telling whether a Pixie point is
+    selected by a list of tags, or None if all points are selected. A
+    point is selected if a tag matches its id or its tag name entirely.
+    The compiled tags are cached by the list of tags.
+    :param: tags: list of tags (regular expressions ok), '*' selects all
+    """
+    if isinstance(tags, basestring):
+        tags = [tags]
+    if not tags or '*' in tags:
+        return None
+    return tag_filters.get(tuple(tags), lambda: compileTagFilter(tags))
+
+
+def compileTagFilter(tags):
+    patterns = []
+    for tag in tags:
+        try:
+            re.compile(tag)
+            patterns.append('(?:%s)' % tag)
+        except re.error as e:
+            logger.warning('PIXIE Callback Server: tag %s is not a regular expression: %s', tag, e)
+            patterns.append(re.escape(tag))
+    regex = re.compile('(?:%s)\Z' % '|'.join(patterns))
+    return lambda key, point: bool(regex.match(key) or regex.match(point.get('tagName') or ''))
+
+
+def filterPixiePoints(pstatus, match):
+    """
+    Return a Pixie status or locations with only the selected points.
+    :param: pstatus: Pixie status or locations
+    :param: match: tag filter, see getTagFilter()
+    """
+    if pstatus is None or match is None:
+        return pstatus
+    filtered = dict(pstatus)
+    filtered['pixiePoints'] = dict((key, point) for key, point in pstatus['pixiePoints'].iteritems()
+                                   if match(key, point))
+    return filtered
+
+
 def getPixieStatus():
+    """
+    Get the tag status information from the snapshot or, if there is none,
+    from the Pixie Adjacent Server.
+    """
+    current = snapshot
+    if current is not None:
+        return current.status
+    return fetchPixieStatus()
+
+
+def fetchPixieStatus():
     """
     Connect to the Pixie Adjacant Server and get the tag status information.
     """
+    begin = time.time()
     try:
         url = urlparse(settings.PIXIE_SERVER_ADJACENT_URL)
         con = httplib.HTTPConnection(url.hostname, url.port)
-        con.request('GET', '/getPixieStatus')
+        con.request('GET', '/getPixieStatus', headers=tracing.headers({}))
         res = con.getresponse()
-        data = json.loads(res.read())
+        data = jsoncodec.loads(res.read())
+        if not isinstance(data, dict) or not isinstance(data.get('pixiePoints'), dict):
+            raise ValueError('not a Pixie status: %s' % payload(data))
     except Exception as e:
         logger.error('PIXIE Callback Server: getPixieStatus: Exception: %s', e)
         data = None
+    seconds = time.time() - begin
+    metrics.observe(metrics.OUTBOUND, 'pixie', seconds, data is None)
+    tracing.record('pixie', seconds, data is None)
     return data
 
     
-def getPixieLocations():
+def getPixieLocations(match=None):
     """
-    Calibrate Pixie tag locations based on two reference points and return
+    Calibrate Pixie tag locations based on the reference points and return
     the coordinates.
+    :param: match: tag filter, see getTagFilter()
     """
+    current = snapshot
+    if current is not None:
+        return filterPixiePoints(current.locations, match)
     # get Pixie status
-    pstatus = getPixieStatus()
+    pstatus = fetchPixieStatus()
     if pstatus == None:
 		return None
-    # get refernece points from data
-    loc = {}
-    prefs = {}
+    return calculatePixieLocations(pstatus, match)
+
+
+def calculatePixieLocations(pstatus, match=None):
+    """
+    Calculate the coordinates of the Pixie tags in a Pixie status.
+    Tags not selected by the tag filter are skipped.
+    :param: pstatus: Pixie status
+    :param: match: tag filter, see getTagFilter()
+    """
+    # precompute the reference point geometry once, then locate all
+    # connected tags in one pass
+    loc = {'username': None}
     points = {}
+    refs = settings.PIXIE_SERVER_REFERENCE_POINTS
     try:
-        for i, p in enumerate(settings.PIXIE_SERVER_REFERENCE_POINTS):
-            pref = {}
-            pp = pstatus['pixiePoints'][p]
-            pref['ref'] = pp
-            pref['distn'] = 0
-            pref['distp'] = 0
-            if i < len(settings.PIXIE_SERVER_REFERENCE_POINTS) - 1:
-                pref['distn'] = pp['range'][settings.PIXIE_SERVER_REFERENCE_POINTS[i+1]]
-            if i > 0:
-                pref['distp'] = pp['range'][settings.PIXIE_SERVER_REFERENCE_POINTS[i-1]]
-            prefs[p] = pref
+        loc['username'] = pstatus.get('username')
+        geometry = ReferenceGeometry(refs, pstatus['pixiePoints'])
+        located = []
+        ranges = []
         for key, value in pstatus['pixiePoints'].iteritems():
-            if key not in settings.PIXIE_SERVER_REFERENCE_POINTS:
+            if key not in refs and (match is None or match(key, value)):
                 point = {}
                 point['status'] = value['status']
                 point['tagName'] = value['tagName']
                 point['tagColor'] = value['tagColor']
-                c = {}
+                point['coordinates'] = {}
                 if value['status'] == 'Connected':
-                    dr1 = value['range'][settings.PIXIE_SERVER_REFERENCE_POINTS[0]]
-                    dr2 = value['range'][settings.PIXIE_SERVER_REFERENCE_POINTS[1]]
-                    d = prefs[settings.PIXIE_SERVER_REFERENCE_POINTS[0]]['distn']
-                    c['x'], c['y'] = calculateCoordinates(dr1, dr2, d)
-                point['coordinates'] = c
+                    try:
+                        ranges.append([value['range'][r] for r in refs])
+                        located.append(point)
+                    except KeyError as e:
+                        logger.warning('PIXIE Callback Server: calculatePixieLocations: tag %s: no range to %s', key, e)
                 points[key] = point
+        for point, (x, y) in zip(located, geometry.locate(ranges)):
+            point['coordinates'] = {'x': x, 'y': y}
     except Exception as e:
         logger.error('PIXIE Callback Server: calibratePixieLocations: Exception: %s', e)
-    loc['username'] = pstatus['username']
     loc['pixiePoints'] = points
     loc['dimensions'] = settings.PIXIE_SERVER_HOME_DIMENSIONS
     return loc
     
     
-def calculateCoordinates(dr1, dr2, d):
-    """
-    Calculate the x and y coordinates of a point based on its distance
-    to two reference points.
-    :param dr1: distance of the point to reference point 1
-    :param dr2: distance of the point to reference point 2
-    :param d: distance between the two reference points
-    """
-    logger.debug('PIXIE Callback Server: calculateCoordinates: dr1: %d, dr2: %d, d: %d', dr1, dr2, d)
-    try:
-        x = ((dr1 * dr1) - (dr2 * dr2) + (d * d)) / (2 * d)
-        y =  math.sqrt((dr1 * dr1) - (x * x))
-        logger.debug('PIXIE Callback Server: calculateCoordinates: x: %f, y: %f', x, y)
-        return (int(round(x)), int(round(y)))
-    except Exception as e: raise
-
-
 def sendRVIMessage(sendto, message):
     """
     Send message to recipient via RVI.
     :param: sendto: recipient RVI service
-    :param: meessage: message as RVI parameter block
+    :param: message: message as RVI parameter block
     """
-    
-    logger.info('PIXIE Callback Server: sending message: %s to %s', message, sendto)
-    
-    # send message
-    try:
-        service_edge.message(service_name = sendto,
-                           timeout = int(time.time()) + settings.RVI_SEND_TIMEOUT,
-                           parameters = [message])
-    except Exception as e:
-        logger.error('PIXIE Callback Server: cannot send message: %s', e)
-        return False
-    
-    logger.info('PIXIE Callback Server: successfully sent message: to %s', sendto)
-
-    return True
+    return service_edge.send(sendto, message, logger, 'PIXIE Callback Server')
 
 
+def getStatistics():
+    """
+    Return the statistics of the Pixie Server.
+    """
+    stats = {}
+    current = snapshot
+    if current is not None:
+        stats['snapshot_age'] = current.age()
+    if poller is not None:
+        stats['polls'] = poller.polls
+        stats['poll_errors'] = poller.errors
+    if tag_filters is not None:
+        stats['tag_filters'] = tag_filters.stats()
+    with subscriptions_lock:
+        stats['subscriptions'] = len(subscriptions)
+        stats['pushes'] = sum(s.pushes for s in subscriptions.itervalues())
+    return stats
@@ -0,0 +1,274 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Profiling of the running daemon, started and stopped via the core server.
+
+A 'sampling' session samples the stacks of all threads periodically and
+costs little, a 'cprofile' session runs every RPC call under cProfile,
+which is exact but slows the calls down. At most one session runs at a
+time.
+"""
+
+import os, sys, threading, time
+import cProfile, pstats
+
+import settings
+
+# leaf frames of threads waiting for work rather than running
+IDLE = set([
+    ('threading.py', 'wait'),
+    ('SocketServer.py', '_eintr_retry'),
+    ('socket.py', 'accept'),
+])
+
+
+def codeKey(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def label(key):
+    return '%s:%d(%s)' % (os.path.basename(key[0]), key[1], key[2])
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stacks of all other threads every interval seconds and
+    counts them. Samples of threads waiting for work are only counted as
+    idle.
+    """
+
+    mode = 'sampling'
+
+    def __init__(self, interval=0.005, depth=64):
+        threading.Thread.__init__(self, name='SamplingProfiler')
+        self.daemon = True
+        self.interval = interval
+        self.depth = depth
+        self.stacks = {}
+        self.samples = 0
+        self.idle = 0
+        self.begin = time.time()
+        self.seconds = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE:
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    stack.append(codeKey(frame.f_code))
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def runcall(self, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.seconds = time.time() - self.begin
+
+    def stats(self, limit=20):
+        """
+        Return the functions with the most samples, by samples in the
+        function itself and by samples in the function or its callees.
+        """
+        own = {}
+        cumulative = {}
+        for stack, count in self.stacks.iteritems():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for key in set(stack):
+                cumulative[key] = cumulative.get(key, 0) + count
+        total = float(self.samples) or 1.0
+        def top(counts):
+            ranked = sorted(counts.iteritems(), key=lambda item: item[1], reverse=True)[:limit]
+            return [{'function': label(key), 'samples': count, 'percent': 100 * count / total}
+                    for key, count in ranked]
+        return {
+            'mode': self.mode,
+            'seconds': self.seconds,
+            'samples': self.samples,
+            'idle': self.idle,
+            'self': top(own),
+            'cumulative': top(cumulative),
+        }
+
+    def dump(self, path):
+        """
+        Write the stacks in the collapsed format of flamegraph.pl.
+        """
+        path += '.folded'
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write('%s %d\n' % (';'.join(label(key) for key in stack), count))
+        return path
+
+
+class CProfileSession(object):
+    """
+    Runs RPC calls under cProfile. cProfile only sees the thread it is
+    enabled on, so every thread gets a profiler of its own and they are
+    merged when the session stops.
+    """
+
+    mode = 'cprofile'
+
+    def __init__(self):
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.begin = time.time()
+        self.seconds = None
+        self.calls = 0
+        self.merged = None
+
+    def start(self):
+        pass
+
+    def runcall(self, function, *args, **kwargs):
+        ident = threading.current_thread().ident
+        with self.lock:
+            entry = self.profiles.get(ident)
+            if entry is None:
+                # reentrant, so a call can stop the session it runs in
+                entry = self.profiles[ident] = (cProfile.Profile(), threading.RLock())
+            self.calls += 1
+        profile, busy = entry
+        with busy:
+            return profile.runcall(function, *args, **kwargs)
+
+    def stop(self):
+        self.seconds = time.time() - self.begin
+        with self.lock:
+            entries = self.profiles.values()
+        for profile, busy in entries:
+            # wait for the calls in progress
+            with busy:
+                profile.create_stats()
+        if entries:
+            self.merged = pstats.Stats(entries[0][0])
+            for profile, busy in entries[1:]:
+                self.merged.add(profile)
+
+    def stats(self, limit=20):
+        """
+        Return the functions with the most time spent in the function
+        itself and in the function and its callees.
+        """
+        entries = self.merged.stats.items() if self.merged is not None else []
+        def top(index):
+            ranked = sorted(entries, key=lambda item: item[1][index], reverse=True)[:limit]
+            return [{'function': label(key), 'calls': nc, 'tottime': tt, 'cumtime': ct}
+                    for key, (cc, nc, tt, ct, callers) in ranked]
+        return {
+            'mode': self.mode,
+            'seconds': self.seconds,
+            'calls': self.calls,
+            'self': top(2),
+            'cumulative': top(3),
+        }
+
+    def dump(self, path):
+        """
+        Write the merged statistics in the pstats format.
+        """
+        path += '.pstats'
+        if self.merged is not None:
+            self.merged.dump_stats(path)
+        else:
+            open(path, 'w').close()
+        return path
+
+
+MODES = {
+    SamplingProfiler.mode: SamplingProfiler,
+    CProfileSession.mode: CProfileSession,
+}
+
+# running session, used by the RPC servers
+session = None
+# last stopped session
+last = None
+lock = threading.Lock()
+timer = None
+
+
+def start(mode='sampling', interval=None, duration=None):
+    """
+    Start a profiling session. Returns False if one is running already.
+    :param: mode: 'sampling' or 'cprofile'
+    :param: interval: sampling interval in seconds
+    :param: duration: seconds after which the session stops by itself,
+                      at most settings.PROFILE_MAX_DURATION
+    """
+    global session, timer
+    if mode not in MODES:
+        raise ValueError('unknown profiling mode: %s' % mode)
+    duration = min(duration or settings.PROFILE_MAX_DURATION, settings.PROFILE_MAX_DURATION)
+    with lock:
+        if session is not None:
+            return False
+        if mode == SamplingProfiler.mode:
+            new = SamplingProfiler(interval or settings.PROFILE_SAMPLING_INTERVAL)
+        else:
+            new = CProfileSession()
+        new.start()
+        session = new
+        timer = threading.Timer(duration, stop)
+        timer.daemon = True
+        timer.start()
+    return True
+
+
+def stop():
+    """
+    Stop the running session and keep it as the last one. Returns the
+    stopped session, or the last one if none was running.
+    """
+    global session, last, timer
+    with lock:
+        stopping, session = session, None
+        if timer is not None:
+            timer.cancel()
+            timer = None
+    if stopping is None:
+        return last
+    stopping.stop()
+    last = stopping
+    return last
+
+
+def runcall(function, *args, **kwargs):
+    """
+    Call a function under the running session, if it profiles calls.
+    """
+    current = session
+    if current is None:
+        return function(*args, **kwargs)
+    return current.runcall(function, *args, **kwargs)
+
+
+def dump(profile):
+    """
+    Write a stopped session to settings.PROFILE_DIR and return the path.
+    """
+    if not os.path.isdir(settings.PROFILE_DIR):
+        os.makedirs(settings.PROFILE_DIR)
+    name = 'hagw-%s-%s-%d' % (profile.mode, time.strftime('%Y%m%d-%H%M%S', time.localtime(profile.begin)), os.getpid())
+    return profile.dump(os.path.join(settings.PROFILE_DIR, name))
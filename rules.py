@@ -0,0 +1,161 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Edge triggered rules on vehicle status report channels.
+
+A rule is a dictionary:
+    'name':     rule name
+    'channel':  channel, e.g. 'trunk' or 'seats.frontleft'
+    'op':       one of ==, !=, <, <=, >, >=
+    'value':    value to compare with, numbers compare numerically
+    'action':   name of the action to run when the rule fires
+    'debounce': optional, seconds after firing during which the rule does
+                not fire again for the same vehicle
+All other keys are passed on to the action, e.g. the message to send.
+The specification passed to the action always has a name.
+"""
+
+import threading, time, operator
+from collections import OrderedDict
+
+
+class Rule(object):
+    """
+    Compiled rule.
+    """
+
+    OPERATORS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+    }
+
+    def __init__(self, id, spec):
+        self.id = id
+        self.name = spec.get('name', 'rule %d' % id)
+        self.spec = dict(spec, name=self.name)
+        self.channel = spec['channel']
+        self.op = spec.get('op', '==')
+        if self.op not in Rule.OPERATORS:
+            raise ValueError('rule %s: unknown operator: %s' % (self.name, self.op))
+        self.compare = Rule.OPERATORS[self.op]
+        self.value = spec['value']
+        self.numeric = isinstance(self.value, (int, long, float))
+        self.action = spec['action']
+        self.debounce = spec.get('debounce', 0)
+
+    def matches(self, value):
+        if self.numeric:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return False
+        return self.compare(value, self.value)
+
+
+class RuleEngine(object):
+    """
+    Rules indexed by channel, so a report only evaluates the rules of the
+    channels it contains. Equality rules on string values are further
+    indexed by value and found by a lookup, only the other rules of a
+    channel are evaluated one by one.
+
+    A rule fires when its condition becomes true for a vehicle, i.e. on
+    the transition from false to true, and not again while it stays true.
+    The state is kept per vehicle as the set of rules currently true and
+    the time each rule last fired, for at most max_vehicles vehicles. The
+    state of the vehicle that has not reported the longest is evicted,
+    its rules may fire again with its next report.
+    """
+
+    def __init__(self, rules, actions, logger, max_vehicles=100):
+        """
+        :param: rules: list of rule specifications
+        :param: actions: action functions by name, called with vin, rule spec and value
+        :param: logger: logger
+        :param: max_vehicles: maximum number of vehicles with state kept
+        """
+        self.actions = actions
+        self.logger = logger
+        self.rules = []
+        self.equal = {}
+        self.other = {}
+        for spec in rules:
+            rule = Rule(len(self.rules), spec)
+            if rule.action not in actions:
+                raise ValueError('rule %s: unknown action: %s' % (rule.name, rule.action))
+            self.rules.append(rule)
+            if rule.op == '==' and not rule.numeric:
+                self.equal.setdefault(rule.channel, {}).setdefault(rule.value, []).append(rule)
+            else:
+                self.other.setdefault(rule.channel, []).append(rule)
+        self.channels = set(self.equal) | set(self.other)
+        self.max_vehicles = max_vehicles
+        # (rules true by channel, firing times by rule id) by vin
+        self.vehicles = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'reports': 0, 'evaluated': 0, 'fired': 0, 'debounced': 0, 'errors': 0}
+
+    def evaluate(self, vin, samples, t=None):
+        """
+        Evaluate the rules of the channels of a report and run the actions
+        of the rules that fire. Returns the names of the rules that fired.
+        :param: vin: vehicle identification number
+        :param: samples: (channel, value) pairs, see telemetry.flattenReport()
+        :param: t: time of the report, defaults to now
+        """
+        if t is None:
+            t = time.time()
+        firing = []
+        with self.lock:
+            self.counters['reports'] += 1
+            state = self.vehicles.pop(vin, None)
+            if state is None:
+                state = ({}, {})
+                if len(self.vehicles) >= self.max_vehicles:
+                    self.vehicles.popitem(last=False)
+            self.vehicles[vin] = state
+            active, fired = state
+            for channel, value in samples:
+                if channel not in self.channels:
+                    continue
+                now = set()
+                if isinstance(value, basestring):
+                    now.update(self.equal.get(channel, {}).get(value, ()))
+                rules = self.other.get(channel, ())
+                now.update(rule for rule in rules if rule.matches(value))
+                self.counters['evaluated'] += len(rules) + len(now)
+                before = active.get(channel, set())
+                for rule in now - before:
+                    last = fired.get(rule.id)
+                    if last is not None and t - last < rule.debounce:
+                        self.counters['debounced'] += 1
+                        continue
+                    fired[rule.id] = t
+                    firing.append((rule, value))
+                active[channel] = now
+            self.counters['fired'] += len(firing)
+        for rule, value in firing:
+            self.logger.info('Rule Engine: rule %s fired for vin: %s, value: %s', rule.name, vin, value)
+            try:
+                self.actions[rule.action](vin, rule.spec, value)
+            except Exception as e:
+                with self.lock:
+                    self.counters['errors'] += 1
+                self.logger.error('Rule Engine: rule %s: action %s failed: %s', rule.name, rule.action, e)
+        return [rule.name for rule, value in firing]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, rules=len(self.rules), vehicles=len(self.vehicles))
@@ -0,0 +1,327 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Outbound client of the RVI Service Edge.
+"""
+
+import threading, itertools, time
+from collections import deque
+from urlparse import urlparse
+import jsonrpclib
+from jsonrpclib.jsonrpc import check_for_errors
+
+from httppool import HTTPConnectionPool
+import settings, jsoncodec, metrics, tracing
+from hagwlogging import payload
+
+
+class RVIServiceEdge(object):
+    """
+    RVI Service Edge client that can be shared by threads. Calls are sent
+    as JSON-RPC requests over a pool of keep-alive connections and their
+    latency is recorded per method. Service edge methods are called like
+    methods of a jsonrpclib proxy, e.g. edge.message(service_name=...).
+    """
+
+    class Method(object):
+        """
+        Bound service edge method.
+        """
+        def __init__(self, edge, name):
+            self.edge = edge
+            self.name = name
+
+        def __call__(self, *args, **kwargs):
+            if args and kwargs:
+                raise ValueError('cannot mix positional and keyword arguments')
+            return self.edge.call(self.name, kwargs or list(args))
+
+    def __init__(self, url, pool_size=4, connect_timeout=2, read_timeout=10):
+        self.url = url
+        self.path = urlparse(url).path or '/'
+        self.pool = HTTPConnectionPool(url, size=pool_size,
+                                       connect_timeout=connect_timeout,
+                                       read_timeout=read_timeout)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.send_queue = None
+        self.queue_lock = threading.Lock()
+
+    def retarget(self, url, pool_size=4, connect_timeout=2, read_timeout=10):
+        """
+        Send the following calls to another service edge or with other
+        pool settings. Calls in progress finish on the old connections.
+        """
+        old = self.pool
+        self.pool = HTTPConnectionPool(url, size=pool_size,
+                                       connect_timeout=connect_timeout,
+                                       read_timeout=read_timeout)
+        self.url = url
+        self.path = urlparse(url).path or '/'
+        old.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return RVIServiceEdge.Method(self, name)
+
+    def call(self, method, params):
+        """
+        Call a service edge method and return its result.
+        :param: method: method name
+        :param: params: parameters, list or dictionary
+        """
+        request = jsoncodec.dumps({'jsonrpc': '2.0', 'method': method,
+                                   'params': params, 'id': next(self.ids)})
+        headers = {'Content-Type': 'application/json-rpc', 'Accept': 'application/json-rpc'}
+        begin = time.time()
+        failed = True
+        try:
+            status, reason, data = self.pool.request('POST', self.path, request, headers)
+            if status != 200:
+                raise jsonrpclib.ProtocolError((self.url, status, reason))
+            result = check_for_errors(jsoncodec.loads(data))['result']
+            failed = False
+            return result
+        finally:
+            self.record(method, time.time() - begin, failed)
+
+    def post(self, service_name, timeout, parameters):
+        """
+        Send a message via RVI without waiting for the service edge. The
+        message is queued if there is a send queue, otherwise it is sent
+        right away. Returns False if the message was not queued or sent.
+        A message refused by a queue that was replaced meanwhile is
+        posted again to its successor.
+        :param: service_name: recipient RVI service
+        :param: timeout: time in seconds since the epoch the message expires
+        :param: parameters: RVI parameter block
+        """
+        while True:
+            queue = self.send_queue
+            if queue is None:
+                self.message(service_name = service_name, timeout = timeout, parameters = parameters)
+                return True
+            if queue.put(service_name, timeout, parameters):
+                return True
+            if self.send_queue is queue:
+                return False
+
+    def send(self, sendto, message, logger, sender):
+        """
+        Send a message to a recipient via RVI on behalf of a callback server,
+        expiring RVI_SEND_TIMEOUT seconds from now. Returns False if the
+        message was dropped or could not be sent, see post().
+        :param: sendto: recipient RVI service
+        :param: message: message as RVI parameter block
+        :param: logger: logger of the sender
+        :param: sender: name of the sender in the log, e.g. 'Core Server'
+        """
+        logger.info('%s: sending message: %s to %s', sender, payload(message), sendto)
+        try:
+            if not self.post(service_name = sendto,
+                             timeout = int(time.time()) + settings.RVI_SEND_TIMEOUT,
+                             parameters = [message]):
+                logger.error('%s: message to %s dropped', sender, sendto)
+                return False
+        except Exception as e:
+            logger.error('%s: cannot send message: %s', sender, e)
+            return False
+        return True
+
+    def replace_send_queue(self, queue):
+        """
+        Stop the current send queue and move its queued messages to queue.
+        Returns the number of messages that were dropped because queue is
+        None or refused them.
+        :param: queue: new send queue or None
+        """
+        with self.queue_lock:
+            old, self.send_queue = self.send_queue, queue
+            if old is None:
+                return 0
+            old.stop()
+            messages = old.drain()
+            if queue is None:
+                return len(messages)
+            return len([message for message in messages if not queue.put(*message)])
+
+    def record(self, method, seconds, failed):
+        metrics.observe(metrics.OUTBOUND, 'rvi/' + method, seconds, failed)
+        tracing.record('rvi/' + method, seconds, failed)
+        with self.lock:
+            entry = self.latency.get(method)
+            if entry is None:
+                entry = self.latency[method] = {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+            entry['calls'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            if failed:
+                entry['errors'] += 1
+
+    def stats(self):
+        """
+        Return per method call counts and latencies in seconds together
+        with the connection pool statistics.
+        """
+        with self.lock:
+            methods = {}
+            for method, entry in self.latency.iteritems():
+                methods[method] = dict(entry, mean=entry['total'] / entry['calls'])
+        stats = {'methods': methods, 'pool': self.pool.stats()}
+        if self.send_queue is not None:
+            stats['send_queue'] = self.send_queue.stats()
+        return stats
+
+    def close(self):
+        self.replace_send_queue(None)
+        self.pool.close()
+
+
+class RVISendQueue(object):
+    """
+    Bounded queue of outbound RVI messages drained by worker threads.
+    Failed sends are retried with exponential backoff until the message's
+    RVI timeout has passed, then the message expires. When the queue is
+    full the overflow policy decides what happens: 'drop-oldest' discards
+    the oldest queued message, 'drop-newest' refuses the new one and
+    'block' waits for space. Once the queue is stopped it refuses all
+    messages and wakes producers waiting for space.
+    """
+
+    POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+    def __init__(self, edge, logger, size=256, policy='drop-oldest', workers=1,
+                 backoff=0.5, max_backoff=4.0):
+        if policy not in RVISendQueue.POLICIES:
+            raise ValueError('unknown overflow policy: %s' % policy)
+        self.edge = edge
+        self.logger = logger
+        self.size = size
+        self.items = deque()
+        # guards items, wakes workers when a message is queued and
+        # producers when space is freed or the queue is stopped
+        self.cond = threading.Condition(threading.Lock())
+        self.policy = policy
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = {'queued': 0, 'sent': 0, 'retries': 0, 'dropped': 0, 'expired': 0, 'refused': 0}
+        self.workers = []
+        for i in range(0, workers):
+            worker = threading.Thread(target=self.run, name='RVISendQueue-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def put(self, service_name, timeout, parameters):
+        """
+        Queue a message. Returns False if the message was refused or the
+        queue has been stopped. The message is sent within the trace of
+        the caller.
+        """
+        item = (service_name, timeout, parameters, tracing.current())
+        dropped = None
+        with self.cond:
+            if self.policy == 'block':
+                while len(self.items) >= self.size and not self.stopped.is_set():
+                    self.cond.wait()
+            if self.stopped.is_set():
+                self.count('refused')
+                return False
+            if len(self.items) >= self.size:
+                if self.policy == 'drop-newest':
+                    dropped = item
+                else:
+                    dropped = self.items.popleft()
+            if dropped is not item:
+                self.items.append(item)
+                self.cond.notify_all()
+        if dropped is not None:
+            self.count('dropped')
+            self.logger.warning('RVI Send Queue: queue full, dropping message to %s', dropped[0])
+            if dropped is item:
+                return False
+        self.count('queued')
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.items and not self.stopped.is_set():
+                    self.cond.wait()
+                if self.stopped.is_set():
+                    return
+                item = self.items.popleft()
+                self.cond.notify_all()
+            self.send(*item)
+
+    def send(self, service_name, timeout, parameters, trace=None):
+        """
+        Send a message, retrying until it is sent or has expired.
+        """
+        previous = tracing.resume(trace)
+        try:
+            return self.retry(service_name, timeout, parameters)
+        finally:
+            tracing.resume(previous)
+
+    def retry(self, service_name, timeout, parameters):
+        backoff = self.backoff
+        while not self.stopped.is_set():
+            if time.time() >= timeout:
+                self.count('expired')
+                self.logger.error('RVI Send Queue: message to %s expired', service_name)
+                return False
+            try:
+                self.edge.message(service_name = service_name,
+                                  timeout = timeout,
+                                  parameters = parameters)
+                self.count('sent')
+                return True
+            except Exception as e:
+                self.logger.warning('RVI Send Queue: cannot send message to %s: %s', service_name, e)
+            self.count('retries')
+            self.stopped.wait(min(backoff, max(timeout - time.time(), 0)))
+            backoff = min(backoff * 2, self.max_backoff)
+        return False
+
+    def drain(self):
+        """
+        Remove and return the queued messages as (service_name, timeout,
+        parameters), e.g. to move them to another queue after stop().
+        """
+        with self.cond:
+            messages = [item[:3] for item in self.items]
+            self.items.clear()
+            self.cond.notify_all()
+        return messages
+
+    def stop(self):
+        """
+        Stop the workers and refuse further messages. Producers waiting
+        for space return False.
+        """
+        with self.cond:
+            self.stopped.set()
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            depth = len(self.items)
+        with self.lock:
+            return dict(self.counters, depth=depth)
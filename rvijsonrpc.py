@@ -12,40 +12,544 @@ Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
 JSON RPC to interact with RVI middleware framwork.
 """
 
+import sys, threading, Queue, time, inspect, traceback, socket, httplib
+from urlparse import urlparse
+from jsonrpclib import Fault
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer
 
+import settings, jsoncodec, metrics, tracing, profiler
+
+# Linux value, the socket module of Python 2 does not define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 class RVIJSONRPCServer(SimpleJSONRPCServer):
     """
     RVI RPC Server Class
+
+    With workers > 0 the server hands accepted requests to a bounded pool
+    of worker threads instead of handling them on the thread running
+    serve_forever(). Each service may then run at most service_limit
+    calls at a time (service_limits overrides this per service name).
+    Calls beyond the limit are answered with a busy fault right away
+    instead of waiting in a worker, so a service that stalls on its
+    backend only ties up its own share of the pool.
+
+    With reuse_port the listener is bound with SO_REUSEPORT, so worker
+    processes can listen on the same address and the kernel spreads the
+    connections over them.
     """
 
+    def __init__(self, addr, workers=0, queue_size=0, service_limit=0,
+                 service_limits=None, reuse_port=False, **kwargs):
+        # the listener is bound by the base class constructor
+        self.reuse_port = reuse_port
+        SimpleJSONRPCServer.__init__(self, addr, **kwargs)
+        self.workers = workers
+        self.service_limit = service_limit
+        self.service_limits = service_limits or {}
+        self.service_semaphores = {}
+        self.service_routes = {}
+        self.service_active = {}
+        self.service_rejected = {}
+        self.stats_lock = threading.Lock()
+        self.active = 0
+        self.handled = 0
+        self.queue_high = 0
+        self.queue = None
+        self.pool = []
+        self.closed = False
+        self.stopping = False
+        # since when the accepting thread is busy with a request
+        self.busy_since = None
+        if workers > 0:
+            self.queue = Queue.Queue(queue_size)
+            for i in range(0, workers):
+                worker = threading.Thread(target=self.process_request_worker,
+                                          name='RVIJSONRPCWorker-%d' % i)
+                worker.daemon = True
+                worker.start()
+                self.pool.append(worker)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        SimpleJSONRPCServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        """
+        Queue the request for the worker pool. Blocks the accepting thread
+        while the queue is full, which pushes back on the clients, until
+        the server is shut down; the request is dropped then.
+        """
+        self.busy_since = time.time()
+        try:
+            if self.queue is None:
+                return SimpleJSONRPCServer.process_request(self, request, client_address)
+            while True:
+                if self.stopping:
+                    self.shutdown_request(request)
+                    return
+                try:
+                    self.queue.put((request, client_address), True, 0.5)
+                    break
+                except Queue.Full:
+                    pass
+            with self.stats_lock:
+                self.queue_high = max(self.queue_high, self.queue.qsize())
+        finally:
+            self.busy_since = None
+
+    def stalled(self, timeout):
+        """
+        Return True if the accepting thread has been busy with one request,
+        handling it or waiting for room in the full queue, for more than
+        timeout seconds.
+        """
+        since = self.busy_since
+        return since is not None and time.time() - since > timeout
+
+    def process_request_worker(self):
+        """
+        Worker thread main loop.
+        """
+        while not self.closed:
+            item = self.queue.get()
+            if item is None:
+                # pass the stop on to the next idle worker
+                try:
+                    self.queue.put_nowait(None)
+                except Queue.Full:
+                    pass
+                break
+            request, client_address = item
+            with self.stats_lock:
+                self.active += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.stats_lock:
+                    self.active -= 1
+                    self.handled += 1
+
+    def shutdown(self):
+        # let an accepting thread blocked on the full queue return
+        self.stopping = True
+        SimpleJSONRPCServer.shutdown(self)
+
+    def server_close(self):
+        """
+        Close the listener and stop the worker pool without blocking:
+        requests not taken by a worker yet are dropped and busy workers
+        exit after their current request.
+        """
+        SimpleJSONRPCServer.server_close(self)
+        self.closed = True
+        if self.queue is None:
+            return
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        self.pool = []
+
+    def get_service_semaphore(self, service):
+        """
+        Return the semaphore limiting concurrent calls of a service or
+        None if the service is not limited.
+        """
+        semaphore = self.service_semaphores.get(service, False)
+        if semaphore is not False:
+            return semaphore
+        with self.stats_lock:
+            limit = self.service_limits.get(service, self.service_limit)
+            if self.workers == 0 or limit <= 0:
+                semaphore = None
+            else:
+                semaphore = threading.BoundedSemaphore(limit)
+            return self.service_semaphores.setdefault(service, semaphore)
+
+    def stats(self):
+        """
+        Return queue depth and concurrency accounting of the server.
+        """
+        with self.stats_lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queue.qsize() if self.queue is not None else 0,
+                'queue_high': self.queue_high,
+                'active': self.active,
+                'handled': self.handled,
+                'service_active': dict(self.service_active),
+                'service_rejected': dict(self.service_rejected),
+            }
+
+    def _marshaled_dispatch(self, data, dispatch_method=None):
+        """
+        Decode a request, dispatch it and encode the response with the
+        JSON codec. Batch requests are left to jsonrpclib.
+        """
+        try:
+            request = jsoncodec.loads(data)
+        except Exception as e:
+            return Fault(-32700, 'Request %s invalid. (%s)' % (data, e)).response()
+        if not isinstance(request, dict):
+            return SimpleJSONRPCServer._marshaled_dispatch(self, data, dispatch_method)
+        rpcid = request.get('id')
+        method = request.get('method')
+        params = request.get('params', [])
+        if not isinstance(method, basestring):
+            return Fault(-32600, 'Invalid request -- no method.').response(rpcid)
+        if not isinstance(params, (list, dict)):
+            return Fault(-32600, 'Invalid request -- params must be a list or dict.').response(rpcid)
+        # callers may pass their trace id as a member of the request
+        trace = tracing.begin(method, request.get('trace_id'))
+        try:
+            result = self._dispatch(method, params)
+        except:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            result = Fault(-32603, '%s:%s' % (exc_type, exc_value))
+        tracing.end(trace, isinstance(result, Fault))
+        if rpcid is None:
+            # notification
+            return None
+        if 'jsonrpc' in request:
+            response = {'jsonrpc': request['jsonrpc'], 'id': rpcid}
+        else:
+            response = {'id': rpcid, 'result': None, 'error': None}
+        if isinstance(result, Fault):
+            response['error'] = {'code': result.faultCode, 'message': result.faultString}
+        else:
+            response['result'] = result
+        try:
+            return jsoncodec.dumps(response)
+        except:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            return Fault(-32603, '%s:%s' % (exc_type, exc_value)).response(rpcid)
+
+    def register_function(self, function, name=None):
+        """
+        Register a function for a service and compile its route.
+        """
+        if name is None:
+            name = function.__name__
+        SimpleJSONRPCServer.register_function(self, function, name)
+        self.service_routes[name] = ServiceRoute(function, name)
+
+    def _call_service(self, service, params):
+        """
+        Look up and call the function registered for a service, under the
+        profiler if one is running, and record the call in the metrics.
+        """
+        route = self.service_routes.get(service)
+        if route is None:
+            return SimpleJSONRPCServer._dispatch(self, service, params)
+        tracing.rename(service)
+        begin = time.time()
+        if profiler.session is None:
+            result = self._call_route(route, params)
+        else:
+            result = profiler.runcall(self._call_route, route, params)
+        metrics.observe(metrics.INBOUND, service, time.time() - begin, isinstance(result, Fault))
+        return result
+
+    def _call_route(self, route, params):
+        try:
+            args, kwargs = route.bind(params)
+        except ValueError as e:
+            return Fault(-32602, 'Invalid parameters: %s' % e)
+        try:
+            if kwargs:
+                return route.function(*args, **kwargs)
+            return route.function(*args)
+        except:
+            err_lines = traceback.format_exc().splitlines()
+            trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
+            return Fault(-32603, 'Server error: %s' % trace_string)
+
+    def _dispatch_service(self, service, params):
+        """
+        Dispatch a call to a service, observing the service's concurrency
+        limit. A call over the limit fails with a busy fault.
+        """
+        semaphore = self.service_semaphores.get(service, False)
+        if semaphore is False:
+            semaphore = self.get_service_semaphore(service)
+        if semaphore is None:
+            return self._call_service(service, params)
+        if not semaphore.acquire(False):
+            with self.stats_lock:
+                self.service_rejected[service] = self.service_rejected.get(service, 0) + 1
+            return Fault(-32000, 'Service busy: %s' % service)
+        with self.stats_lock:
+            self.service_active[service] = self.service_active.get(service, 0) + 1
+        try:
+            return self._call_service(service, params)
+        finally:
+            with self.stats_lock:
+                self.service_active[service] -= 1
+            semaphore.release()
+
     def _dispatch(self, method, params):
         """
         Dispatch RVI 'message'.
         Check if method is 'message', if so dispatch on
         name 'service_name' instead.
         """
-        # print "dispatch:", params
         if method == 'message':
-            # print "Will dispatch message to: " + params['service_name']
+            # Convert the RVI 'parameters' list of single entry dictionaries,
+            # e.g. [{'vin': 1234}, {hello: 'world'}], to a regular dictionary:
+            # {'vin': 1234, hello: 'world'}
             dict_param = {}
-            # Extract the 'parameters' element from the top level JSON-RPC
-            # 'param'. 
-            # Convert 'parameters' from [{'vin': 1234}, {hello: 'world'}] to
-            # a regular dictionary: {'vin': 1234, hello: 'world'}
-
-            #print "Service:", params['service_name']
-            #print "Parameters:", params['parameters']
-            msg_params = params['parameters']
-            for i in range(0, len(msg_params)):
-                for j in range(0, len(msg_params[i].keys())):
-                    #print "params", msg_params[i].keys()[j], "=", msg_params[i].values()[j]
-                    dict_param[msg_params[i].keys()[j]] = msg_params[i].values()[j]
-
-            # print "Parameter dictionary: ", dict_param
-            # print 
-            # Ship the processed dispatch info upward.
-            return SimpleJSONRPCServer._dispatch(self, params['service_name'], dict_param)           
-        return SimpleJSONRPCServer._dispatch(self,message, params)
-        
+            for param in params['parameters']:
+                dict_param.update(param)
+            return self._dispatch_service(params['service_name'], dict_param)
+        return self._dispatch_service(method, params)
+
+
+class ServiceRoute(object):
+    """
+    Function registered for a service together with the argument binder
+    compiled from its signature.
+    """
+
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+        target = function
+        if not (inspect.isfunction(target) or inspect.ismethod(target)):
+            target = getattr(function, '__call__', function)
+        try:
+            spec = inspect.getargspec(target)
+        except TypeError:
+            # builtin or otherwise opaque callable, pass arguments through
+            self.params = None
+            return
+        params = spec.args
+        if inspect.ismethod(target) and target.__self__ is not None:
+            params = params[1:]
+        defaults = spec.defaults or ()
+        required = len(params) - len(defaults)
+        self.params = [(param, i < required, defaults[i - required] if i >= required else None)
+                       for i, param in enumerate(params)]
+        self.order = tuple(params)
+        self.names = frozenset(params)
+        self.varargs = spec.varargs is not None
+        self.varkw = spec.keywords is not None
+
+    def bind(self, params):
+        """
+        Return the positional and keyword arguments for a call with params.
+        Raises ValueError if params do not match the signature.
+        :param: params: parameters, list or dictionary
+        """
+        if self.params is None:
+            if isinstance(params, dict):
+                return (), params
+            return params, None
+        if isinstance(params, dict):
+            if len(params) == len(self.order):
+                # common case: exactly the parameters of the function
+                try:
+                    return [params[param] for param in self.order], None
+                except KeyError:
+                    pass
+            args = []
+            for param, required, default in self.params:
+                if param in params:
+                    args.append(params[param])
+                elif required:
+                    raise ValueError('missing parameter %s' % param)
+                else:
+                    args.append(default)
+            kwargs = None
+            if not self.names.issuperset(params):
+                extra = [key for key in params if key not in self.names]
+                if extra and not self.varkw:
+                    raise ValueError('unexpected parameters %s' % ', '.join(sorted(extra)))
+                kwargs = dict((key, params[key]) for key in extra)
+            return args, kwargs
+        if len(params) > len(self.params) and not self.varargs:
+            raise ValueError('too many parameters')
+        if len(params) < len(self.params):
+            missing = [param for param, required, default in self.params[len(params):] if required]
+            if missing:
+                raise ValueError('missing parameter %s' % missing[0])
+            params = list(params) + [default for param, required, default in self.params[len(params):]]
+        return params, None
+
+
+class MultiplexJSONRPCServer(RVIJSONRPCServer):
+    """
+    RVI RPC Server hosting the services of several callback servers on
+    one listener. Calls are routed on the service id prefix of the
+    service name, e.g. '/pixie' for '/pixie/getitemlocations', to the
+    function table of the callback server owning the prefix.
+    """
+
+    def __init__(self, addr, **kwargs):
+        RVIJSONRPCServer.__init__(self, addr, **kwargs)
+        self.routes = {}
+
+    def add_route(self, prefix, server):
+        self.routes[prefix] = server
+
+    def remove_route(self, prefix):
+        self.routes.pop(prefix, None)
+
+    def _call_service(self, service, params):
+        end = service.find('/', 1)
+        route = self.routes.get(service[:end] if end > 0 else service)
+        if route is None:
+            return Fault(-32601, 'Method %s not supported.' % service)
+        return route._call_service(service, params)
+
+
+class RVICallbackServer(threading.Thread):
+    """
+    RPC server thread responding to callbacks from the RVI framework.
+    Base class of the callback servers of the HAGW. If a multiplexer is
+    given the services are hosted on the listener of the multiplexer
+    instead of a listener of their own and no thread is started.
+    """
+
+    # settings read on every use, changing them needs no action
+    live_settings = ()
+
+    def __init__(self, callback_url, service_id, mux=None):
+        threading.Thread.__init__(self)
+        self.callback_url = callback_url
+        self.service_id = service_id
+        self.mux = mux
+        self.ready = threading.Event()
+        if mux is not None:
+            self.network_address = mux.callback_url
+        else:
+            self.network_address = callback_url
+
+    def create_local_server(self, server_class=RVIJSONRPCServer):
+        """
+        Create the RPC server for the callback URL. The server is only
+        bound if the services are not hosted by a multiplexer.
+        """
+        url = urlparse(self.callback_url)
+        if self.mux is not None:
+            return server_class(addr=((url.hostname, url.port)), logRequests=False,
+                                bind_and_activate=False)
+        return server_class(addr=((url.hostname, url.port)), logRequests=False,
+                            workers=settings.RPC_SERVER_WORKERS,
+                            queue_size=settings.RPC_SERVER_QUEUE_SIZE,
+                            service_limit=settings.RPC_SERVER_SERVICE_CONCURRENCY,
+                            service_limits=settings.RPC_SERVER_SERVICE_LIMITS,
+                            reuse_port=settings.PROCESS_MODE == 'processes')
+
+    def register_services(self):
+        # register services with RVI framework
+        pass
+
+    def register_rvi_services(self, service_edge, services):
+        """
+        Register services with RVI concurrently.
+        Returns the registration results in the order of the services.
+        :param: service_edge: RVI service edge, must be safe to share by threads
+        :param: services: names of the services
+        """
+        results = [None] * len(services)
+        errors = []
+        def register(i, service):
+            try:
+                results[i] = service_edge.register_service(service = service,
+                                                           network_address = self.network_address)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=register, args=(i, service)) for i, service in enumerate(services)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def activate(self, register=True):
+        """
+        Start serving and register the services with RVI. The ready event
+        is set once the server is listening and its services are registered.
+        Returns the time the registration took in seconds.
+        :param: register: False to skip the registration, e.g. when a server
+                          is restarted on the address it was registered with
+        """
+        self.start()
+        started = time.time()
+        if register:
+            self.register_services()
+        self.ready.set()
+        return time.time() - started
+
+    def reconfigure(self, changed):
+        """
+        Apply changed settings to the running server. Returns the names of
+        the settings that could not be applied, the server has to be
+        restarted for them.
+        :param: changed: names of the changed settings of the server
+        """
+        return set(changed) - set(self.live_settings)
+
+    def healthy(self, timeout, busy_timeout):
+        """
+        Return True if the server thread is running and the listener
+        answers a JSON-RPC request within timeout seconds. Servers hosted
+        by a multiplexer are healthy while they are attached, the listener
+        is checked with the multiplexer. A listener bound with SO_REUSEPORT
+        is checked locally instead, the probe could be answered by another
+        worker process sharing the address. A server handling requests on
+        its own thread is not probed while it is busy with one, the probe
+        would wait for it; it is healthy unless the request has taken more
+        than busy_timeout seconds.
+        """
+        if self.mux is not None:
+            return self.mux.attached(self)
+        if not self.is_alive():
+            return False
+        server = self.localServer
+        if server.reuse_port or (server.queue is None and server.busy_since is not None):
+            return not server.stalled(busy_timeout)
+        url = urlparse(self.callback_url)
+        request = jsoncodec.dumps({'jsonrpc': '2.0', 'method': 'hagw.probe', 'id': 0})
+        try:
+            con = httplib.HTTPConnection(url.hostname, url.port, timeout=timeout)
+            try:
+                con.request('POST', '/', request, {'Content-Type': 'application/json-rpc'})
+                res = con.getresponse()
+                res.read()
+            finally:
+                con.close()
+        except (httplib.HTTPException, socket.error):
+            return False
+        # any JSON-RPC answer will do, the method does not exist
+        return res.status == 200
+
+    def start(self):
+        if self.mux is not None:
+            self.mux.attach(self)
+        else:
+            threading.Thread.start(self)
+
+    def run(self):
+        self.localServer.serve_forever()
+
+    def shutdown(self):
+        if self.mux is not None:
+            self.mux.detach(self)
+        elif self.is_alive():
+            self.localServer.shutdown()
+        self.localServer.server_close()
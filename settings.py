@@ -19,17 +19,35 @@ BASE_DIR = os.path.dirname(__file__)
 # Logging settings
 #LOGGING_DIR = os.path.join(BASE_DIR, 'hagw.log')
 LOGGING_DIR = '/var/log/hagw.log'
+# Write the log file from a background thread
+LOGGING_ASYNC = True
+# Payloads logged with hagwlogging.payload() are truncated to this many
+# characters (0 disables truncation) and rate limited per service to
+# LOG_PAYLOAD_RATE per second with bursts of up to LOG_PAYLOAD_BURST
+LOG_PAYLOAD_MAX = 512
+LOG_PAYLOAD_RATE = 10
+LOG_PAYLOAD_BURST = 20
 LOGGING_CONFIG = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'verbose': {
-            'format': '%(levelname)s %(asctime)s %(module)s %(process)d %(thread)d %(message)s'
+            'format': '%(levelname)s %(asctime)s %(module)s %(process)d %(thread)d %(trace_id)s %(message)s'
         },
         'simple': {
             'format': '%(levelname)s %(message)s'
         },
     },
+    'filters': {
+        'payload': {
+            '()': 'hagwlogging.PayloadSampler',
+            'rate': LOG_PAYLOAD_RATE,
+            'burst': LOG_PAYLOAD_BURST,
+        },
+        'trace': {
+            '()': 'tracing.TraceFilter',
+        },
+    },
     'handlers': {
         'null': {
             'level': 'DEBUG',
@@ -39,12 +57,14 @@ LOGGING_CONFIG = {
              'level': 'DEBUG',
              'class': 'logging.StreamHandler',
              'formatter': 'simple',
+             'filters': ['payload'],
         },
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'hagwlogging.AsyncFileHandler' if LOGGING_ASYNC else 'logging.FileHandler',
             'filename': LOGGING_DIR,
             'formatter': 'verbose',
+            'filters': ['payload', 'trace'],
         },
     },
     'loggers': {
@@ -63,18 +83,111 @@ LOGGING_CONFIG = {
 
 # General Configuration
 MAIN_LOOP_INTERVAL = 5
+# Seconds to wait for the callback servers to listen and register with RVI
+SERVER_STARTUP_TIMEOUT = 30
+# Every MAIN_LOOP_INTERVAL the supervisor probes the listener of every
+# callback server, waiting up to SUPERVISOR_PROBE_TIMEOUT seconds. A server
+# whose thread died or that failed SUPERVISOR_FAILURE_THRESHOLD probes in a
+# row is restarted on its own. If the HAGW cannot ping itself via RVI the
+# services are registered again. Failed recoveries are retried with an
+# exponential backoff from SUPERVISOR_BACKOFF to SUPERVISOR_MAX_BACKOFF
+# seconds. A server is given SUPERVISOR_SHUTDOWN_TIMEOUT seconds to stop.
+# A server busy with one request on its own thread, without RPC_SERVER_WORKERS,
+# or sharing its address with other worker processes is not probed but
+# counts as failed once the request has taken SUPERVISOR_BUSY_TIMEOUT seconds
+SUPERVISOR_PROBE_TIMEOUT = 5
+SUPERVISOR_BUSY_TIMEOUT = 60
+SUPERVISOR_FAILURE_THRESHOLD = 2
+SUPERVISOR_BACKOFF = 1
+SUPERVISOR_MAX_BACKOFF = 60
+SUPERVISOR_SHUTDOWN_TIMEOUT = 5
+# 'threads' runs all callback servers as threads of one process. 'processes'
+# forks a worker process per callback server, or a single one running all of
+# them if the Multiplex Server is enabled. The daemon restarts workers that
+# exit with the supervisor backoff and passes SIGHUP and SIGTERM on to them.
+# PROCESS_WORKERS runs more workers for a server (by key, 'mux' for the
+# Multiplex Server), they share its address with SO_REUSEPORT. Each worker
+# keeps its own state (caches, telemetry, subscriptions), so this suits the
+# stateless servers best. Worker n serves its metrics on the port of
+# METRICS_HTTP_URL plus n.
+PROCESS_MODE = 'threads'
+# e.g. {'pixie': 4, 'thingcontrol': 2}
+PROCESS_WORKERS = {}
+
+# Metrics: upper bounds in seconds of the latency histogram buckets of the
+# inbound services and outbound dependencies. If METRICS_HTTP_ENABLE is set
+# they are served at METRICS_HTTP_URL/metrics (Prometheus text format) and
+# METRICS_HTTP_URL/metrics.json, they are also available via /core/metrics.
+METRICS_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_HTTP_ENABLE = False
+METRICS_HTTP_URL = 'http://127.0.0.1:20006'
+
+# Trace every RPC call, see tracing.py. Calls taking TRACE_SLOW_THRESHOLD
+# seconds or longer are logged with their outbound calls, the last
+# TRACE_HISTORY of them are available via /core/gettraces
+TRACE_ENABLE = True
+TRACE_SLOW_THRESHOLD = 0.25
+TRACE_HISTORY = 100
+
+# Profiling sessions started via /core/startprofile, see profiler.py. They
+# stop by themselves after at most PROFILE_MAX_DURATION seconds and are
+# dumped to PROFILE_DIR
+PROFILE_SAMPLING_INTERVAL = 0.005
+PROFILE_MAX_DURATION = 600
+PROFILE_DIR = '/var/tmp/hagw-profiles'
+
+# JSON backends in order of preference, the standard library json module
+# is used if none of them is installed
+JSON_CODEC_BACKENDS = ['ujson', 'simplejson']
+
+# Callback RPC Server Configuration
+# Number of worker threads per callback server, 0 handles requests on the
+# server thread itself
+RPC_SERVER_WORKERS = 0
+# Maximum number of accepted requests waiting for a worker, 0 is unbounded
+RPC_SERVER_QUEUE_SIZE = 64
+# Maximum number of concurrent calls per service when running with workers,
+# 0 is unlimited. RPC_SERVER_SERVICE_LIMITS overrides it per service name.
+# Calls over the limit fail with a 'Service busy' fault (-32000).
+RPC_SERVER_SERVICE_CONCURRENCY = 2
+# e.g. {'/thingcontrol/getdevicestatus': 1}
+RPC_SERVER_SERVICE_LIMITS = {}
 
 # RVI Configuration
 RVI_SERVICE_EDGE_URL = 'http://192.168.100.101:8801'
 RVI_SEND_TIMEOUT = 10
+# Keep-alive connections to the RVI Service Edge, timeouts in seconds
+RVI_SERVICE_EDGE_POOL_SIZE = 4
+RVI_SERVICE_EDGE_CONNECT_TIMEOUT = 2
+RVI_SERVICE_EDGE_READ_TIMEOUT = 10
+# Queue outbound RVI messages and send them in the background, retrying
+# with exponential backoff (seconds) until RVI_SEND_TIMEOUT has passed.
+# Overflow policy of the full queue: 'drop-oldest', 'drop-newest' or 'block'
+RVI_SEND_QUEUE_ENABLE = True
+RVI_SEND_QUEUE_SIZE = 256
+RVI_SEND_QUEUE_POLICY = 'drop-oldest'
+RVI_SEND_QUEUE_WORKERS = 2
+RVI_SEND_RETRY_BACKOFF = 0.5
+RVI_SEND_RETRY_MAX_BACKOFF = 4.0
 
 # TV Configuration
 TV_SERVICE_EDGE_URL = 'tcp://192.168.100.101:11264'
 TV_SEND_TIMEOUT = 10
+# Persistent connection to the TV, messages are terminated by a newline and
+# dropped if they could not be written within TV_SEND_TIMEOUT seconds.
+# Timeouts and reconnect backoff in seconds
+TV_QUEUE_SIZE = 64
+TV_CONNECT_TIMEOUT = 2
+TV_WRITE_TIMEOUT = 5
+TV_RECONNECT_BACKOFF = 0.5
+TV_RECONNECT_MAX_BACKOFF = 8.0
 
 # IVI Configuration
 IVI_SERVICE_EDGE_URL = 'tcp://192.168.100.108:11264'
 IVI_SEND_TIMEOUT = 10
+# Persistent connection to the IVI, timeouts in seconds
+IVI_CONNECT_TIMEOUT = 2
+IVI_WRITE_TIMEOUT = 5
 
 
 # HAGW Core Services
@@ -83,14 +196,38 @@ CORE_SERVER_CALLBACK_URL = 'http://127.0.0.1:20000'
 CORE_SERVER_SERVICE_ID = '/core'
 CORE_SERVER_RVI_DOMAIN = 'jlr.com/smarthome/myhome'
 
+# Multiplex Server Configuration
+# When enabled all callback servers share one listener on
+# MUX_SERVER_CALLBACK_URL instead of binding their own
+MUX_SERVER_ENABLE = False
+MUX_SERVER_CALLBACK_URL = 'http://127.0.0.1:20005'
+#MUX_SERVER_CALLBACK_URL = 'http://192.168.100.100:20005'
+
 # Pixie Adjacent Server Configuration
 PIXIE_SERVER_ENABLE = True
 PIXIE_SERVER_CALLBACK_URL = 'http://127.0.0.1:20001'
 #PIXIE_SERVER_CALLBACK_URL = 'http://192.168.100.100:20001'
 PIXIE_SERVER_SERVICE_ID = '/pixie'
 PIXIE_SERVER_ADJACENT_URL = 'http://192.168.100.101:3000'
+# Two or more reference points: the first one is the origin, the second one
+# defines the x axis
 PIXIE_SERVER_REFERENCE_POINTS = ['D78D11E03AC8', 'DC955EBFD1C1']
 PIXIE_SERVER_HOME_DIMENSIONS = {'x': 350, 'y': 300}
+# Poll the Pixie Adjacent Server in the background every
+# PIXIE_SERVER_POLL_INTERVAL seconds and answer requests from the snapshot
+PIXIE_SERVER_POLL_ENABLE = False
+PIXIE_SERVER_POLL_INTERVAL = 1.0
+# Number of compiled tag filters of Pixie requests kept
+PIXIE_SERVER_TAG_FILTER_CACHE_SIZE = 64
+# Location subscriptions: the poller is started with the first subscription
+# and pushes tags that moved by at least PIXIE_SERVER_SUBSCRIPTION_THRESHOLD
+# (same unit as the ranges) or changed status, at most once every
+# PIXIE_SERVER_SUBSCRIPTION_MIN_INTERVAL seconds per subscriber. Subscriptions
+# expire after PIXIE_SERVER_SUBSCRIPTION_LEASE seconds unless renewed.
+PIXIE_SERVER_SUBSCRIPTION_THRESHOLD = 10
+PIXIE_SERVER_SUBSCRIPTION_MIN_INTERVAL = 2.0
+PIXIE_SERVER_SUBSCRIPTION_LEASE = 3600
+PIXIE_SERVER_MAX_SUBSCRIPTIONS = 32
 
 # Thingcontrol Server Configuration
 TC_SERVER_ENABLE = True
@@ -100,6 +237,27 @@ TC_SERVER_SERVICE_ID = '/thingcontrol'
 TC_SERVER_GATEWAY_URL = 'http://192.168.100.156:9091'
 TC_SERVER_GATEWAY_DOMAIN_CONTROL = '/hlg/thingcontrol'
 TC_SERVER_GATEWAY_DOMAIN_STATUS = '/hlg/thingsstatus'
+# Keep-alive connections to the Thingcontrol gateway, timeouts in seconds
+TC_SERVER_GATEWAY_POOL_SIZE = 4
+TC_SERVER_GATEWAY_IDLE_TIMEOUT = 30
+TC_SERVER_GATEWAY_CONNECT_TIMEOUT = 2
+TC_SERVER_GATEWAY_READ_TIMEOUT = 10
+# Commands of a /thingcontrol/batch request are sent concurrently, at most
+# TC_SERVER_BATCH_CONCURRENCY at a time, within TC_SERVER_BATCH_TIMEOUT seconds.
+# Callers may ask for a timeout of at most TC_SERVER_BATCH_MAX_TIMEOUT seconds
+TC_SERVER_BATCH_CONCURRENCY = 8
+TC_SERVER_BATCH_TIMEOUT = 5
+TC_SERVER_BATCH_MAX_TIMEOUT = 30
+# Seconds a device status fetched from the gateway is reused, 0 disables
+# the status cache
+TC_SERVER_STATUS_CACHE_TTL = 1.0
+# Remember the state of the devices from commands and status fetches for
+# TC_SERVER_SHADOW_MAX_AGE seconds, do not send commands that would not
+# change it and answer status requests from it. Door lock and secureHome
+# commands are always sent. Off by default: a device operated by hand or
+# by another controller meanwhile would ignore a suppressed command
+TC_SERVER_SHADOW_ENABLE = False
+TC_SERVER_SHADOW_MAX_AGE = 30
 
 # Usermessage Server Configuration
 UM_SERVER_ENABLE = True
@@ -112,3 +270,17 @@ VH_SERVER_ENABLE = True
 VH_SERVER_CALLBACK_URL = 'http://127.0.0.1:20004'
 #VH_SERVER_CALLBACK_URL = 'http://192.168.100.100:20004'
 VH_SERVER_SERVICE_ID = '/vehicle'
+# Telemetry store: the latest VH_SERVER_TELEMETRY_SAMPLES samples of every
+# channel and VH_SERVER_TELEMETRY_BUCKETS aggregates of
+# VH_SERVER_TELEMETRY_RESOLUTION seconds each (default 24 hours)
+VH_SERVER_TELEMETRY_SAMPLES = 256
+VH_SERVER_TELEMETRY_BUCKETS = 288
+VH_SERVER_TELEMETRY_RESOLUTION = 300
+VH_SERVER_TELEMETRY_MAX_VEHICLES = 100
+# Rules on status report channels, see rules.py. A rule fires when its
+# condition becomes true. Actions: 'tv' sends 'message' to the TV, 'rvi'
+# sends the event to the RVI service 'sendto'.
+VH_SERVER_RULES = [
+    {'name': 'trunk open', 'channel': 'trunk', 'op': '==', 'value': 'open', 'debounce': 10,
+     'action': 'tv', 'message': '{ "command": "vehicleIncursion", "type": "hatch" }'},
+]
@@ -0,0 +1,90 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Last known state of the home automation devices.
+"""
+
+import threading, time
+
+
+class DeviceShadow(object):
+    """
+    Last known Thingcontrol message of every device by device id, updated
+    from the commands accepted by the gateway and from status fetches.
+    Entries older than max_age seconds are stale and no longer used.
+    """
+
+    def __init__(self, max_age=30):
+        """
+        :param: max_age: seconds an entry is trusted
+        """
+        self.max_age = max_age
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.counters = {'updates': 0, 'suppressed': 0, 'forwarded': 0,
+                         'hits': 0, 'misses': 0, 'stale': 0}
+
+    def fresh(self, entry, now):
+        if entry is None:
+            return False
+        if now - entry['time'] > self.max_age:
+            self.counters['stale'] += 1
+            return False
+        return True
+
+    def unchanged(self, data):
+        """
+        Return True if the device already is in the state a command would
+        set, i.e. the command can be suppressed, and count the decision.
+        :param: data: Thingcontrol message of the command
+        """
+        with self.lock:
+            entry = self.devices.get(data['device_id'])
+            if self.fresh(entry, time.time()) and entry['data']['control'] == data['control']:
+                self.counters['suppressed'] += 1
+                return True
+            self.counters['forwarded'] += 1
+            return False
+
+    def update(self, data, source):
+        """
+        Record the state of a device.
+        :param: data: Thingcontrol message of a command or status
+        :param: source: 'command' or 'status'
+        """
+        with self.lock:
+            self.devices[data['device_id']] = {'data': data, 'source': source, 'time': time.time()}
+            self.counters['updates'] += 1
+
+    def invalidate(self, device_id):
+        """
+        Forget the state of a device, e.g. after a failed command.
+        """
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+    def get(self, device_id):
+        """
+        Return the last known message of a device or None if there is no
+        fresh one.
+        :param: device_id: device id
+        """
+        with self.lock:
+            entry = self.devices.get(device_id)
+            if self.fresh(entry, time.time()):
+                self.counters['hits'] += 1
+                return entry['data']
+            self.counters['misses'] += 1
+            return None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, devices=len(self.devices))
@@ -0,0 +1,183 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Persistent outbound TCP connections for notifications, e.g. to the TV.
+"""
+
+import threading, socket, select, time, Queue
+from urlparse import urlparse
+
+import metrics
+
+
+class StreamConnection(object):
+    """
+    Persistent TCP connection written by a background thread. Messages are
+    terminated by the delimiter and queued by send(), which never blocks.
+    The writer coalesces the queued messages into a single write, and
+    reconnects with exponential backoff when the connection fails. Messages
+    that could not be written within their timeout are dropped. If the
+    connection is named its writes are recorded in the metrics.
+    """
+
+    def __init__(self, url, logger, queue_size=64, connect_timeout=2, write_timeout=5,
+                 send_timeout=10, backoff=0.5, max_backoff=8.0, delimiter='\n', max_write=65536,
+                 name=None):
+        """
+        :param: url: endpoint, tcp://host:port
+        :param: logger: logger
+        :param: queue_size: maximum number of queued messages
+        :param: connect_timeout: connect timeout in seconds
+        :param: write_timeout: write timeout in seconds
+        :param: send_timeout: seconds a message may wait to be written
+        :param: backoff: initial reconnect backoff in seconds
+        :param: max_backoff: maximum reconnect backoff in seconds
+        :param: delimiter: message terminator
+        :param: max_write: maximum number of bytes coalesced into one write
+        :param: name: name of the connection in the metrics
+        """
+        self.name = name
+        parsed = urlparse(url)
+        self.url = url
+        self.address = (parsed.hostname, parsed.port)
+        self.logger = logger
+        self.queue = Queue.Queue(queue_size)
+        self.connect_timeout = connect_timeout
+        self.write_timeout = write_timeout
+        self.send_timeout = send_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.delimiter = delimiter
+        self.max_write = max_write
+        self.sock = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = {'queued': 0, 'sent': 0, 'writes': 0, 'dropped': 0,
+                         'expired': 0, 'connects': 0, 'errors': 0}
+        self.writer = threading.Thread(target=self.run, name='StreamConnection %s' % url)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def send(self, message):
+        """
+        Queue a message. Returns False if the queue is full.
+        :param: message: message, without delimiter
+        """
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        try:
+            self.queue.put_nowait((time.time() + self.send_timeout, message + self.delimiter))
+        except Queue.Full:
+            self.count('dropped')
+            self.logger.warning('Stream Connection %s: queue full, dropping message', self.url)
+            return False
+        self.count('queued')
+        return True
+
+    def run(self):
+        pending = []
+        backoff = self.backoff
+        while not self.stopped.is_set():
+            if not pending:
+                item = self.queue.get()
+                if item is None:
+                    break
+                pending.append(item)
+            # coalesce everything queued meanwhile into one write
+            size = sum(len(data) for deadline, data in pending)
+            while size < self.max_write:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is None:
+                    self.stopped.set()
+                    break
+                pending.append(item)
+                size += len(item[1])
+            now = time.time()
+            expired = [entry for entry in pending if entry[0] < now]
+            if expired:
+                pending = [entry for entry in pending if entry[0] >= now]
+                self.count('expired', len(expired))
+                self.logger.error('Stream Connection %s: %d messages expired', self.url, len(expired))
+                if not pending:
+                    continue
+            begin = time.time()
+            try:
+                self.write(''.join(data for deadline, data in pending))
+                self.count('sent', len(pending))
+                self.count('writes')
+                pending = []
+                backoff = self.backoff
+                if self.name is not None:
+                    metrics.observe(metrics.OUTBOUND, self.name, time.time() - begin)
+            except (socket.error, socket.timeout) as e:
+                self.count('errors')
+                if self.name is not None:
+                    metrics.observe(metrics.OUTBOUND, self.name, time.time() - begin, True)
+                self.logger.warning('Stream Connection %s: write failed: %s, retrying in %.1f s', self.url, e, backoff)
+                self.disconnect()
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            except Exception as e:
+                # not worth retrying, drop the batch but keep the writer alive
+                self.count('errors')
+                self.count('dropped', len(pending))
+                self.logger.error('Stream Connection %s: dropping %d messages: %s', self.url, len(pending), e)
+                pending = []
+                # a part of the batch may have been written
+                self.disconnect()
+        self.disconnect()
+
+    def write(self, data):
+        if self.sock is not None and self.closed_by_peer():
+            self.disconnect()
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, self.connect_timeout)
+            self.sock.settimeout(self.write_timeout)
+            self.count('connects')
+        self.sock.sendall(data)
+
+    def closed_by_peer(self):
+        # the peer does not send anything, so a readable socket is at EOF
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+            return bool(readable) and not self.sock.recv(4096)
+        except (socket.error, select.error):
+            return True
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def stop(self):
+        """
+        Stop the writer. Messages still queued are discarded.
+        """
+        self.stopped.set()
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        self.writer.join(self.write_timeout)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, depth=self.queue.qsize(), connected=self.sock is not None)
@@ -0,0 +1,163 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Health supervision of the callback servers of the HAGW.
+"""
+
+import threading, time
+
+import settings
+
+
+class Backoff(object):
+    """
+    Exponential backoff of the recovery attempts of one component.
+    """
+
+    def __init__(self, initial, maximum):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = initial
+        self.next = 0
+
+    def due(self, now):
+        return now >= self.next
+
+    def failed(self, now):
+        """
+        Schedule the next attempt and return the delay.
+        """
+        delay = self.delay
+        self.next = now + delay
+        self.delay = min(self.delay * 2, self.maximum)
+        return delay
+
+    def reset(self):
+        self.delay = self.initial
+        self.next = 0
+
+
+class Supervisor(object):
+    """
+    Checks the callback servers one by one and recovers only the failed
+    ones, each with an exponential backoff of its own.
+
+    A server is unhealthy if its thread has died or its listener has not
+    answered a probe for failure_threshold checks in a row; it is then
+    shut down and restarted on the same address, which keeps its RVI
+    registrations valid. RVI is checked separately by pinging the core
+    server through RVI: if that fails the services of all servers are
+    registered again, but no listener is touched.
+    """
+
+    # key of the RVI registrations in the backoff table
+    RVI = 'rvi'
+
+    # the ping via RVI is answered by the core server, maybe on the multiplexer
+    PING_SERVERS = ('core', 'mux')
+
+    def __init__(self, daemon, logger):
+        """
+        :param: daemon: HAGW server providing servers, restart_server() and ping()
+        :param: logger: logger
+        """
+        self.daemon = daemon
+        self.logger = logger
+        self.failures = {}
+        self.backoffs = {}
+        self.counters = {'checks': 0, 'probe_failures': 0, 'restarts': 0,
+                         'restart_failures': 0, 'registrations': 0, 'registration_failures': 0}
+
+    def backoff(self, key):
+        backoff = self.backoffs.get(key)
+        if backoff is None:
+            backoff = self.backoffs[key] = Backoff(settings.SUPERVISOR_BACKOFF,
+                                                   settings.SUPERVISOR_MAX_BACKOFF)
+        return backoff
+
+    def check(self):
+        """
+        Check all servers and RVI once and recover what failed.
+        """
+        self.counters['checks'] += 1
+        now = time.time()
+        failed = set()
+        for key, server in self.daemon.servers.items():
+            if server.healthy(settings.SUPERVISOR_PROBE_TIMEOUT, settings.SUPERVISOR_BUSY_TIMEOUT):
+                self.failures[key] = 0
+                self.backoff(key).reset()
+                continue
+            failed.add(key)
+            self.counters['probe_failures'] += 1
+            self.failures[key] = self.failures.get(key, 0) + 1
+            dead = server.mux is None and not server.is_alive()
+            if not dead and self.failures[key] < settings.SUPERVISOR_FAILURE_THRESHOLD:
+                self.logger.warning('Supervisor: %s not answering (%d)', key, self.failures[key])
+                continue
+            backoff = self.backoff(key)
+            if backoff.due(now):
+                self.restart(key, backoff, now)
+        if not failed.intersection(Supervisor.PING_SERVERS):
+            self.check_rvi(now)
+
+    def restart(self, key, backoff, now):
+        self.logger.warning('Supervisor: restarting %s', key)
+        try:
+            self.daemon.restart_server(key)
+        except Exception as e:
+            self.counters['restart_failures'] += 1
+            self.logger.error('Supervisor: cannot restart %s: %s, next attempt in %.1f s',
+                              key, e, backoff.failed(now))
+            return
+        self.counters['restarts'] += 1
+        self.failures[key] = 0
+        # a server failing again right away backs off further
+        backoff.failed(now)
+        self.logger.info('Supervisor: %s restarted', key)
+
+    def check_rvi(self, now):
+        backoff = self.backoff(Supervisor.RVI)
+        if self.daemon.ping():
+            backoff.reset()
+            return
+        if not backoff.due(now):
+            return
+        self.logger.warning('Supervisor: ping via RVI failed, registering services again')
+        try:
+            self.daemon.register_services()
+        except Exception as e:
+            self.counters['registration_failures'] += 1
+            self.logger.error('Supervisor: cannot register services: %s, next attempt in %.1f s',
+                              e, backoff.failed(now))
+            return
+        self.counters['registrations'] += 1
+        backoff.failed(now)
+
+    def stats(self):
+        return dict(self.counters, failures=dict(self.failures))
+
+
+def stopServer(server, timeout):
+    """
+    Shut a callback server down, giving up after timeout seconds if it is
+    stuck in a request. Its listener is closed in any case, so the address
+    can be bound again.
+    :param: server: callback server
+    :param: timeout: seconds to wait
+    """
+    stopper = threading.Thread(target=server.shutdown, name='Stop %s' % server.callback_url)
+    stopper.daemon = True
+    stopper.start()
+    stopper.join(timeout)
+    if stopper.is_alive():
+        server.localServer.server_close()
+        return False
+    return True
@@ -0,0 +1,209 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+In-memory time series of vehicle status reports by VIN and channel.
+"""
+
+import threading, time
+from array import array
+from collections import OrderedDict
+
+
+def flattenReport(data):
+    """
+    Return the (channel, value) pairs of a status report. Nested values are
+    split into one channel per key, e.g. seats.frontleft.
+    :param: data: list of {'channel': name, 'value': value}
+    """
+    samples = []
+    for item in data:
+        name, value = item['channel'], item['value']
+        if isinstance(value, dict):
+            samples.extend((name + '.' + key, v) for key, v in value.iteritems())
+        else:
+            samples.append((name, value))
+    return samples
+
+
+class Channel(object):
+    """
+    Time series of one channel in fixed memory. The latest samples are kept
+    in a ring buffer of (time, value) pairs; every sample is also added to
+    a second ring of fixed length buckets holding count, sum, minimum and
+    maximum, which covers a longer history at a lower resolution. String
+    values are stored as codes of the store's enumeration table.
+    """
+
+    def __init__(self, samples, buckets, resolution):
+        self.samples = samples
+        self.times = array('d', [0.0] * samples)
+        self.values = array('d', [0.0] * samples)
+        self.count = 0
+        self.resolution = float(resolution)
+        self.buckets = buckets
+        self.bucket_start = array('d', [0.0] * buckets)
+        self.bucket_count = array('l', [0] * buckets)
+        self.bucket_sum = array('d', [0.0] * buckets)
+        self.bucket_min = array('d', [0.0] * buckets)
+        self.bucket_max = array('d', [0.0] * buckets)
+        self.bucket = -1
+        self.enum = False
+
+    def add(self, t, value):
+        i = self.count % self.samples
+        self.times[i] = t
+        self.values[i] = value
+        self.count += 1
+        start = t - t % self.resolution
+        b = self.bucket % self.buckets
+        if self.bucket < 0 or self.bucket_start[b] != start:
+            self.bucket += 1
+            b = self.bucket % self.buckets
+            self.bucket_start[b] = start
+            self.bucket_count[b] = 1
+            self.bucket_sum[b] = value
+            self.bucket_min[b] = value
+            self.bucket_max[b] = value
+        else:
+            self.bucket_count[b] += 1
+            self.bucket_sum[b] += value
+            if value < self.bucket_min[b]:
+                self.bucket_min[b] = value
+            if value > self.bucket_max[b]:
+                self.bucket_max[b] = value
+
+    def latest(self):
+        i = (self.count - 1) % self.samples
+        return self.times[i], self.values[i]
+
+    def aggregate(self, since):
+        """
+        Return count, sum, minimum and maximum of the samples since the
+        given time. Uses the raw samples if they reach back far enough,
+        otherwise the buckets, which start up to one resolution early.
+        """
+        n = min(self.count, self.samples)
+        oldest = (self.count - n) % self.samples
+        if self.count <= self.samples or self.times[oldest] <= since:
+            count, total, low, high = 0, 0.0, None, None
+            for k in range(self.count - 1, self.count - n - 1, -1):
+                i = k % self.samples
+                if self.times[i] < since:
+                    break
+                v = self.values[i]
+                count += 1
+                total += v
+                low = v if low is None or v < low else low
+                high = v if high is None or v > high else high
+            return count, total, low, high
+        count, total, low, high = 0, 0.0, None, None
+        for k in range(self.bucket, max(self.bucket - self.buckets, -1), -1):
+            b = k % self.buckets
+            if self.bucket_start[b] + self.resolution <= since:
+                break
+            count += self.bucket_count[b]
+            total += self.bucket_sum[b]
+            low = self.bucket_min[b] if low is None or self.bucket_min[b] < low else low
+            high = self.bucket_max[b] if high is None or self.bucket_max[b] > high else high
+        return count, total, low, high
+
+
+class TelemetryStore(object):
+    """
+    Channels of the vehicles that reported most recently. When more than
+    max_vehicles vehicles have reported, the one that has not reported the
+    longest is evicted.
+    """
+
+    def __init__(self, samples=256, buckets=288, resolution=300, max_vehicles=100):
+        """
+        :param: samples: number of samples kept per channel
+        :param: buckets: number of downsampled buckets kept per channel
+        :param: resolution: bucket length in seconds
+        :param: max_vehicles: maximum number of vehicles kept
+        """
+        self.samples = samples
+        self.buckets = buckets
+        self.resolution = resolution
+        self.max_vehicles = max_vehicles
+        self.vehicles = OrderedDict()
+        self.codes = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = float(len(self.names))
+            self.names.append(value)
+        return code
+
+    def record(self, vin, samples, t=None):
+        """
+        Add a status report of a vehicle.
+        :param: vin: vehicle identification number
+        :param: samples: (channel, value) pairs, see flattenReport()
+        :param: t: time of the report, defaults to now
+        """
+        if t is None:
+            t = time.time()
+        with self.lock:
+            channels = self.vehicles.pop(vin, None)
+            if channels is None:
+                channels = {}
+                if len(self.vehicles) >= self.max_vehicles:
+                    self.vehicles.popitem(last=False)
+            self.vehicles[vin] = channels
+            for name, value in samples:
+                try:
+                    value, enum = float(value), False
+                except (TypeError, ValueError):
+                    value, enum = self.encode(unicode(value)), True
+                channel = channels.get(name)
+                if channel is None:
+                    channel = channels[name] = Channel(self.samples, self.buckets, self.resolution)
+                channel.enum = enum
+                channel.add(t, value)
+
+    def query(self, vin, channels=None, window=None):
+        """
+        Return per channel the latest value and its time, and the number of
+        samples in the window. Numeric channels also report minimum, maximum
+        and mean of the window. Returns None if the vehicle is unknown.
+        :param: vin: vehicle identification number
+        :param: channels: channel names, all channels if empty
+        :param: window: window in seconds, defaults to the latest value only
+        """
+        now = time.time()
+        with self.lock:
+            stored = self.vehicles.get(vin)
+            if stored is None:
+                return None
+            result = {}
+            for name in channels or stored.keys():
+                channel = stored.get(name)
+                if channel is None:
+                    continue
+                t, value = channel.latest()
+                entry = {'time': t, 'value': self.names[int(value)] if channel.enum else value}
+                if window:
+                    count, total, low, high = channel.aggregate(now - window)
+                    entry['count'] = count
+                    if not channel.enum and count:
+                        entry.update({'min': low, 'max': high, 'mean': total / count})
+                result[name] = entry
+            return result
+
+    def stats(self):
+        with self.lock:
+            return {'vehicles': len(self.vehicles),
+                    'channels': sum(len(c) for c in self.vehicles.itervalues()),
+                    'enumerations': len(self.names)}
@@ -0,0 +1,95 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the caches.
+"""
+
+import threading, time, unittest
+
+from cache import TTLCache, LRUCache
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_hit_and_expiry(self):
+        cache = TTLCache(0.05)
+        fetches = []
+        fetch = lambda: fetches.append(1) or len(fetches)
+        self.assertEqual(cache.get('key', fetch), 1)
+        self.assertEqual(cache.get('key', fetch), 1)
+        time.sleep(0.06)
+        self.assertEqual(cache.get('key', fetch), 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stale']), (1, 1, 1))
+
+    def test_none_is_not_cached(self):
+        cache = TTLCache(60)
+        fetches = []
+        cache.get('key', lambda: fetches.append(1))
+        cache.get('key', lambda: fetches.append(1))
+        self.assertEqual(len(fetches), 2)
+
+    def test_invalidate(self):
+        cache = TTLCache(60)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.invalidate('a')
+        self.assertEqual(cache.get('a', lambda: 3), 3)
+        cache.invalidate()
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        cache = TTLCache(60)
+        release = threading.Event()
+        fetches = []
+        def fetch():
+            fetches.append(1)
+            release.wait(5)
+            return 'value'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('key', fetch)))
+                   for i in range(0, 5)]
+        for thread in threads:
+            thread.start()
+        # wait until all followers are waiting for the leader
+        deadline = time.time() + 5
+        while cache.stats()['coalesced'] < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+    def test_failed_fetch_releases_followers(self):
+        cache = TTLCache(60)
+        def fetch():
+            raise IOError('unreachable')
+        self.assertRaises(IOError, cache.get, 'key', fetch)
+        self.assertEqual(cache.get('key', lambda: 'value'), 'value')
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: None)
+        cache.get('c', lambda: 3)
+        self.assertEqual(cache.get('a', lambda: 4), 1)
+        self.assertEqual(cache.get('b', lambda: 5), 5)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the edge triggered rule engine.
+"""
+
+import logging, unittest
+
+from rules import RuleEngine
+
+
+logger = logging.getLogger('hagw.test')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class RuleEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.actions = {'record': lambda vin, rule, value: self.calls.append((vin, rule['name'], value))}
+
+    def engine(self, rules, max_vehicles=100):
+        return RuleEngine(rules, self.actions, logger, max_vehicles)
+
+    def test_fires_on_rising_edge_only(self):
+        engine = self.engine([{'name': 'open', 'channel': 'trunk', 'value': 'open', 'action': 'record'}])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 0), ['open'])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 1), [])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'closed')], 2), [])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 3), ['open'])
+        self.assertEqual(self.calls, [('VIN1', 'open', 'open'), ('VIN1', 'open', 'open')])
+
+    def test_state_is_per_vehicle(self):
+        engine = self.engine([{'name': 'open', 'channel': 'trunk', 'value': 'open', 'action': 'record'}])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 0), ['open'])
+        self.assertEqual(engine.evaluate('VIN2', [('trunk', 'open')], 0), ['open'])
+
+    def test_numeric_comparison(self):
+        engine = self.engine([{'name': 'fast', 'channel': 'speed', 'op': '>', 'value': 100, 'action': 'record'}])
+        self.assertEqual(engine.evaluate('VIN1', [('speed', '99.5')], 0), [])
+        self.assertEqual(engine.evaluate('VIN1', [('speed', 'unknown')], 1), [])
+        self.assertEqual(engine.evaluate('VIN1', [('speed', '120')], 2), ['fast'])
+        self.assertEqual(self.calls, [('VIN1', 'fast', '120')])
+
+    def test_debounce(self):
+        engine = self.engine([{'name': 'open', 'channel': 'trunk', 'value': 'open',
+                               'action': 'record', 'debounce': 10}])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 0), ['open'])
+        engine.evaluate('VIN1', [('trunk', 'closed')], 1)
+        # rising again within the debounce time
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 2), [])
+        engine.evaluate('VIN1', [('trunk', 'closed')], 11)
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 12), ['open'])
+        self.assertEqual(engine.stats()['debounced'], 1)
+
+    def test_evicted_vehicle_fires_again(self):
+        engine = self.engine([{'name': 'open', 'channel': 'trunk', 'value': 'open', 'action': 'record'}],
+                             max_vehicles=1)
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 0), ['open'])
+        engine.evaluate('VIN2', [('trunk', 'closed')], 1)
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 2), ['open'])
+        self.assertEqual(engine.stats()['vehicles'], 1)
+
+    def test_failing_action_is_counted(self):
+        self.actions['fail'] = lambda vin, rule, value: 1 / 0
+        engine = self.engine([{'channel': 'trunk', 'value': 'open', 'action': 'fail'}])
+        self.assertEqual(engine.evaluate('VIN1', [('trunk', 'open')], 0), ['rule 0'])
+        self.assertEqual(engine.stats()['errors'], 1)
+
+    def test_invalid_rules(self):
+        self.assertRaises(ValueError, self.engine,
+                          [{'channel': 'trunk', 'op': '~', 'value': 'open', 'action': 'record'}])
+        self.assertRaises(ValueError, self.engine,
+                          [{'channel': 'trunk', 'value': 'open', 'action': 'unknown'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
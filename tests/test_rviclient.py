@@ -0,0 +1,187 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the RVI send queue.
+"""
+
+import logging, threading, time, unittest
+
+from rviclient import RVIServiceEdge, RVISendQueue
+
+
+logger = logging.getLogger('hagw.test')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class Edge(object):
+    """
+    Service edge recording the messages sent. Sending blocks until the
+    edge is opened and fails while failures are left.
+    """
+
+    def __init__(self, failures=0):
+        self.sent = []
+        self.failures = failures
+        self.open = threading.Event()
+        self.open.set()
+
+    def message(self, service_name, timeout, parameters):
+        self.open.wait(5)
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError('unreachable')
+        self.sent.append(service_name)
+
+
+def wait(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class RVISendQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.stop()
+            queue.edge.open.set()
+        for queue in self.queues:
+            for worker in queue.workers:
+                worker.join(5)
+
+    def queue(self, edge, **kwargs):
+        queue = RVISendQueue(edge, logger, **kwargs)
+        self.queues.append(queue)
+        return queue
+
+    def blocked(self, size, policy):
+        """
+        Return a closed edge and a queue of size whose worker is busy
+        sending the first message, so further messages stay queued.
+        """
+        edge = Edge()
+        edge.open.clear()
+        queue = self.queue(edge, size=size, policy=policy)
+        queue.put('first', time.time() + 60, [])
+        self.assertTrue(wait(lambda: queue.stats()['depth'] == 0))
+        return edge, queue
+
+    def test_messages_are_sent(self):
+        edge = Edge()
+        queue = self.queue(edge, workers=2)
+        for i in range(0, 10):
+            self.assertTrue(queue.put('service%d' % i, time.time() + 60, []))
+        self.assertTrue(wait(lambda: len(edge.sent) == 10))
+        self.assertEqual(sorted(edge.sent), sorted('service%d' % i for i in range(0, 10)))
+
+    def test_drop_oldest(self):
+        edge, queue = self.blocked(2, 'drop-oldest')
+        for name in ('a', 'b', 'c'):
+            self.assertTrue(queue.put(name, time.time() + 60, []))
+        self.assertEqual([message[0] for message in queue.drain()], ['b', 'c'])
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+    def test_drop_newest(self):
+        edge, queue = self.blocked(2, 'drop-newest')
+        self.assertTrue(queue.put('a', time.time() + 60, []))
+        self.assertTrue(queue.put('b', time.time() + 60, []))
+        self.assertFalse(queue.put('c', time.time() + 60, []))
+        self.assertEqual([message[0] for message in queue.drain()], ['a', 'b'])
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+    def test_block_waits_for_space(self):
+        edge, queue = self.blocked(1, 'block')
+        queue.put('a', time.time() + 60, [])
+        results = []
+        producer = threading.Thread(target=lambda: results.append(queue.put('b', time.time() + 60, [])))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        edge.open.set()
+        producer.join(5)
+        self.assertEqual(results, [True])
+        self.assertTrue(wait(lambda: edge.sent == ['first', 'a', 'b']))
+
+    def test_stop_wakes_blocked_producer(self):
+        edge, queue = self.blocked(1, 'block')
+        queue.put('a', time.time() + 60, [])
+        results = []
+        producer = threading.Thread(target=lambda: results.append(queue.put('b', time.time() + 60, [])))
+        producer.start()
+        producer.join(0.1)
+        queue.stop()
+        producer.join(5)
+        self.assertEqual(results, [False])
+        self.assertFalse(queue.put('c', time.time() + 60, []))
+        self.assertEqual(queue.stats()['refused'], 2)
+
+    def test_failed_send_is_retried(self):
+        edge = Edge(failures=2)
+        queue = self.queue(edge, backoff=0.01, max_backoff=0.02)
+        queue.put('a', time.time() + 60, [])
+        self.assertTrue(wait(lambda: edge.sent == ['a']))
+        self.assertEqual(queue.stats()['retries'], 2)
+
+    def test_message_expires(self):
+        edge = Edge(failures=1000)
+        queue = self.queue(edge, backoff=0.01, max_backoff=0.02)
+        queue.put('a', time.time() + 0.1, [])
+        self.assertTrue(wait(lambda: queue.stats()['expired'] == 1))
+        self.assertEqual(edge.sent, [])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, RVISendQueue, Edge(), logger, policy='drop-all')
+
+
+class SendQueueHandoverTest(unittest.TestCase):
+
+    def test_queued_messages_move_to_new_queue(self):
+        edge = RVIServiceEdge('http://127.0.0.1:1')
+        sender = Edge()
+        sender.open.clear()
+        edge.message = sender.message
+        old = edge.send_queue = RVISendQueue(edge, logger)
+        for name in ('first', 'a', 'b'):
+            edge.post(name, time.time() + 60, [])
+        self.assertTrue(wait(lambda: old.stats()['depth'] == 2))
+        new = RVISendQueue(edge, logger)
+        self.assertEqual(edge.replace_send_queue(new), 0)
+        # a producer still holding the old queue is refused
+        self.assertFalse(old.put('c', time.time() + 60, []))
+        self.assertTrue(edge.post('d', time.time() + 60, []))
+        sender.open.set()
+        self.assertTrue(wait(lambda: sorted(sender.sent) == ['a', 'b', 'd', 'first']))
+        edge.close()
+        for worker in old.workers + new.workers:
+            worker.join(5)
+
+    def test_disabling_the_queue_drops_messages(self):
+        edge = RVIServiceEdge('http://127.0.0.1:1')
+        sender = Edge()
+        sender.open.clear()
+        edge.message = sender.message
+        old = edge.send_queue = RVISendQueue(edge, logger)
+        for name in ('first', 'a', 'b'):
+            edge.post(name, time.time() + 60, [])
+        self.assertTrue(wait(lambda: old.stats()['depth'] == 2))
+        self.assertEqual(edge.replace_send_queue(None), 2)
+        sender.open.set()
+        edge.close()
+        old.workers[0].join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
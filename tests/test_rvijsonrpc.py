@@ -0,0 +1,78 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the compiled service routes.
+"""
+
+import unittest
+
+from rvijsonrpc import ServiceRoute
+
+
+def report(vin, timestamp, data=None):
+    return vin, timestamp, data
+
+
+def anything(vin, *args, **kwargs):
+    return vin, args, kwargs
+
+
+class Handler(object):
+
+    def status(self, command):
+        return command
+
+
+class ServiceRouteTest(unittest.TestCase):
+
+    def test_bind_dictionary(self):
+        route = ServiceRoute(report, 'report')
+        self.assertEqual(route.bind({'vin': 1, 'timestamp': 2, 'data': 3}), ([1, 2, 3], None))
+        self.assertEqual(route.bind({'vin': 1, 'timestamp': 2}), ([1, 2, None], None))
+
+    def test_bind_list(self):
+        route = ServiceRoute(report, 'report')
+        self.assertEqual(route.bind([1, 2, 3]), ([1, 2, 3], None))
+        self.assertEqual(route.bind([1, 2]), ([1, 2, None], None))
+
+    def test_missing_parameter(self):
+        route = ServiceRoute(report, 'report')
+        self.assertRaisesRegexp(ValueError, 'missing parameter timestamp', route.bind, {'vin': 1})
+        self.assertRaisesRegexp(ValueError, 'missing parameter timestamp', route.bind, [1])
+
+    def test_same_number_of_other_parameters(self):
+        route = ServiceRoute(report, 'report')
+        self.assertRaisesRegexp(ValueError, 'missing parameter timestamp', route.bind,
+                                {'vin': 1, 'data': 3, 'extra': 4})
+
+    def test_unexpected_parameters(self):
+        route = ServiceRoute(report, 'report')
+        self.assertRaisesRegexp(ValueError, 'unexpected parameters extra, more', route.bind,
+                                {'vin': 1, 'timestamp': 2, 'more': 3, 'extra': 4})
+        self.assertRaisesRegexp(ValueError, 'too many parameters', route.bind, [1, 2, 3, 4])
+
+    def test_variable_arguments(self):
+        route = ServiceRoute(anything, 'anything')
+        self.assertEqual(route.bind({'vin': 1, 'extra': 2}), ([1], {'extra': 2}))
+        self.assertEqual(route.bind([1, 2, 3]), ([1, 2, 3], None))
+
+    def test_bound_method(self):
+        route = ServiceRoute(Handler().status, 'status')
+        self.assertEqual(route.bind({'command': 'lock'}), (['lock'], None))
+
+    def test_opaque_callable(self):
+        route = ServiceRoute(len, 'len')
+        self.assertEqual(route.bind([[1, 2]]), ([[1, 2]], None))
+        self.assertEqual(route.bind({'x': 1}), ((), {'x': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the device shadow.
+"""
+
+import unittest
+
+import shadow
+from shadow import DeviceShadow
+
+
+def message(device_id, control):
+    return {'device_id': device_id, 'control': control}
+
+
+class Clock(object):
+    """
+    Stands in for the time module of the shadow.
+    """
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class DeviceShadowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock(1000.0)
+        self.time = shadow.time
+        shadow.time = self.clock
+
+    def tearDown(self):
+        shadow.time = self.time
+
+    def test_unchanged_command_is_suppressed(self):
+        devices = DeviceShadow(max_age=30)
+        devices.update(message('lamp', {'on': True}), 'command')
+        self.assertTrue(devices.unchanged(message('lamp', {'on': True})))
+        self.assertFalse(devices.unchanged(message('lamp', {'on': False})))
+        self.assertFalse(devices.unchanged(message('plug', {'on': True})))
+        stats = devices.stats()
+        self.assertEqual((stats['suppressed'], stats['forwarded']), (1, 2))
+
+    def test_stale_entry_is_not_used(self):
+        devices = DeviceShadow(max_age=30)
+        devices.update(message('lamp', {'on': True}), 'status')
+        self.clock.now += 31
+        self.assertFalse(devices.unchanged(message('lamp', {'on': True})))
+        self.assertIsNone(devices.get('lamp'))
+        self.assertEqual(devices.stats()['stale'], 2)
+
+    def test_get(self):
+        devices = DeviceShadow()
+        devices.update(message('lamp', {'on': True}), 'status')
+        self.assertEqual(devices.get('lamp'), message('lamp', {'on': True}))
+        self.assertIsNone(devices.get('plug'))
+        stats = devices.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_invalidate(self):
+        devices = DeviceShadow()
+        devices.update(message('lamp', {'on': True}), 'command')
+        devices.invalidate('lamp')
+        devices.invalidate('plug')
+        self.assertFalse(devices.unchanged(message('lamp', {'on': True})))
+        self.assertEqual(devices.stats()['devices'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the vehicle telemetry store.
+"""
+
+import time, unittest
+
+from telemetry import Channel, TelemetryStore, flattenReport
+
+
+class FlattenReportTest(unittest.TestCase):
+
+    def test_nested_values_become_channels(self):
+        data = [{'channel': 'speed', 'value': '42.5'},
+                {'channel': 'seats', 'value': {'frontleft': 'occupied'}}]
+        self.assertEqual(flattenReport(data), [('speed', '42.5'), ('seats.frontleft', 'occupied')])
+
+
+class ChannelTest(unittest.TestCase):
+
+    def test_latest_after_ring_wrap(self):
+        channel = Channel(samples=4, buckets=3, resolution=10)
+        for i in range(0, 6):
+            channel.add(100 + i, float(i))
+        self.assertEqual(channel.latest(), (105.0, 5.0))
+
+    def test_aggregate_uses_samples_within_ring(self):
+        channel = Channel(samples=4, buckets=3, resolution=10)
+        for i in range(0, 6):
+            channel.add(100 + i, float(i))
+        # samples at 102..105 are kept, 103..105 are in the window
+        self.assertEqual(channel.aggregate(103), (3, 12.0, 3.0, 5.0))
+
+    def test_aggregate_falls_back_to_buckets(self):
+        channel = Channel(samples=4, buckets=3, resolution=10)
+        for i in range(0, 6):
+            channel.add(100 + i, float(i))
+        # the samples do not reach back to 100, the bucket from 100 does
+        self.assertEqual(channel.aggregate(100), (6, 15.0, 0.0, 5.0))
+
+    def test_bucket_ring_wrap(self):
+        channel = Channel(samples=2, buckets=3, resolution=10)
+        for i in range(0, 5):
+            channel.add(100 + 10 * i, float(i))
+            channel.add(105 + 10 * i, float(i) + 0.5)
+        # only the last three buckets, from 120, 130 and 140, are kept
+        self.assertEqual(channel.aggregate(0), (6, 19.5, 2.0, 4.5))
+
+    def test_empty_window(self):
+        channel = Channel(samples=4, buckets=3, resolution=10)
+        channel.add(100, 1.0)
+        self.assertEqual(channel.aggregate(101), (0, 0.0, None, None))
+
+
+class TelemetryStoreTest(unittest.TestCase):
+
+    def test_query_numeric_and_enumerated_channels(self):
+        store = TelemetryStore(samples=8, buckets=4, resolution=60)
+        now = time.time()
+        store.record('VIN1', [('speed', '10'), ('trunk', 'open')], now - 2)
+        store.record('VIN1', [('speed', '30'), ('trunk', 'closed')], now - 1)
+        result = store.query('VIN1', window=60)
+        self.assertEqual(result['speed']['value'], 30.0)
+        self.assertEqual((result['speed']['min'], result['speed']['max'], result['speed']['mean']),
+                         (10.0, 30.0, 20.0))
+        self.assertEqual(result['trunk']['value'], u'closed')
+        self.assertEqual(result['trunk']['count'], 2)
+        self.assertNotIn('mean', result['trunk'])
+
+    def test_query_selected_channels(self):
+        store = TelemetryStore()
+        store.record('VIN1', [('speed', '10'), ('trunk', 'open')])
+        self.assertEqual(store.query('VIN1', channels=['trunk', 'unknown']).keys(), ['trunk'])
+
+    def test_unknown_vehicle(self):
+        self.assertIsNone(TelemetryStore().query('VIN1'))
+
+    def test_least_recently_reporting_vehicle_is_evicted(self):
+        store = TelemetryStore(max_vehicles=2)
+        store.record('VIN1', [('speed', '1')])
+        store.record('VIN2', [('speed', '2')])
+        store.record('VIN1', [('speed', '3')])
+        store.record('VIN3', [('speed', '4')])
+        self.assertIsNone(store.query('VIN2'))
+        self.assertIsNotNone(store.query('VIN1'))
+        self.assertEqual(store.stats()['vehicles'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Tests of the batch trilateration engine.
+"""
+
+import math, unittest
+
+import trilateration
+from trilateration import ReferenceGeometry
+
+
+def scalarCoordinates(dr1, dr2, d):
+    """
+    Coordinates of a point from its distances to two reference points d
+    apart, as the Pixie server calculated them one tag at a time.
+    """
+    x = ((dr1 * dr1) - (dr2 * dr2) + (d * d)) / (2 * d)
+    y = math.sqrt((dr1 * dr1) - (x * x))
+    return (int(round(x)), int(round(y)))
+
+
+def referencePoints(positions):
+    """
+    Return Pixie points with their ranges to each other for reference
+    points at the given positions.
+    """
+    return dict((ref, {'range': dict((other, math.hypot(x - ox, y - oy))
+                                     for other, (ox, oy) in positions.iteritems() if other != ref)})
+                for ref, (x, y) in positions.iteritems())
+
+
+def tagRanges(refs, positions, tag):
+    return [math.hypot(tag[0] - positions[ref][0], tag[1] - positions[ref][1]) for ref in refs]
+
+
+TAGS = [(0, 0), (10, 20), (250, 5), (123, 456), (-40, 30), (300, 300)]
+
+
+class ReferenceGeometryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = trilateration.numpy
+
+    def tearDown(self):
+        trilateration.numpy = self.numpy
+
+    def backends(self):
+        yield 'python', None
+        if self.numpy is not None:
+            yield 'numpy', self.numpy
+
+    def test_two_references_match_scalar_formula(self):
+        refs = ['a', 'b']
+        positions = {'a': (0.0, 0.0), 'b': (200.0, 0.0)}
+        geometry = ReferenceGeometry(refs, referencePoints(positions))
+        self.assertFalse(geometry.planar)
+        ranges = [tagRanges(refs, positions, tag) for tag in TAGS]
+        expected = [scalarCoordinates(r[0], r[1], 200.0) for r in ranges]
+        for name, backend in self.backends():
+            trilateration.numpy = backend
+            self.assertEqual(geometry.locate(ranges), expected, name)
+
+    def test_three_references_locate_exactly(self):
+        refs = ['a', 'b', 'c']
+        positions = {'a': (0.0, 0.0), 'b': (200.0, 0.0), 'c': (60.0, 150.0)}
+        geometry = ReferenceGeometry(refs, referencePoints(positions))
+        self.assertTrue(geometry.planar)
+        ranges = [tagRanges(refs, positions, tag) for tag in TAGS]
+        for name, backend in self.backends():
+            trilateration.numpy = backend
+            self.assertEqual(geometry.locate(ranges), TAGS, name)
+
+    def test_collinear_references(self):
+        refs = ['a', 'b', 'c']
+        positions = {'a': (0.0, 0.0), 'b': (100.0, 0.0), 'c': (300.0, 0.0)}
+        geometry = ReferenceGeometry(refs, referencePoints(positions))
+        self.assertFalse(geometry.planar)
+        tags = [tag for tag in TAGS if tag[1] >= 0]
+        ranges = [tagRanges(refs, positions, tag) for tag in tags]
+        for name, backend in self.backends():
+            trilateration.numpy = backend
+            self.assertEqual(geometry.locate(ranges), tags, name)
+
+    def test_no_tags(self):
+        geometry = ReferenceGeometry(['a', 'b'], referencePoints({'a': (0.0, 0.0), 'b': (1.0, 0.0)}))
+        self.assertEqual(geometry.locate([]), [])
+
+    def test_invalid_references(self):
+        points = referencePoints({'a': (0.0, 0.0), 'b': (0.0, 0.0)})
+        self.assertRaises(ValueError, ReferenceGeometry, ['a'], points)
+        self.assertRaises(ValueError, ReferenceGeometry, ['a', 'b'], points)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,35 +13,49 @@ Thingcontrol (HomeLake) Server.
 """
 
 import os, threading, base64
-import time, httplib, json, math
+import time, httplib, math
 from urlparse import urlparse
-from rvijsonrpc import RVIJSONRPCServer
+from rvijsonrpc import RVICallbackServer
+from httppool import HTTPConnectionPool
+from cache import TTLCache
+from shadow import DeviceShadow
+from streamclient import StreamConnection
+from hagwlogging import payload
 
-import settings
+import settings, jsoncodec
 
 logger = None
 service_edge = None
-transaction_id = 0
+gateway = None
+status_cache = None
+shadow = None
+ivi = None
+# device id of the device reported by a status command
+status_devices = {}
 
 # Thingcontrol Callback Server
-class ThingcontrolCallbackServer(threading.Thread):
+class ThingcontrolCallbackServer(RVICallbackServer):
     """
     RPC server thread responding to Thingcontrol callbacks from the RVI framework
     """
     
-    def __init__(self, _logger, _service_edge):
+    def __init__(self, _logger, _service_edge, _mux=None):
         global logger
         global service_edge
+        global gateway
+        global status_cache
+        global shadow
         logger = _logger
         service_edge = _service_edge
-        threading.Thread.__init__(self)
+        gateway = createGateway()
+        status_cache = createStatusCache()
+        shadow = createShadow()
+        RVICallbackServer.__init__(self, settings.TC_SERVER_CALLBACK_URL, settings.TC_SERVER_SERVICE_ID, _mux)
         self.init_callback_server()
-        self.register_services()
 
     def init_callback_server(self):
         # initialize RPC server and register callback functions
-        url = urlparse(settings.TC_SERVER_CALLBACK_URL)
-        self.localServer =  RVIJSONRPCServer(addr=((url.hostname, url.port)), logRequests=False)
+        self.localServer = self.create_local_server()
         self.localServer.register_function(getDeviceStatus, settings.TC_SERVER_SERVICE_ID + "/getdevicestatus")
         self.localServer.register_function(setHueLighting, settings.TC_SERVER_SERVICE_ID + "/sethuelighting")
         self.localServer.register_function(setOutlet, settings.TC_SERVER_SERVICE_ID + "/setoutlet")
@@ -50,52 +64,92 @@ class ThingcontrolCallbackServer(threading.Thread):
         self.localServer.register_function(setDimmer, settings.TC_SERVER_SERVICE_ID + "/setdimmer")
         self.localServer.register_function(setThermostat, settings.TC_SERVER_SERVICE_ID + "/setthermostat")
         self.localServer.register_function(secureHome, settings.TC_SERVER_SERVICE_ID + "/securehome")
+        self.localServer.register_function(batch, settings.TC_SERVER_SERVICE_ID + "/batch")
         
     def register_services(self):
         # register services with RVI framework
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/getdevicestatus',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: getdevicestatus service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/sethuelighting',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: sethuelighting service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/setoutlet',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: setoutlet service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/setswitch',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: setswitch service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/setlock',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: setlock service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/setdimmer',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: setdimmer service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/setthermostat',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: setthermostat service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.TC_SERVER_SERVICE_ID + '/securehome',
-                                               network_address = settings.TC_SERVER_CALLBACK_URL)
-        logger.info('Thingcontrol Service Registration: setthermostat service name: %s', result['service'])
-
-    def run(self):
-        self.localServer.serve_forever()
-        
+        services = [settings.TC_SERVER_SERVICE_ID + '/' + name for name in
+                    ['getdevicestatus', 'sethuelighting', 'setoutlet', 'setswitch', 'setlock', 'setdimmer', 'setthermostat', 'securehome', 'batch']]
+        for result in self.register_rvi_services(service_edge, services):
+            logger.info('Thingcontrol Service Registration: service name: %s', result['service'])
+
+    live_settings = ('TC_SERVER_GATEWAY_DOMAIN_CONTROL', 'TC_SERVER_GATEWAY_DOMAIN_STATUS',
+                     'TC_SERVER_BATCH_CONCURRENCY', 'TC_SERVER_BATCH_TIMEOUT',
+                     'TC_SERVER_BATCH_MAX_TIMEOUT')
+
+    def start(self):
+        global ivi
+        ivi = createIVIConnection()
+        RVICallbackServer.start(self)
+
+    def reconfigure(self, changed):
+        # swap the gateway, the caches and the IVI connection in place
+        global gateway, status_cache, shadow, ivi
+        changed = set(changed) - set(self.live_settings)
+        handled = set(name for name in changed if name == 'TC_SERVER_STATUS_CACHE_TTL' or
+                      name.startswith(('TC_SERVER_GATEWAY_', 'TC_SERVER_SHADOW_', 'IVI_')))
+        if any(name.startswith('TC_SERVER_GATEWAY_') for name in handled):
+            old, gateway = gateway, createGateway()
+            old.close()
+            logger.info('Thingcontrol Callback Server: gateway now %s', settings.TC_SERVER_GATEWAY_URL)
+        if 'TC_SERVER_STATUS_CACHE_TTL' in changed:
+            status_cache = createStatusCache()
+        if changed & set(['TC_SERVER_SHADOW_ENABLE', 'TC_SERVER_SHADOW_MAX_AGE']):
+            shadow = createShadow()
+        if any(name.startswith('IVI_') for name in handled):
+            old, ivi = ivi, createIVIConnection()
+            if old is not None:
+                old.stop()
+            logger.info('Thingcontrol Callback Server: IVI now %s', settings.IVI_SERVICE_EDGE_URL)
+        return RVICallbackServer.reconfigure(self, changed - handled)
+
     def shutdown(self):
-        self.localServer.shutdown()
-        self.localServer.server_close()
+        global ivi
+        RVICallbackServer.shutdown(self)
+        gateway.close()
+        if ivi is not None:
+            ivi.stop()
+            ivi = None
+
+
+# Outbound connections and caches
+def createGateway():
+    return HTTPConnectionPool(settings.TC_SERVER_GATEWAY_URL,
+                              size=settings.TC_SERVER_GATEWAY_POOL_SIZE,
+                              idle_timeout=settings.TC_SERVER_GATEWAY_IDLE_TIMEOUT,
+                              connect_timeout=settings.TC_SERVER_GATEWAY_CONNECT_TIMEOUT,
+                              read_timeout=settings.TC_SERVER_GATEWAY_READ_TIMEOUT,
+                              name='thingcontrol')
+
+def createStatusCache():
+    if settings.TC_SERVER_STATUS_CACHE_TTL > 0:
+        return TTLCache(settings.TC_SERVER_STATUS_CACHE_TTL)
+    return None
+
+def createShadow():
+    if settings.TC_SERVER_SHADOW_ENABLE == True:
+        return DeviceShadow(settings.TC_SERVER_SHADOW_MAX_AGE)
+    return None
+
+def createIVIConnection():
+    return StreamConnection(settings.IVI_SERVICE_EDGE_URL, logger,
+                            connect_timeout = settings.IVI_CONNECT_TIMEOUT,
+                            write_timeout = settings.IVI_WRITE_TIMEOUT,
+                            send_timeout = settings.IVI_SEND_TIMEOUT,
+                            name = 'ivi')
 
 
 # Callback functions
 def getDeviceStatus(devices, sendto):
     """
-    Return the status of the home automation devices.
+    Return the status of the home automation devices, from the device
+    shadow if it knows the current state.
     :param: devices: list of devices (wildcards ok)
     :param: sendto: RVI service to send the response to
     """
     logger.info('Thingcontrol Callback Server: getDeviceStatus: devices: %s, sento: %s.', devices, sendto)
     if '*' in devices or 'thermostat' in devices:
-        data = getThingcontrolStatus('thermostat')
+        data = getShadowStatus('thermostat') or getThingcontrolStatus('thermostat')
     else:
         logger.warning('Thingcontrol Callback Server: getDeviceStatus: unknown device')
         return {u'status': 1}
@@ -111,13 +165,8 @@ def setHueLighting(deviceid, control):
     :param: deviceid: id of the hue lighting device
     :param: control: hue settings
     """
-    logger.info('Thingcontrol Callback Server: setHueLighting: deviceid: %s, control: %s.', deviceid, control)
-    data = initData()
-    data['device_id'] = deviceid
-    data['device_type'] = 'zb_hue_bulb'
-    data['msgTyp'] = 'zb_hue_msg'
-    data['control'] = control
-    sendThingcontrolCommand('huelighting', data)
+    logger.info('Thingcontrol Callback Server: setHueLighting: deviceid: %s, control: %s.', deviceid, payload(control))
+    sendThingcontrolCommand('huelighting', makeCommand('huelighting', deviceid, control))
     return {u'status': 0}
 
 def setOutlet(deviceid, control):
@@ -126,13 +175,8 @@ def setOutlet(deviceid, control):
     :param: deviceid: id of the outlet device
     :param: control: state
     """
-    logger.info('Thingcontrol Callback Server: setOutlet: deviceid: %s, control: %s.', deviceid, control)
-    data = initData()
-    data['device_id'] = deviceid
-    data['device_type'] = 'zb-smartplug'
-    data['msgTyp'] = 'zb_smartplug_msg'
-    data['control'] = control
-    sendThingcontrolCommand('wallsmartoutlet', data)
+    logger.info('Thingcontrol Callback Server: setOutlet: deviceid: %s, control: %s.', deviceid, payload(control))
+    sendThingcontrolCommand('wallsmartoutlet', makeCommand('wallsmartoutlet', deviceid, control))
     return {u'status': 0}
 
 def setSwitch(deviceid, control):
@@ -141,13 +185,8 @@ def setSwitch(deviceid, control):
     :param: deviceid: id of the switch device
     :param: control: state
     """
-    logger.info('Thingcontrol Callback Server: setSwitch: deviceid: %s, control: %s.', deviceid, control)
-    data = initData()
-    data['device_id'] = deviceid
-    data['device_type'] = 'zb-smartswitch'
-    data['msgTyp'] = 'zb_smartswitch_msg'
-    data['control'] = control
-    sendThingcontrolCommand('smartswitch', data)
+    logger.info('Thingcontrol Callback Server: setSwitch: deviceid: %s, control: %s.', deviceid, payload(control))
+    sendThingcontrolCommand('smartswitch', makeCommand('smartswitch', deviceid, control))
     return {u'status': 0}
 
 def setLock(deviceid, control):
@@ -156,13 +195,8 @@ def setLock(deviceid, control):
     :param: deviceid: id of the lock device
     :param: control: state
     """
-    logger.info('Thingcontrol Callback Server: setLock: deviceid: %s, control: %s.', deviceid, control)
-    data = initData()
-    data['device_id'] = deviceid
-    data['device_type'] = 'zb_door_lock'
-    data['msgTyp'] = 'zb_door_msg'
-    data['control'] = control
-    sendThingcontrolCommand('doorlock', data)
+    logger.info('Thingcontrol Callback Server: setLock: deviceid: %s, control: %s.', deviceid, payload(control))
+    sendThingcontrolCommand('doorlock', makeCommand('doorlock', deviceid, control))
     return {u'status': 0}
 
 def setDimmer(deviceid, control):
@@ -171,13 +205,8 @@ def setDimmer(deviceid, control):
     :param: deviceid: id of the dimmer device
     :param: control: state
     """
-    logger.info('Thingcontrol Callback Server: setDimmer: deviceid: %s, control: %s.', deviceid, control)
-    data = initData()
-    data['device_id'] = deviceid
-    data['device_type'] = 'zb-dimmer'
-    data['msgTyp'] = 'zb_dimmer_msg'
-    data['control'] = control
-    sendThingcontrolCommand('dimmer', data)
+    logger.info('Thingcontrol Callback Server: setDimmer: deviceid: %s, control: %s.', deviceid, payload(control))
+    sendThingcontrolCommand('dimmer', makeCommand('dimmer', deviceid, control))
     return {u'status': 0}
 
 def setThermostat(deviceid, control):
@@ -186,33 +215,87 @@ def setThermostat(deviceid, control):
     :param: deviceid: id of the thermostat device
     :param: control: state
     """
-    logger.info('Thingcontrol Callback Server: setThermostat: deviceid: %s, control: %s.', deviceid, control)
-    data = initData()
-    data['device_id'] = deviceid
-    data['device_type'] = 'zw_thermostat'
-    data['msgTyp'] = 'zw_thermostat_msg'
-    data['control'] = control
-    sendThingcontrolCommand('thermostat', data)
+    logger.info('Thingcontrol Callback Server: setThermostat: deviceid: %s, control: %s.', deviceid, payload(control))
+    sendThingcontrolCommand('thermostat', makeCommand('thermostat', deviceid, control))
     return {u'status': 0}
 
 def secureHome(deviceid, control):
     """
-    Control thermostat device.
-    :param: deviceid: id of the thermostat device
-    :param: control: state
+    Arm or disarm the smarthome: switch all lights off and lock all doors,
+    or switch them on and unlock the doors. The devices are controlled
+    concurrently.
+    :param: deviceid: not used
+    :param: control: [{'value': 'arm'}] or [{'value': 'disarm'}]
     """
-    logger.info('Thingcontrol Callback Server: secureHome: deviceid: %s, control: %s.', deviceid, control)
+    logger.info('Thingcontrol Callback Server: secureHome: deviceid: %s, control: %s.', deviceid, payload(control))
     for c in control:
         if 'value' in c:
             if c['value'] == 'arm':
-                switchLights('off')
-                lockDoors('lock')
+                commands = [lightsCommand('off'), doorsCommand('lock')]
             elif c['value'] == 'disarm':
-                switchLights('on')
-                lockDoors('unlock')
+                commands = [lightsCommand('on'), doorsCommand('unlock')]
+            else:
+                continue
+            # security commands are always sent, see sendThingcontrolCommand()
+            results = runBatch(commands, settings.TC_SERVER_BATCH_TIMEOUT, force=True)
+            if any(result['status'] != 'ok' for result in results):
+                return {u'status': 1, u'results': results}
     return {u'status': 0}
 
-   
+def batch(commands, sendto=None, timeout=None):
+    """
+    Send a list of device commands to the gateway concurrently and return
+    the result for every command, in the order of the commands, see
+    runBatch().
+    :param: commands: list of {'command': command, 'deviceid': id, 'control': control}
+                      with command one of the device types, e.g. 'huelighting'
+    :param: sendto: optional RVI service to send the results to as well
+    :param: timeout: overall timeout in seconds, defaults to TC_SERVER_BATCH_TIMEOUT,
+                     at most TC_SERVER_BATCH_MAX_TIMEOUT
+    """
+    logger.info('Thingcontrol Callback Server: batch: commands: %s, sendto: %s.', payload(commands), sendto)
+    if timeout is None:
+        timeout = settings.TC_SERVER_BATCH_TIMEOUT
+    elif isinstance(timeout, bool) or not isinstance(timeout, (int, long, float)) or timeout < 0:
+        return {u'status': 1, u'error': u'timeout must be a non-negative number'}
+    timeout = min(timeout, settings.TC_SERVER_BATCH_MAX_TIMEOUT)
+    batch_commands = []
+    for c in commands:
+        command, deviceid = c.get('command'), c.get('deviceid')
+        if command in device_types:
+            batch_commands.append((command, deviceid, makeCommand(command, deviceid, c.get('control'))))
+        else:
+            batch_commands.append((command, deviceid, None))
+    results = runBatch(batch_commands, timeout)
+    status = 0 if all(result['status'] == 'ok' for result in results) else 1
+    if sendto:
+        sendRVIMessage(sendto, {u'status': status, u'results': results})
+    return {u'status': status, u'results': results}
+
+
+# Gateway command: (device type, message type)
+device_types = {
+    'huelighting': ('zb_hue_bulb', 'zb_hue_msg'),
+    'wallsmartoutlet': ('zb-smartplug', 'zb_smartplug_msg'),
+    'smartswitch': ('zb-smartswitch', 'zb_smartswitch_msg'),
+    'doorlock': ('zb_door_lock', 'zb_door_msg'),
+    'dimmer': ('zb-dimmer', 'zb_dimmer_msg'),
+    'thermostat': ('zw_thermostat', 'zw_thermostat_msg'),
+}
+
+def makeCommand(command, deviceid, control):
+    """
+    Return the Thingcontrol message for a device command.
+    :param: command: gateway command, a key of device_types
+    :param: deviceid: id of the device
+    :param: control: device settings
+    """
+    data = initData()
+    data['device_id'] = deviceid
+    data['device_type'], data['msgTyp'] = device_types[command]
+    data['control'] = control
+    return data
+
 def initData():
     """
     Initialize data structure for Thingcontrol message
@@ -232,110 +315,237 @@ def initData():
     }
     return data
     
-def switchLights(state):
+def lightsCommand(state):
     """
-    Turn on/off all lights in the smarthome.
+    Return the batch command turning on/off all lights in the smarthome.
     :param: state: 'on' or 'off'
     """
-    data = initData()
-    data['device_id'] = 'wip_gw2.zb_hue01'
-    data['device_type'] = 'zb_hue_bulb'
-    data['msgTyp'] = 'zb_hue_msg'
     if state == "off":
-        data['control'] = [{"value":0, "controlR":0, "controlG":0, "controlB":0}]
+        control = [{"value":0, "controlR":0, "controlG":0, "controlB":0}]
     else:
-        data['control'] = [{"value":255, "controlR":255, "controlG":255, "controlB":255}]
-    sendThingcontrolCommand('huelighting', data)
+        control = [{"value":255, "controlR":255, "controlG":255, "controlB":255}]
+    return ('huelighting', 'wip_gw2.zb_hue01', makeCommand('huelighting', 'wip_gw2.zb_hue01', control))
     
-def lockDoors(state):
+def doorsCommand(state):
     """
-    Lock/unlock all doors in the smarthome
+    Return the batch command locking/unlocking all doors in the smarthome.
     :param: state: 'lock' or 'unlock'
     """
-    data = initData()
-    data['device_id'] = 'wip_gw2.zb_lock01'
-    data['device_type'] = 'zb_door_lock'
-    data['msgTyp'] = 'zb_door_msg'
-    data['control'] = [{"state":state}]
-    sendThingcontrolCommand('doorlock', data)
-    
+    return ('doorlock', 'wip_gw2.zb_lock01', makeCommand('doorlock', 'wip_gw2.zb_lock01', [{"state":state}]))
     
     
-def sendThingcontrolCommand(command, data):
+# Commands never suppressed by the shadow: the device may have been changed
+# by hand since, and a lock command must not be skipped on a stale state
+SHADOW_EXEMPT = set(['doorlock'])
+
+def sendThingcontrolCommand(command, data, force=False):
     """
     Connect to the Thingcontrol server and send a command.
+    Returns the HTTP status of the response or None if sending failed.
+    A command that would not change the state of the device according to
+    the device shadow is not sent and 304 (not modified) is returned,
+    unless it is forced or one of SHADOW_EXEMPT.
     :param: command: command to send
     :param: data: JSON data blob for command
+    :param: force: send the command even if the shadow has it unchanged
     """
-    logger.info('Thingcontrol Callback Server: sendThingcontrolCommand: command: %s, data: %s, dest: %s.', command, data, settings.TC_SERVER_GATEWAY_URL)
+    if (shadow is not None and not force and command not in SHADOW_EXEMPT
+            and shadow.unchanged(data)):
+        logger.info('Thingcontrol Callback Server: sendThingcontrolCommand: command: %s, device: %s: no change, not sent.', command, data['device_id'])
+        return httplib.NOT_MODIFIED
+    logger.info('Thingcontrol Callback Server: sendThingcontrolCommand: command: %s, data: %s, dest: %s.', command, payload(data), settings.TC_SERVER_GATEWAY_URL)
     try:
-        url = urlparse(settings.TC_SERVER_GATEWAY_URL)
-        con = httplib.HTTPConnection(url.hostname, url.port)
         path = settings.TC_SERVER_GATEWAY_DOMAIN_CONTROL + '/' + command
         headers = { 'Content-Type':'application/json', 'Accept':'application/json'}
-        con.request('POST', path, json.dumps(data), headers)
-        res = con.getresponse()
-        logger.info('Thingcontrol Callback Server: sendThingcontrolCommand: Response: %s %s', res.status, res.reason)
+        status, reason, body = gateway.request('POST', path, jsoncodec.dumps(data), headers)
+        logger.info('Thingcontrol Callback Server: sendThingcontrolCommand: Response: %s %s', status, reason)
     except Exception as e:
         logger.error('Thingcontrol Callback Server: sendThingcontrolCommand: Exception: %s', e)
-    return data
+        status = None
+    if shadow is not None:
+        if status is not None and status < 300:
+            shadow.update(data, 'command')
+        else:
+            # the state of the device is unknown
+            shadow.invalidate(data['device_id'])
+    if status_cache is not None:
+        # whether applied or not, the cached status may be outdated now
+        for key in set([command]) | set(key for key, device_id in status_devices.items()
+                                         if device_id == data['device_id']):
+            status_cache.invalidate(key)
+    return status
+
+
+def runBatch(commands, timeout, force=False):
+    """
+    Send commands to the Thingcontrol server concurrently, with at most
+    TC_SERVER_BATCH_CONCURRENCY requests in flight, and return a result
+    per command in the order of the commands. Does not wait longer than
+    timeout seconds. Commands still in flight when the timeout expires may
+    or may not have been carried out and are reported as 'unknown',
+    commands not sent by then as 'error'.
+    :param: commands: list of (command, deviceid, data), data None for an unknown command
+    :param: timeout: overall timeout in seconds
+    :param: force: send the commands even if the shadow has them unchanged
+    """
+    deadline = time.time() + timeout
+    results = [None] * len(commands)
+    pending = range(len(commands) - 1, -1, -1)
+    sent = set()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or time.time() >= deadline:
+                    return
+                i = pending.pop()
+                sent.add(i)
+            command, deviceid, data = commands[i]
+            begin = time.time()
+            if data is None:
+                result = {u'status': u'error', u'error': u'unknown command'}
+            else:
+                status = sendThingcontrolCommand(command, data, force)
+                if status == httplib.NOT_MODIFIED:
+                    result = {u'status': u'ok', u'suppressed': True}
+                elif status is None:
+                    result = {u'status': u'error', u'error': u'gateway not reachable'}
+                elif status >= 300:
+                    result = {u'status': u'error', u'error': u'gateway status %d' % status}
+                else:
+                    result = {u'status': u'ok'}
+            result[u'seconds'] = round(time.time() - begin, 3)
+            with lock:
+                results[i] = result
+
+    workers = []
+    for n in range(0, min(len(commands), settings.TC_SERVER_BATCH_CONCURRENCY)):
+        thread = threading.Thread(target=worker, name='ThingcontrolBatch-%d' % n)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join(max(deadline - time.time(), 0))
+    with lock:
+        # stop the workers from starting further commands
+        del pending[:]
+        final = []
+        for i, result in enumerate(results):
+            if result is None and i in sent:
+                result = {u'status': u'unknown', u'error': u'no reply within timeout'}
+            elif result is None:
+                result = {u'status': u'error', u'error': u'not sent within timeout'}
+            final.append(result)
+    for (command, deviceid, data), result in zip(commands, final):
+        result[u'command'] = command
+        result[u'deviceid'] = deviceid
+    return final
     
     
 def getThingcontrolStatus(command):
+    """
+    Get the status information from the status cache or, if it is not
+    cached, from the Thingcontrol Server.
+    :param: command: the status command
+    """
+    if status_cache is None:
+        return fetchThingcontrolStatus(command)
+    return status_cache.get(command, lambda: fetchThingcontrolStatus(command))
+
+
+def fetchThingcontrolStatus(command):
     """
     Connect to the Thingcontrol Server and get the termostat status information.
     :param: command: the status command
     """
     logger.info('Thingcontrol Callback Server: getThingcontrolStatus: command: %s, dest: %s.', command, settings.TC_SERVER_GATEWAY_URL)
     try:
-        url = urlparse(settings.TC_SERVER_GATEWAY_URL)
-        con = httplib.HTTPConnection(url.hostname, url.port)
         path = settings.TC_SERVER_GATEWAY_DOMAIN_STATUS + '/' + command
-        con.request('GET', path)
-        res = con.getresponse()
-        data = json.loads(res.read())
+        status, reason, body = gateway.request('GET', path)
+        data = jsoncodec.loads(body)
     except Exception as e:
         logger.error('Thingcontrol Callback Server: getThingcontrolStatus: Exception: %s', e)
         data = None
+    if isinstance(data, dict) and data.get('device_id'):
+        status_devices[command] = data['device_id']
+        if shadow is not None:
+            shadow.update(data, 'status')
     return data
+
+
+def getShadowStatus(command):
+    """
+    Return the state of the device reported by a status command from the
+    device shadow, or None if the shadow does not know it.
+    :param: command: the status command
+    """
+    if shadow is None or command not in status_devices:
+        return None
+    return shadow.get(status_devices[command])
+
+
+def getStatistics():
+    """
+    Return the statistics of the Thingcontrol Server.
+    """
+    stats = {}
+    if gateway is not None:
+        stats['gateway'] = gateway.stats()
+    if status_cache is not None:
+        stats['status_cache'] = status_cache.stats()
+    if shadow is not None:
+        stats['shadow'] = shadow.stats()
+    if ivi is not None:
+        stats['ivi'] = ivi.stats()
+    return stats
     
 
-old_temp = 0
+old_temp = None
 def setIVIHVAC():
-    data = getThingcontrolStatus('thermostat')
+    """
+    Set the vehicle HVAC to the target temperature of the home thermostat
+    if it has changed since the last update.
+    """
+    global old_temp
+    data = getShadowStatus('thermostat') or getThingcontrolStatus('thermostat')
     if data == None: return False
+    temp = None
     for c in data['control']:
         if 'target_temp' in c: temp = c['target_temp']
+    if temp is None: return False
     if temp != old_temp:
         control = {}
         control['temp_front_left'] = temp
         control['temp_front_right'] = temp
         control['fan_speed'] = 5
-        sendIVI(settings.IVI_SERVICE_EDGE_URL, control)
+        if not sendIVI(jsoncodec.dumps(control)):
+            return False
+        old_temp = temp
     return True
-    
+
+
+def sendIVI(message):
+    """
+    Send a message to the IVI. The message is queued on the persistent
+    IVI connection and written in the background.
+    :param: message: message
+    """
+    logger.info('Sending to IVI: %s, message: %s', settings.IVI_SERVICE_EDGE_URL, message)
+    if ivi is None or not ivi.send(message):
+        logger.error('Sending to IVI failed: %s', 'not connected' if ivi is None else 'queue full')
+        return False
+    return True
+
+
     
 def sendRVIMessage(sendto, message):
     """
     Send message to recipient via RVI.
     :param: sendto: recipient RVI service
-    :param: meessage: message as RVI parameter block
+    :param: message: message as RVI parameter block
     """
-    
-    logger.info('Thingcontrol Callback Server: sending message: %s to %s', message, sendto)
-    
-    # send message
-    try:
-        service_edge.message(service_name = sendto,
-                           timeout = int(time.time()) + settings.RVI_SEND_TIMEOUT,
-                           parameters = [message])
-    except Exception as e:
-        logger.error('Thingcontrol Callback Server: cannot send message: %s', e)
-        return False
-    
-    logger.info('Thingcontrol Callback Server: successfully sent message: to %s', sendto)
-
-    return True
+    return service_edge.send(sendto, message, logger, 'Thingcontrol Callback Server')
 
 
 
@@ -0,0 +1,188 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Per-request traces. Every inbound RPC call gets a trace id, which is added
+to the log records written while handling the call and sent with its
+outbound HTTP requests. Outbound calls are recorded as timing spans of the
+trace, and traces slower than settings.TRACE_SLOW_THRESHOLD are logged and
+kept for /core/gettraces.
+"""
+
+import os, re, threading, time, binascii, collections
+import logging
+
+import settings
+
+# HTTP header carrying the trace id of outbound requests
+TRACE_HEADER = 'X-HAGW-Trace-Id'
+# trace ids accepted from callers, anything else could corrupt the header
+TRACE_ID = re.compile(r'[0-9A-Za-z-]{1,64}\Z')
+
+logger = logging.getLogger('hagw.default')
+local = threading.local()
+
+
+class Trace(object):
+    """
+    Trace of one inbound call: its id, name, duration and the spans of its
+    outbound calls. Spans may still be added by background senders after
+    the trace has ended.
+    """
+
+    def __init__(self, trace_id, name):
+        self.id = trace_id
+        self.name = name
+        self.begin = time.time()
+        self.seconds = None
+        self.failed = False
+        self.spans = []
+
+    def add(self, name, seconds, failed):
+        self.spans.append((name, time.time() - seconds - self.begin, seconds, failed))
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'begin': self.begin,
+            'seconds': self.seconds,
+            'failed': self.failed,
+            'spans': [{'name': name, 'offset': offset, 'seconds': seconds, 'failed': failed}
+                      for name, offset, seconds, failed in list(self.spans)],
+        }
+
+
+# slow traces, most recent last
+slow = collections.deque(maxlen=settings.TRACE_HISTORY)
+
+
+def setHistory(size):
+    """
+    Change the number of slow traces kept.
+    """
+    global slow
+    slow = collections.deque(slow, maxlen=size)
+
+
+def newId():
+    return binascii.hexlify(os.urandom(8))
+
+
+def current():
+    """
+    Return the trace of the calling thread or None.
+    """
+    return getattr(local, 'trace', None)
+
+
+def currentId():
+    trace = getattr(local, 'trace', None)
+    return trace.id if trace is not None else None
+
+
+def begin(name, trace_id=None):
+    """
+    Start the trace of an inbound call on the calling thread. Returns the
+    trace or None if tracing is disabled.
+    :param: name: service name
+    :param: trace_id: trace id given by the caller, replaced by a new one
+                      unless it is 1 to 64 letters, digits or dashes
+    """
+    if not settings.TRACE_ENABLE:
+        return None
+    if not isinstance(trace_id, basestring) or not TRACE_ID.match(trace_id):
+        trace_id = newId()
+    local.trace = Trace(str(trace_id), name)
+    return local.trace
+
+
+def rename(name):
+    """
+    Rename the trace of the calling thread, e.g. once the service of an
+    RVI message is known.
+    """
+    trace = getattr(local, 'trace', None)
+    if trace is not None:
+        trace.name = name
+
+
+def end(trace, failed=False):
+    """
+    End a trace started with begin(). Slow traces are logged and kept.
+    :param: trace: trace returned by begin()
+    :param: failed: True if the call failed
+    """
+    if trace is None:
+        return
+    trace.seconds = time.time() - trace.begin
+    trace.failed = failed
+    if trace.seconds >= settings.TRACE_SLOW_THRESHOLD:
+        slow.append(trace)
+        logger.warning('Trace %s: %s took %.1f ms: %s', trace.id, trace.name, trace.seconds * 1000,
+                       ', '.join('%s %.1f ms' % (name, seconds * 1000)
+                                 for name, offset, seconds, failed in trace.spans) or 'no spans')
+    local.trace = None
+
+
+def resume(trace):
+    """
+    Continue a trace on another thread, e.g. a background sender. Returns
+    the trace the thread had before, to be resumed afterwards.
+    :param: trace: trace taken from current() on the originating thread
+    """
+    previous = getattr(local, 'trace', None)
+    local.trace = trace
+    return previous
+
+
+def record(name, seconds, failed=False):
+    """
+    Record an outbound call as a span of the trace of the calling thread.
+    :param: name: dependency name
+    :param: seconds: duration
+    :param: failed: True if the call failed
+    """
+    trace = getattr(local, 'trace', None)
+    if trace is not None:
+        trace.add(name, seconds, failed)
+
+
+def headers(headers):
+    """
+    Return the headers of an outbound HTTP request with the trace id of
+    the calling thread added.
+    :param: headers: request headers, not modified
+    """
+    trace = getattr(local, 'trace', None)
+    if trace is None:
+        return headers
+    return dict(headers, **{TRACE_HEADER: trace.id})
+
+
+def traces(limit=None):
+    """
+    Return the summaries of the most recent slow traces, newest first.
+    :param: limit: maximum number of traces
+    """
+    recent = list(slow)
+    recent.reverse()
+    return [trace.summary() for trace in recent[:limit]]
+
+
+class TraceFilter(logging.Filter):
+    """
+    Add the trace id of the calling thread to log records as trace_id,
+    '-' outside of traces.
+    """
+
+    def filter(self, record):
+        record.trace_id = currentId() or '-'
+        return True
@@ -0,0 +1,104 @@
+"""
+Copyright (C) 2014, Jaguar Land Rover
+
+This program is licensed under the terms and conditions of the
+Mozilla Public License, version 2.0.  The full text of the
+Mozilla Public License is at https://www.mozilla.org/MPL/2.0/
+
+Maintainer: Rudolf Streif (rstreif@jaguarlandrover.com)
+"""
+
+"""
+Batch trilateration of Pixie tags from their distances to two or more
+reference points. Uses NumPy if it is installed.
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ReferenceGeometry(object):
+    """
+    Positions of the reference points and the least squares solver derived
+    from them. The first reference point is the origin, the second one lies
+    on the x axis and all further ones are placed from their distances to
+    the first two, with y >= 0.
+
+    For a tag with distances r0..rn to the reference points p0..pn the
+    linearized equations 2 * pi . (x, y) = r0^2 - ri^2 + |pi|^2, i = 1..n
+    are solved in the least squares sense. If all reference points lie on
+    the x axis, which is always the case for two of them, only x can be
+    solved for and y is taken from the distance to the origin.
+    """
+
+    def __init__(self, refs, points):
+        """
+        :param: refs: ids of the reference points
+        :param: points: Pixie points by id, with their ranges to the other points
+        """
+        if len(refs) < 2:
+            raise ValueError('at least two reference points are required')
+        self.refs = list(refs)
+        d = float(points[refs[0]]['range'][refs[1]])
+        if d <= 0:
+            raise ValueError('reference points %s and %s coincide' % (refs[0], refs[1]))
+        self.positions = [(0.0, 0.0), (d, 0.0)]
+        for ref in refs[2:]:
+            r0 = float(points[refs[0]]['range'][ref])
+            r1 = float(points[refs[1]]['range'][ref])
+            px = (r0 * r0 - r1 * r1 + d * d) / (2 * d)
+            self.positions.append((px, math.sqrt(max(r0 * r0 - px * px, 0.0))))
+        # right hand side offsets |pi|^2 and rows 2 * pi of the system matrix
+        self.norms = [x * x + y * y for x, y in self.positions[1:]]
+        rows = [(2 * x, 2 * y) for x, y in self.positions[1:]]
+        sxx = sum(a * a for a, b in rows)
+        sxy = sum(a * b for a, b in rows)
+        syy = sum(b * b for a, b in rows)
+        det = sxx * syy - sxy * sxy
+        self.planar = det > 1e-9 * max(sxx * syy, 1.0)
+        if self.planar:
+            # pseudo inverse (A^T A)^-1 A^T of the system matrix
+            self.wx = [(syy * a - sxy * b) / det for a, b in rows]
+            self.wy = [(sxx * b - sxy * a) / det for a, b in rows]
+        else:
+            self.wx = [a / sxx for a, b in rows]
+            self.wy = None
+
+    def locate(self, ranges):
+        """
+        Return the coordinates (x, y) of tags rounded to integers.
+        :param: ranges: per tag the list of its distances to the reference points
+        """
+        if not ranges:
+            return []
+        if numpy is not None:
+            return self.locate_numpy(ranges)
+        return [self.locate_one(r) for r in ranges]
+
+    def locate_one(self, r):
+        r0 = r[0] * r[0]
+        b = [r0 - ri * ri + n for ri, n in zip(r[1:], self.norms)]
+        x = sum(w * bi for w, bi in zip(self.wx, b))
+        if self.planar:
+            y = sum(w * bi for w, bi in zip(self.wy, b))
+        else:
+            y = math.sqrt(max(r0 - x * x, 0.0))
+        return (int(round(x)), int(round(y)))
+
+    def locate_numpy(self, ranges):
+        r = numpy.asarray(ranges, dtype=float)
+        r2 = r * r
+        b = r2[:, :1] - r2[:, 1:] + numpy.asarray(self.norms)
+        x = b.dot(numpy.asarray(self.wx))
+        if self.planar:
+            y = b.dot(numpy.asarray(self.wy))
+        else:
+            y = numpy.sqrt(numpy.maximum(r2[:, 0] - x * x, 0.0))
+        # round half away from zero like round()
+        x = numpy.sign(x) * numpy.floor(numpy.abs(x) + 0.5)
+        y = numpy.sign(y) * numpy.floor(numpy.abs(y) + 0.5)
+        return zip(x.astype(int).tolist(), y.astype(int).tolist())
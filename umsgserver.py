@@ -15,51 +15,40 @@ User Message Server.
 import os, threading, base64
 import time, httplib, json, math
 from urlparse import urlparse
-from rvijsonrpc import RVIJSONRPCServer
+from rvijsonrpc import RVICallbackServer
+from hagwlogging import payload
 
 import settings
 
 logger = None
 service_edge = None
-transaction_id = 0
 
 # Usermessage Callback Server
-class UsermessageCallbackServer(threading.Thread):
+class UsermessageCallbackServer(RVICallbackServer):
     """
     RPC server thread responding to user message callbacks from the RVI framework
     """
     
-    def __init__(self, _logger, _service_edge):
+    def __init__(self, _logger, _service_edge, _mux=None):
         global logger
         global service_edge
         logger = _logger
         service_edge = _service_edge
-        threading.Thread.__init__(self)
+        RVICallbackServer.__init__(self, settings.UM_SERVER_CALLBACK_URL, settings.UM_SERVER_SERVICE_ID, _mux)
         self.init_callback_server()
-        self.register_services()
 
     def init_callback_server(self):
         # initialize RPC server and register callback functions
-        url = urlparse(settings.UM_SERVER_CALLBACK_URL)
-        self.localServer =  RVIJSONRPCServer(addr=((url.hostname, url.port)), logRequests=False)
+        self.localServer = self.create_local_server()
         self.localServer.register_function(showUserMessage, settings.UM_SERVER_SERVICE_ID + "/showusermessage")
-        self.localServer.register_function(cancelUserMessage, settings.UM_SERVER_SERVICE_ID + "/canelusermessage")
+        self.localServer.register_function(cancelUserMessage, settings.UM_SERVER_SERVICE_ID + "/cancelusermessage")
         
     def register_services(self):
         # register services with RVI framework
-        result = service_edge.register_service(service = settings.UM_SERVER_SERVICE_ID + '/showusermessage',
-                                               network_address = settings.UM_SERVER_CALLBACK_URL)
-        logger.info('Usermessage Service Registration: showusermessage service name: %s', result['service'])
-        result = service_edge.register_service(service = settings.UM_SERVER_SERVICE_ID + '/cancelusermessage',
-                                               network_address = settings.UM_SERVER_CALLBACK_URL)
-        logger.info('Usermessage Service Registration: cancelusermessage service name: %s', result['service'])
-
-    def run(self):
-        self.localServer.serve_forever()
-        
-    def shutdown(self):
-        self.localServer.shutdown()
-        self.localServer.server_close()
+        services = [settings.UM_SERVER_SERVICE_ID + '/' + name for name in
+                    ['showusermessage', 'cancelusermessage']]
+        for result in self.register_rvi_services(service_edge, services):
+            logger.info('Usermessage Service Registration: service name: %s', result['service'])
 
 
 # Callback functions
@@ -70,7 +59,7 @@ def showUserMessage(messageid, displays, messagetext):
     :param: displays: list of displays to show the message on
     :param: messagetext: text of the message
     """
-    logger.info('Usermessage Callback Server: showUserMessage: messageid: %s, displays: %s, message: %s.', messageid, displays, messagetext)
+    logger.info('Usermessage Callback Server: showUserMessage: messageid: %s, displays: %s, message: %s.', messageid, displays, payload(messagetext))
     return {u'status': 0}
 
 def cancelUserMessage(messageid, displays):
@@ -79,5 +68,5 @@ def cancelUserMessage(messageid, displays):
     :param: messageid: unique id of the message
     :param: displays: list of displays to remove the message from
     """
-    logger.info('Usermessage Callback Server: cancelUserMessage: messageid: %s, displays: %s, message: %s.', messageid, displays, messagetext)
+    logger.info('Usermessage Callback Server: cancelUserMessage: messageid: %s, displays: %s.', messageid, displays)
     return {u'status': 0}
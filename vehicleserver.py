@@ -15,47 +15,82 @@ Vehicle Server.
 import os, threading, base64, socket
 import time, httplib, json, math
 from urlparse import urlparse
-from rvijsonrpc import RVIJSONRPCServer
+from rvijsonrpc import RVICallbackServer
+from streamclient import StreamConnection
+from telemetry import TelemetryStore, flattenReport
+from rules import RuleEngine
+from hagwlogging import payload
 
 import settings
 
 logger = None
 service_edge = None
-transaction_id = 0
+tv = None
+store = None
+rules = None
 
 # Vehicle Callback Server
-class VehicleCallbackServer(threading.Thread):
+class VehicleCallbackServer(RVICallbackServer):
     """
     RPC server thread responding to vehicle callbacks from the RVI framework
     """
     
-    def __init__(self, _logger, _service_edge):
+    def __init__(self, _logger, _service_edge, _mux=None):
         global logger
         global service_edge
+        global store
+        global rules
         logger = _logger
         service_edge = _service_edge
-        threading.Thread.__init__(self)
+        store = createStore()
+        rules = RuleEngine(settings.VH_SERVER_RULES, actions, logger,
+                           max_vehicles = settings.VH_SERVER_TELEMETRY_MAX_VEHICLES)
+        RVICallbackServer.__init__(self, settings.VH_SERVER_CALLBACK_URL, settings.VH_SERVER_SERVICE_ID, _mux)
         self.init_callback_server()
-        self.register_services()
 
     def init_callback_server(self):
         # initialize RPC server and register callback functions
-        url = urlparse(settings.VH_SERVER_CALLBACK_URL)
-        self.localServer =  RVIJSONRPCServer(addr=((url.hostname, url.port)), logRequests=False)
+        self.localServer = self.create_local_server()
         self.localServer.register_function(statusReport, settings.VH_SERVER_SERVICE_ID + "/statusreport")
+        self.localServer.register_function(getTelemetry, settings.VH_SERVER_SERVICE_ID + "/gettelemetry")
         
     def register_services(self):
         # register services with RVI framework
-        result = service_edge.register_service(service = settings.VH_SERVER_SERVICE_ID + '/statusreport',
-                                               network_address = settings.VH_SERVER_CALLBACK_URL)
-        logger.info('Vehicle Server Service Registration: %s', result['service'])
+        services = [settings.VH_SERVER_SERVICE_ID + '/' + name for name in
+                    ['statusreport', 'gettelemetry']]
+        for result in self.register_rvi_services(service_edge, services):
+            logger.info('Vehicle Server Service Registration: %s', result['service'])
+
+    def start(self):
+        global tv
+        tv = createTVConnection()
+        RVICallbackServer.start(self)
+
+    def reconfigure(self, changed):
+        # swap the rules, the telemetry store and the TV connection in place
+        global store, rules, tv
+        changed = set(changed)
+        handled = set(name for name in changed if name == 'VH_SERVER_RULES' or
+                      name.startswith(('VH_SERVER_TELEMETRY_', 'TV_')))
+        if handled & set(['VH_SERVER_RULES', 'VH_SERVER_TELEMETRY_MAX_VEHICLES']):
+            rules = RuleEngine(settings.VH_SERVER_RULES, actions, logger,
+                               max_vehicles = settings.VH_SERVER_TELEMETRY_MAX_VEHICLES)
+        if any(name.startswith('VH_SERVER_TELEMETRY_') for name in handled):
+            # the recorded telemetry is lost
+            store = createStore()
+        if any(name.startswith('TV_') for name in handled):
+            old, tv = tv, createTVConnection()
+            if old is not None:
+                old.stop()
+            logger.info('Vehicle Callback Server: TV now %s', settings.TV_SERVICE_EDGE_URL)
+        return RVICallbackServer.reconfigure(self, changed - handled)
 
-    def run(self):
-        self.localServer.serve_forever()
-        
     def shutdown(self):
-        self.localServer.shutdown()
-        self.localServer.server_close()
+        global tv
+        RVICallbackServer.shutdown(self)
+        if tv is not None:
+            tv.stop()
+            tv = None
 
 
 # Callback functions
@@ -66,37 +101,76 @@ def statusReport(vin, timestamp, data):
     :param: timestamp: date and time in ISO 8601 format
     :param: data: status report data
     """
-    logger.info('Vehicle Callback Server: statusReport: vin: %s, timestamp: %s, data: %s.', vin, timestamp, data)
+    logger.info('Vehicle Callback Server: statusReport: vin: %s, timestamp: %s, data: %s.', vin, timestamp, payload(data))
     
-    for channel in data:
-        key = channel['channel']
-        value = channel['value']
-        if key == 'seats':
-            frontleft = value['frontleft']
-            frontright = value['frontright']
-        elif key == 'trunk':
-            if value == 'open':
-                msg = '{ "command": "vehicleIncursion", "type": "hatch" }'
-                sendTV(msg)
-        elif key == 'speed':
-            speed = float(value)
-        elif key == 'odometer':
-            odometer = float(value)
+    samples = flattenReport(data)
+    store.record(vin, samples)
+    rules.evaluate(vin, samples)
     
     return {u'status': 0}
 
+def getTelemetry(vin, channels, window, sendto):
+    """
+    Return the latest values of the channels of a vehicle and, if window
+    is given, the number of samples and minimum, maximum and mean of the
+    values in the last window seconds.
+    :param: vin: vehicle identification number
+    :param: channels: list of channels, all channels if empty
+    :param: window: window in seconds, 0 for the latest values only
+    :param: sendto: RVI service to send response to
+    """
+    logger.info('Vehicle Callback Server: getTelemetry: vin: %s, channels: %s, window: %s, sendto: %s.', vin, channels, window, sendto)
+    result = store.query(vin, channels, window)
+    if result is None:
+        return {u'status': 1, u'error': u'unknown vehicle: %s' % vin}
+    sendRVIMessage(sendto, {u'vin': vin, u'channels': result})
+    return {u'status': 0}
+
+def sendRVIMessage(sendto, message):
+    """
+    Send message to recipient via RVI.
+    :param: sendto: recipient RVI service
+    :param: message: message as RVI parameter block
+    """
+    return service_edge.send(sendto, message, logger, 'Vehicle Callback Server')
+
+def createStore():
+    return TelemetryStore(samples = settings.VH_SERVER_TELEMETRY_SAMPLES,
+                          buckets = settings.VH_SERVER_TELEMETRY_BUCKETS,
+                          resolution = settings.VH_SERVER_TELEMETRY_RESOLUTION,
+                          max_vehicles = settings.VH_SERVER_TELEMETRY_MAX_VEHICLES)
+
+def createTVConnection():
+    return StreamConnection(settings.TV_SERVICE_EDGE_URL, logger,
+                            queue_size = settings.TV_QUEUE_SIZE,
+                            connect_timeout = settings.TV_CONNECT_TIMEOUT,
+                            write_timeout = settings.TV_WRITE_TIMEOUT,
+                            send_timeout = settings.TV_SEND_TIMEOUT,
+                            backoff = settings.TV_RECONNECT_BACKOFF,
+                            max_backoff = settings.TV_RECONNECT_MAX_BACKOFF,
+                            name = 'tv')
+
+# Rule actions
+def tvAction(vin, rule, value):
+    sendTV(rule['message'])
+
+def rviAction(vin, rule, value):
+    sendRVIMessage(rule['sendto'], {u'vin': vin, u'rule': rule['name'],
+                                    u'channel': rule['channel'], u'value': value})
+
+actions = {
+    'tv': tvAction,
+    'rvi': rviAction,
+}
+
+
 def sendTV(message):
     """
-    Send a message to the smarthome TV.
+    Send a message to the smarthome TV. The message is queued on the
+    persistent TV connection and written in the background.
     :param: message: message
     """
     logger.info('Sending to TV: %s, message: %s', settings.TV_SERVICE_EDGE_URL, message)
-    try:
-        url = urlparse(settings.TV_SERVICE_EDGE_URL)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((url.hostname, url.port))
-        sock.send(message)
-        sock.close()
-    except Exception as e:
-        logger.error('Sending to TV failed: %s', e)
+    if tv is None or not tv.send(message):
+        logger.error('Sending to TV failed: %s', 'not connected' if tv is None else 'queue full')
 